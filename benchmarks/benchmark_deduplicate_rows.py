@@ -0,0 +1,85 @@
+"""Checks and times deduplicate_rows against the per-group loop it replaced.
+
+    python benchmarks/benchmark_deduplicate_rows.py --n-rows 1000000 --n-layers 3
+
+The rows are random semantic ids with a small codebook, so many of them collide. The loop
+is only timed on --n-reference-rows rows, as it scans all the rows for every group of
+duplicates.
+"""
+import argparse
+import time
+
+import rootutils
+import torch
+
+rootutils.setup_root(__file__, indicator=".project-root", pythonpath=True)
+
+from src.utils.tensor_utils import deduplicate_rows
+
+
+def loop_deduplicate_rows(data: torch.Tensor) -> torch.Tensor:
+    """The previous implementation, with a scan of all the rows per group of duplicates."""
+    unique_rows, inverse_indices, counts = torch.unique(
+        data, dim=0, return_inverse=True, return_counts=True
+    )
+    output_indices = torch.zeros(data.shape[0], dtype=torch.long)
+    for group_idx in torch.nonzero(counts > 1).flatten().tolist():
+        group_rows = torch.nonzero(inverse_indices == group_idx).flatten()
+        output_indices[group_rows] = torch.arange(1, group_rows.numel() + 1)
+    return torch.cat((data, output_indices.unsqueeze(1)), dim=1).long()
+
+
+def time_function(function, n_repeats: int) -> float:
+    """The mean time of function in milliseconds."""
+    start_time = time.perf_counter()
+    for _ in range(n_repeats):
+        function()
+    return 1000 * (time.perf_counter() - start_time) / n_repeats
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n-rows", type=int, default=1_000_000)
+    parser.add_argument("--n-layers", type=int, default=3)
+    parser.add_argument("--codebook-size", type=int, default=64)
+    parser.add_argument("--n-reference-rows", type=int, default=20_000)
+    parser.add_argument("--n-repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    generator = torch.Generator().manual_seed(args.seed)
+    data = torch.randint(
+        0,
+        args.codebook_size,
+        (args.n_rows, args.n_layers),
+        generator=generator,
+        dtype=torch.int16,
+    )
+
+    reference_data = data[: args.n_reference_rows]
+    assert torch.equal(
+        deduplicate_rows(reference_data), loop_deduplicate_rows(reference_data)
+    ), "deduplicate_rows differs from the loop implementation"
+    print(f"deduplicate_rows matches the loop implementation on {args.n_reference_rows} rows")
+
+    result = deduplicate_rows(data, keep_dtype=True)
+    n_duplicated_rows = int((result[:, -1] > 0).sum())
+    loop_milliseconds = time_function(
+        lambda: loop_deduplicate_rows(reference_data), 1
+    )
+    reference_milliseconds = time_function(
+        lambda: deduplicate_rows(reference_data), args.n_repeats
+    )
+    milliseconds = time_function(lambda: deduplicate_rows(data), args.n_repeats)
+    print(
+        f"{args.n_rows} rows of {args.n_layers} ids in [0, {args.codebook_size}),"
+        f" {n_duplicated_rows} duplicated rows, max rank {int(result[:, -1].max())}"
+        f" ({result.dtype}):\n"
+        f"  loop, {args.n_reference_rows} rows:             {loop_milliseconds:.1f} ms\n"
+        f"  deduplicate_rows, {args.n_reference_rows} rows: {reference_milliseconds:.1f} ms\n"
+        f"  deduplicate_rows, {args.n_rows} rows:  {milliseconds:.1f} ms"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""Checks and times SquaredEuclideanDistance against the broadcast implementation it
+replaced.
+
+    python benchmarks/benchmark_distance_functions.py --n-points 4096 --n-centroids 1024
+
+Besides the distances and the assignments of random points, it checks the assignments
+after the centroids are updated in place, as done by the k-means updates and the
+optimizers, so that no stale state is reused across calls.
+"""
+import argparse
+import time
+
+import rootutils
+import torch
+
+rootutils.setup_root(__file__, indicator=".project-root", pythonpath=True)
+
+from src.components.distance_functions import SquaredEuclideanDistance
+
+
+def broadcast_squared_distances(
+    x: torch.Tensor, y: torch.Tensor, batch_size: int = 256
+) -> torch.Tensor:
+    """The previous implementation, with a (batch_size, n2, d) difference tensor."""
+    return torch.cat(
+        [
+            (x[start_idx : start_idx + batch_size].unsqueeze(1) - y.unsqueeze(0))
+            .pow(2)
+            .sum(dim=2)
+            for start_idx in range(0, x.shape[0], batch_size)
+        ],
+        dim=0,
+    )
+
+
+def time_function(function, n_repeats: int) -> float:
+    """The mean time of function in milliseconds, after one warm-up call."""
+    function()
+    start_time = time.perf_counter()
+    for _ in range(n_repeats):
+        function()
+    return 1000 * (time.perf_counter() - start_time) / n_repeats
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n-points", type=int, default=4096)
+    parser.add_argument("--n-centroids", type=int, default=1024)
+    parser.add_argument("--n-features", type=int, default=256)
+    parser.add_argument("--n-updates", type=int, default=5)
+    parser.add_argument("--n-repeats", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    distance_function = SquaredEuclideanDistance()
+    x = torch.randn(args.n_points, args.n_features, dtype=torch.float64)
+    centroids = torch.nn.Parameter(
+        torch.randn(args.n_centroids, args.n_features, dtype=torch.float64)
+    )
+
+    expected_distances = broadcast_squared_distances(x, centroids.detach())
+    distances = distance_function.compute(x, centroids.detach())
+    torch.testing.assert_close(distances, expected_distances)
+
+    for update_idx in range(args.n_updates + 1):
+        if update_idx > 0:
+            # in-place updates of the parameter, as in MiniBatchKMeans.model_step
+            with torch.no_grad():
+                centroids[update_idx % args.n_centroids :: 7] += torch.randn(
+                    1, args.n_features, dtype=torch.float64
+                )
+        ids, min_distances = distance_function.assign(x, centroids.detach())
+        expected_min_distances, expected_ids = broadcast_squared_distances(
+            x, centroids.detach()
+        ).min(dim=1)
+        assert torch.equal(ids, expected_ids), f"Assignments differ at update {update_idx}"
+        torch.testing.assert_close(min_distances, expected_min_distances)
+    print(f"Distances and assignments match over {args.n_updates} in-place updates")
+
+    x = x.float()
+    y = centroids.detach().float()
+    broadcast_milliseconds = time_function(
+        lambda: broadcast_squared_distances(x, y).min(dim=1), args.n_repeats
+    )
+    compute_milliseconds = time_function(
+        lambda: distance_function.compute(x, y).min(dim=1), args.n_repeats
+    )
+    assign_milliseconds = time_function(
+        lambda: distance_function.assign(x, y), args.n_repeats
+    )
+    print(
+        f"{args.n_points} points, {args.n_centroids} centroids, {args.n_features} features"
+        f" ({torch.get_num_threads()} threads):\n"
+        f"  broadcast + min: {broadcast_milliseconds:.2f} ms\n"
+        f"  compute + min:   {compute_milliseconds:.2f} ms\n"
+        f"  assign:          {assign_milliseconds:.2f} ms"
+    )
+
+
+if __name__ == "__main__":
+    main()
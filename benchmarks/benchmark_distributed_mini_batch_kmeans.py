@@ -0,0 +1,137 @@
+"""Checks that MiniBatchKMeans with synchronize_statistics reproduces the single process
+codebook when its batches are split across DDP ranks.
+
+    python benchmarks/benchmark_distributed_mini_batch_kmeans.py --world-size 2 --n-steps 50
+
+Each global batch is split between world_size processes of a gloo process group on CPU,
+and every process runs the same model steps on its share. The centroids and cluster counts
+of every rank are compared with those of a single process running on the global batches.
+It also checks that the gradient update is refused in this setting, as the gradients of the
+global statistics would be averaged again across ranks.
+"""
+import argparse
+import os
+import time
+
+import rootutils
+import torch
+import torch.distributed
+import torch.multiprocessing
+
+rootutils.setup_root(__file__, indicator=".project-root", pythonpath=True)
+
+from src.components.clustering_initializers import KMeansPlusPlusInitInitializer
+from src.components.distance_functions import SquaredEuclideanDistance
+from src.models.modules.clustering.mini_batch_kmeans import MiniBatchKMeans
+
+
+def build_model(
+    centroids: torch.Tensor, update_manually: bool = True
+) -> MiniBatchKMeans:
+    n_clusters, n_features = centroids.shape
+    distance_function = SquaredEuclideanDistance()
+    model = MiniBatchKMeans(
+        n_clusters=n_clusters,
+        n_features=n_features,
+        distance_function=distance_function,
+        initializer=KMeansPlusPlusInitInitializer(
+            n_clusters=n_clusters, distance_function=distance_function
+        ),
+        update_manually=update_manually,
+        synchronize_statistics=True,
+    )
+    # the initialization is skipped, the centroids are set directly
+    with torch.no_grad():
+        model.centroids.copy_(centroids)
+    model.is_initialized = True
+    return model
+
+
+def make_data(args: argparse.Namespace):
+    """The initial centroids and the global batches, the same in every process."""
+    generator = torch.Generator().manual_seed(args.seed)
+    means = 4 * torch.randn(args.n_clusters, args.n_features, generator=generator)
+    batches = [
+        means[torch.randint(0, args.n_clusters, (args.batch_size,), generator=generator)]
+        + torch.randn(args.batch_size, args.n_features, generator=generator)
+        for _ in range(args.n_steps)
+    ]
+    centroids = batches[0][: args.n_clusters].clone()
+    return centroids, batches
+
+
+def run_rank(rank: int, args: argparse.Namespace, results: dict) -> None:
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(args.port)
+    torch.distributed.init_process_group("gloo", rank=rank, world_size=args.world_size)
+    try:
+        centroids, batches = make_data(args)
+        try:
+            build_model(centroids, update_manually=False).model_step(batches[0])
+            gradient_update_refused = False
+        except ValueError:
+            gradient_update_refused = True
+
+        model = build_model(centroids)
+        start_time = time.perf_counter()
+        for batch in batches:
+            # each rank gets a contiguous share of the global batch
+            model.model_step(batch.chunk(args.world_size)[rank])
+        # plain lists, so the results are not shared through torch's memory sharing
+        results[rank] = (
+            model.centroids.detach().tolist(),
+            model.cluster_counts.tolist(),
+            time.perf_counter() - start_time,
+            gradient_update_refused,
+        )
+    finally:
+        torch.distributed.destroy_process_group()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--world-size", type=int, default=2)
+    parser.add_argument("--n-clusters", type=int, default=256)
+    parser.add_argument("--n-features", type=int, default=32)
+    parser.add_argument("--batch-size", type=int, default=4096)
+    parser.add_argument("--n-steps", type=int, default=50)
+    parser.add_argument("--port", type=int, default=29513)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    centroids, batches = make_data(args)
+    model = build_model(centroids)
+    start_time = time.perf_counter()
+    for batch in batches:
+        model.model_step(batch)
+    single_process_seconds = time.perf_counter() - start_time
+    expected_centroids = model.centroids.detach()
+    expected_counts = model.cluster_counts
+
+    with torch.multiprocessing.Manager() as manager:
+        results = manager.dict()
+        torch.multiprocessing.spawn(
+            run_rank, args=(args, results), nprocs=args.world_size, join=True
+        )
+        results = dict(results)
+
+    print(
+        f"{args.n_steps} steps of {args.batch_size} points, {args.n_clusters} clusters,"
+        f" {args.n_features} features, single process: {single_process_seconds:.2f} s"
+    )
+    for rank in range(args.world_size):
+        rank_centroids, rank_counts, seconds, gradient_update_refused = results[rank]
+        rank_centroids = torch.tensor(rank_centroids, dtype=expected_centroids.dtype)
+        rank_counts = torch.tensor(rank_counts, dtype=expected_counts.dtype)
+        assert gradient_update_refused, "The gradient update was not refused under DDP"
+        assert torch.equal(rank_counts, expected_counts), f"Counts differ on rank {rank}"
+        torch.testing.assert_close(rank_centroids, expected_centroids)
+        max_difference = (rank_centroids - expected_centroids).abs().max().item()
+        print(
+            f"  rank {rank}: same counts, centroids within {max_difference:.2e} of the"
+            f" single process codebook ({seconds:.2f} s)"
+        )
+
+
+if __name__ == "__main__":
+    main()
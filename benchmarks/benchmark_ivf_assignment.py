@@ -0,0 +1,96 @@
+"""Times IVFAssignmentDistance against the exact assignment of SquaredEuclideanDistance and
+reports its recall for several n_probe values.
+
+    python benchmarks/benchmark_ivf_assignment.py --n-points 8192 --n-centroids 16384 --n-probe 1 4 8 16 32
+
+The centroids are drawn around a few thousand means, as the codebooks of the last layers of
+residual quantization are, and the points around the centroids. The recall is the fraction
+of points assigned to the same centroid as the exact assignment. The time of the IVF
+assignment does not include building the index, which is reused over the repeats as it is
+over the calls between two rebuilds during training and inference.
+"""
+import argparse
+import time
+
+import rootutils
+import torch
+
+rootutils.setup_root(__file__, indicator=".project-root", pythonpath=True)
+
+from src.components.distance_functions import (
+    IVFAssignmentDistance,
+    SquaredEuclideanDistance,
+)
+
+
+def time_function(function, n_repeats: int) -> float:
+    """The mean time of function in milliseconds, after one warm-up call."""
+    function()
+    start_time = time.perf_counter()
+    for _ in range(n_repeats):
+        function()
+    return 1000 * (time.perf_counter() - start_time) / n_repeats
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n-points", type=int, default=8192)
+    parser.add_argument("--n-centroids", type=int, default=16384)
+    parser.add_argument("--n-features", type=int, default=64)
+    parser.add_argument("--n-means", type=int, default=2048)
+    parser.add_argument("--n-lists", type=int, default=None)
+    parser.add_argument("--n-probe", type=int, nargs="+", default=[1, 4, 8, 16, 32])
+    parser.add_argument("--n-repeats", type=int, default=5)
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    device = torch.device(args.device)
+    means = 4 * torch.randn(args.n_means, args.n_features, device=device)
+    centroids = means[torch.randint(0, args.n_means, (args.n_centroids,), device=device)]
+    centroids += torch.randn_like(centroids)
+    x = centroids[torch.randint(0, args.n_centroids, (args.n_points,), device=device)]
+    x += 0.5 * torch.randn_like(x)
+
+    distance_function = SquaredEuclideanDistance()
+    exact_ids, exact_min_distances = distance_function.assign(x, centroids)
+    exact_milliseconds = time_function(
+        lambda: distance_function.assign(x, centroids), args.n_repeats
+    )
+    print(
+        f"{args.n_points} points, {args.n_centroids} centroids, {args.n_features} features"
+        f" on {device}:\n  exact:         {exact_milliseconds:8.2f} ms per call"
+    )
+
+    for n_probe in args.n_probe:
+        ivf_distance_function = IVFAssignmentDistance(
+            distance_function, n_lists=args.n_lists, n_probe=n_probe, min_n_centroids=0
+        )
+        start_time = time.perf_counter()
+        index = ivf_distance_function.get_index(centroids)
+        build_milliseconds = 1000 * (time.perf_counter() - start_time)
+        ids, min_distances = ivf_distance_function.assign_with_index(x, centroids, index)
+        milliseconds = time_function(
+            lambda: ivf_distance_function.assign_with_index(x, centroids, index),
+            args.n_repeats,
+        )
+        recall = (ids == exact_ids).float().mean().item()
+        # the probed centroids are a subset of all centroids, so the distance can only grow
+        assert bool((min_distances >= exact_min_distances - 1e-3).all())
+        n_lists = index["coarse_centroids"].shape[0]
+        print(
+            f"  n_probe={n_probe:<4d} {milliseconds:8.2f} ms per call,"
+            f" {exact_milliseconds / milliseconds:5.2f}x, recall {recall:.4f}"
+            f" ({n_lists} lists, index built in {build_milliseconds:.0f} ms)"
+        )
+
+    # compute keeps the interface of the wrapped distance function
+    torch.testing.assert_close(
+        ivf_distance_function.compute(x, centroids, batch_size=1024),
+        distance_function.compute(x, centroids, batch_size=1024),
+    )
+
+
+if __name__ == "__main__":
+    main()
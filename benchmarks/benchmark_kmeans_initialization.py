@@ -0,0 +1,74 @@
+"""Times the k-means++ and k-means|| modes of KMeansPlusPlusInitInitializer.
+
+    python benchmarks/benchmark_kmeans_initialization.py --n-points 65536 --n-clusters 256 1024
+
+The points are drawn from a mixture of Gaussians. For each number of clusters, it reports
+the time of each mode and the inertia of the initial centroids (the sum of the squared
+distances of the points to their closest centroid), so that the speed-up of k-means|| can
+be weighed against the quality of its seeding.
+"""
+import argparse
+import time
+
+import rootutils
+import torch
+
+rootutils.setup_root(__file__, indicator=".project-root", pythonpath=True)
+
+from src.components.clustering_initializers import KMeansPlusPlusInitInitializer
+from src.components.distance_functions import SquaredEuclideanDistance
+
+
+def make_points(
+    n_points: int, n_features: int, n_components: int, seed: int
+) -> torch.Tensor:
+    """Points drawn from a mixture of n_components Gaussians with random means."""
+    generator = torch.Generator().manual_seed(seed)
+    means = 4 * torch.randn(n_components, n_features, generator=generator)
+    components = torch.randint(0, n_components, (n_points,), generator=generator)
+    return means[components] + torch.randn(n_points, n_features, generator=generator)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n-points", type=int, default=65536)
+    parser.add_argument("--n-features", type=int, default=64)
+    parser.add_argument("--n-clusters", type=int, nargs="+", default=[256, 1024])
+    parser.add_argument("--n-components", type=int, default=512)
+    parser.add_argument("--n-rounds", type=int, default=5)
+    parser.add_argument("--oversampling-factor", type=float, default=2.0)
+    parser.add_argument("--n-repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    points = make_points(args.n_points, args.n_features, args.n_components, args.seed)
+    distance_function = SquaredEuclideanDistance()
+    print(
+        f"{args.n_points} points, {args.n_features} features, {args.n_components} components"
+        f" ({torch.get_num_threads()} threads)"
+    )
+    for n_clusters in args.n_clusters:
+        print(f"{n_clusters} clusters:")
+        for mode in ("kmeans++", "kmeans||"):
+            initializer = KMeansPlusPlusInitInitializer(
+                n_clusters=n_clusters,
+                distance_function=distance_function,
+                mode=mode,
+                n_rounds=args.n_rounds,
+                oversampling_factor=args.oversampling_factor,
+                distributed=False,
+            )
+            torch.manual_seed(args.seed)
+            start_time = time.perf_counter()
+            for _ in range(args.n_repeats):
+                centroids = initializer(points)
+            milliseconds = 1000 * (time.perf_counter() - start_time) / args.n_repeats
+            _, min_distances = distance_function.assign(points, centroids)
+            print(
+                f"  {mode:<8}: {milliseconds:9.1f} ms,"
+                f" inertia {min_distances.sum(dtype=torch.float64).item():.4e}"
+            )
+
+
+if __name__ == "__main__":
+    main()
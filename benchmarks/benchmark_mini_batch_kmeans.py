@@ -0,0 +1,130 @@
+"""Times the mini-batch k-means statistics and updates of MiniBatchKMeans.
+
+    python benchmarks/benchmark_mini_batch_kmeans.py --n-clusters 256 1024 4096
+
+For each number of clusters, it checks that the per-cluster counts and sums computed with
+bincount and index_add match the one-hot matrix multiplication they replaced, and that the
+manual update gives the same centroids and loss as an SGD step on the loss. It then times
+the statistics and a full model step with both updates.
+"""
+import argparse
+import time
+
+import rootutils
+import torch
+
+rootutils.setup_root(__file__, indicator=".project-root", pythonpath=True)
+
+from src.components.clustering_initializers import KMeansPlusPlusInitInitializer
+from src.components.distance_functions import SquaredEuclideanDistance
+from src.models.modules.clustering.mini_batch_kmeans import MiniBatchKMeans
+
+
+def one_hot_statistics(
+    assignments: torch.Tensor, batch: torch.Tensor, n_clusters: int
+):
+    """The previous implementation, with a (n_clusters, batch_size) one-hot matrix."""
+    one_hot = torch.nn.functional.one_hot(assignments, n_clusters).t().to(batch.dtype)
+    return one_hot.sum(dim=1).long(), one_hot @ batch
+
+
+def time_function(function, n_repeats: int) -> float:
+    """The mean time of function in milliseconds, after one warm-up call."""
+    function()
+    start_time = time.perf_counter()
+    for _ in range(n_repeats):
+        function()
+    return 1000 * (time.perf_counter() - start_time) / n_repeats
+
+
+def build_model(
+    n_clusters: int, n_features: int, update_manually: bool, centroids: torch.Tensor
+) -> MiniBatchKMeans:
+    distance_function = SquaredEuclideanDistance()
+    model = MiniBatchKMeans(
+        n_clusters=n_clusters,
+        n_features=n_features,
+        distance_function=distance_function,
+        initializer=KMeansPlusPlusInitInitializer(
+            n_clusters=n_clusters, distance_function=distance_function
+        ),
+        update_manually=update_manually,
+    )
+    # the initialization is skipped, the centroids are set directly
+    with torch.no_grad():
+        model.centroids.copy_(centroids)
+    model.is_initialized = True
+    return model
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n-clusters", type=int, nargs="+", default=[256, 1024, 4096])
+    parser.add_argument("--n-features", type=int, default=64)
+    parser.add_argument("--batch-size", type=int, default=8192)
+    parser.add_argument("--n-repeats", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    batch = torch.randn(args.batch_size, args.n_features)
+    print(f"batch size {args.batch_size}, {args.n_features} features")
+    for n_clusters in args.n_clusters:
+        centroids = torch.randn(n_clusters, args.n_features)
+        manual_model = build_model(n_clusters, args.n_features, True, centroids)
+        gradient_model = build_model(n_clusters, args.n_features, False, centroids)
+        optimizer = torch.optim.SGD([gradient_model.centroids], lr=0.5)
+
+        # statistics
+        assignments, counts, sums = manual_model.forward(batch)
+        expected_counts, expected_sums = one_hot_statistics(
+            assignments, batch, n_clusters
+        )
+        assert torch.equal(counts, expected_counts)
+        torch.testing.assert_close(sums, expected_sums, rtol=1e-4, atol=1e-3)
+
+        # one update with each path, from the same state
+        manual_model.cluster_counts.zero_()
+        _, _, manual_loss = manual_model.model_step(batch)
+        _, _, gradient_loss = gradient_model.model_step(batch)
+        optimizer.zero_grad()
+        gradient_loss.backward()
+        optimizer.step()
+        torch.testing.assert_close(manual_loss, gradient_loss.detach())
+        torch.testing.assert_close(
+            manual_model.centroids.detach(),
+            gradient_model.centroids.detach(),
+            rtol=1e-4,
+            atol=1e-4,
+        )
+
+        def gradient_step():
+            _, _, loss = gradient_model.model_step(batch)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+
+        one_hot_milliseconds = time_function(
+            lambda: one_hot_statistics(assignments, batch, n_clusters), args.n_repeats
+        )
+        index_add_milliseconds = time_function(
+            lambda: torch.zeros(n_clusters, args.n_features).index_add(
+                0, assignments, batch
+            ),
+            args.n_repeats,
+        )
+        manual_step_milliseconds = time_function(
+            lambda: manual_model.model_step(batch), args.n_repeats
+        )
+        gradient_step_milliseconds = time_function(gradient_step, args.n_repeats)
+        print(
+            f"{n_clusters} clusters:\n"
+            f"  one-hot statistics:   {one_hot_milliseconds:.2f} ms\n"
+            f"  index_add statistics: {index_add_milliseconds:.2f} ms\n"
+            f"  manual model step:    {manual_step_milliseconds:.2f} ms\n"
+            f"  gradient model step:  {gradient_step_milliseconds:.2f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""Checks and times first_fit_decreasing against the per-sequence loop it replaced, and compares
+the encoder tokens of padded and packed batches.
+
+    python benchmarks/benchmark_sequence_packing.py --batch-size 256 --sequence-length 120 --packed-sequence-length 240
+
+The history lengths are drawn from a geometric distribution, so most histories are short and
+a few fill the whole sequence, as in the training data. The padded batch has one row of
+sequence_length tokens per history, the packed batch has rows of packed_sequence_length tokens
+holding several histories. The encoder cost grows with the number of tokens of the batch, so
+their ratio bounds the speed-up of packing on the encoder.
+"""
+import argparse
+import time
+
+import rootutils
+import torch
+
+rootutils.setup_root(__file__, indicator=".project-root", pythonpath=True)
+
+from src.data.loading.components.collate_functions import first_fit_decreasing
+
+
+def loop_first_fit_decreasing(item_lengths: torch.Tensor, bin_length: int):
+    """The previous implementation, with a scan of the bins for every item."""
+    lengths = item_lengths.tolist()
+    remaining_space_per_bin = []
+    bin_and_offset = [None] * len(lengths)
+    for item_index in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+        length = lengths[item_index]
+        for bin_index, remaining_space in enumerate(remaining_space_per_bin):
+            if remaining_space >= length:
+                break
+        else:
+            bin_index = len(remaining_space_per_bin)
+            remaining_space_per_bin.append(bin_length)
+        bin_and_offset[item_index] = (
+            bin_index,
+            bin_length - remaining_space_per_bin[bin_index],
+        )
+        remaining_space_per_bin[bin_index] -= length
+    bin_indices, offsets = zip(*bin_and_offset)
+    return torch.tensor(bin_indices), torch.tensor(offsets), len(remaining_space_per_bin)
+
+
+def make_segment_lengths(
+    batch_size: int,
+    sequence_length: int,
+    sid_hierarchy: int,
+    mean_num_items: float,
+    generator: torch.Generator,
+) -> torch.Tensor:
+    """Segment lengths of histories with a geometric number of items, trimmed to the sequence."""
+    num_items = torch.empty(batch_size).geometric_(
+        1 / mean_num_items, generator=generator
+    )
+    return (num_items.long() * sid_hierarchy).clamp(max=sequence_length)
+
+
+def time_function(function, n_repeats: int) -> float:
+    """The mean time of function in milliseconds."""
+    start_time = time.perf_counter()
+    for _ in range(n_repeats):
+        function()
+    return 1000 * (time.perf_counter() - start_time) / n_repeats
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--sequence-length", type=int, default=120)
+    parser.add_argument("--packed-sequence-length", type=int, default=240)
+    parser.add_argument("--sid-hierarchy", type=int, default=4)
+    parser.add_argument("--mean-num-items", type=float, default=8.0)
+    parser.add_argument("--n-batches", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    generator = torch.Generator().manual_seed(args.seed)
+    batches = [
+        make_segment_lengths(
+            args.batch_size,
+            args.sequence_length,
+            args.sid_hierarchy,
+            args.mean_num_items,
+            generator,
+        )
+        for _ in range(args.n_batches)
+    ]
+    num_rows = 0
+    for segment_lengths in batches:
+        bin_indices, offsets, num_bins = first_fit_decreasing(
+            segment_lengths, args.packed_sequence_length
+        )
+        expected_bin_indices, expected_offsets, expected_num_bins = (
+            loop_first_fit_decreasing(segment_lengths, args.packed_sequence_length)
+        )
+        assert num_bins == expected_num_bins
+        assert torch.equal(bin_indices, expected_bin_indices)
+        assert torch.equal(offsets, expected_offsets)
+        num_rows += num_bins
+    print(f"first_fit_decreasing matches the loop implementation on {args.n_batches} batches")
+
+    loop_milliseconds = time_function(
+        lambda: [
+            loop_first_fit_decreasing(segment_lengths, args.packed_sequence_length)
+            for segment_lengths in batches
+        ],
+        1,
+    ) / args.n_batches
+    milliseconds = time_function(
+        lambda: [
+            first_fit_decreasing(segment_lengths, args.packed_sequence_length)
+            for segment_lengths in batches
+        ],
+        1,
+    ) / args.n_batches
+    num_valid_tokens = sum(int(segment_lengths.sum()) for segment_lengths in batches)
+    num_padded_tokens = args.n_batches * args.batch_size * args.sequence_length
+    num_packed_tokens = num_rows * args.packed_sequence_length
+    print(
+        f"{args.batch_size} histories per batch, {args.mean_num_items} items on average:\n"
+        f"  loop placement:                 {loop_milliseconds:.2f} ms per batch\n"
+        f"  first_fit_decreasing placement: {milliseconds:.2f} ms per batch\n"
+        f"  padded batch: {num_padded_tokens / args.n_batches:9.0f} tokens,"
+        f" {1 - num_valid_tokens / num_padded_tokens:.1%} padding\n"
+        f"  packed batch: {num_packed_tokens / args.n_batches:9.0f} tokens,"
+        f" {1 - num_valid_tokens / num_packed_tokens:.1%} padding,"
+        f" {num_rows / args.n_batches:.1f} rows\n"
+        f"  encoder tokens padded / packed: {num_padded_tokens / num_packed_tokens:.2f}x"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""Compares the throughput of per-string and batched tokenization of item texts.
+
+    python benchmarks/benchmark_tokenization.py --tokenizer google/flan-t5-xl --batch-size 256
+
+The per-string path calls load_tokenize on every text, padded to max_length, as
+tokenize_text_features did for every text. The batched path calls load_batch_tokenize once
+per batch, padded to the longest text of the batch, as collate_fn_items does. Both use the
+same prepared tokenizer, and the non-padding token ids are checked to be the same.
+"""
+import argparse
+import random
+import time
+
+import rootutils
+import torch
+from transformers import AutoTokenizer
+
+rootutils.setup_root(__file__, indicator=".project-root", pythonpath=True)
+
+from src.data.loading.components.interfaces import TokenizerConfig
+from src.utils.utils import load_batch_tokenize, load_tokenize
+
+WORDS = (
+    "wireless bluetooth headphones noise cancelling black stainless steel water bottle "
+    "insulated kids running shoes breathable mesh organic cotton t-shirt vintage leather "
+    "wallet portable charger fast charging usb-c cable ceramic coffee mug gift set"
+).split()
+
+
+def make_texts(n_texts: int, max_words: int, seed: int):
+    """Random item titles of 1 to max_words words."""
+    generator = random.Random(seed)
+    return [
+        " ".join(generator.choices(WORDS, k=generator.randint(1, max_words)))
+        for _ in range(n_texts)
+    ]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokenizer", type=str, default="google/flan-t5-xl")
+    parser.add_argument("--n-texts", type=int, default=20000)
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--max-words", type=int, default=40)
+    parser.add_argument("--max-length", type=int, default=128)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    texts = make_texts(args.n_texts, args.max_words, args.seed)
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    per_string_config = TokenizerConfig(
+        tokenizer=tokenizer,
+        max_length=args.max_length,
+        padding="max_length",
+        truncation=True,
+    )
+    batch_config = TokenizerConfig(
+        tokenizer=tokenizer,
+        max_length=args.max_length,
+        padding="longest",
+        truncation=True,
+    )
+    tokenize = load_tokenize(per_string_config)
+    batch_tokenize = load_batch_tokenize(batch_config)
+
+    start_time = time.perf_counter()
+    per_string_outputs = [tokenize(text) for text in texts]
+    per_string_seconds = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    batch_outputs = [
+        batch_tokenize(texts[start_idx : start_idx + args.batch_size])
+        for start_idx in range(0, len(texts), args.batch_size)
+    ]
+    batch_seconds = time.perf_counter() - start_time
+
+    per_string_ids = [
+        output["input_ids"][0][output["attention_mask"][0].bool()]
+        for output in per_string_outputs
+    ]
+    batch_ids = [
+        input_ids[attention_mask.bool()]
+        for output in batch_outputs
+        for input_ids, attention_mask in zip(
+            output["input_ids"], output["attention_mask"]
+        )
+    ]
+    assert all(
+        torch.equal(ids, other_ids) for ids, other_ids in zip(per_string_ids, batch_ids)
+    ), "The batched token ids differ from the per-string token ids"
+
+    per_string_tokens = sum(output["input_ids"].numel() for output in per_string_outputs)
+    batch_tokens = sum(output["input_ids"].numel() for output in batch_outputs)
+    print(
+        f"{args.n_texts} texts of up to {args.max_words} words, {args.tokenizer}"
+        f" (fast: {tokenizer.is_fast}):\n"
+        f"  per string: {args.n_texts / per_string_seconds:10.0f} texts/s,"
+        f" {per_string_tokens} token ids with padding\n"
+        f"  batched:    {args.n_texts / batch_seconds:10.0f} texts/s,"
+        f" {batch_tokens} token ids with padding (batches of {args.batch_size})"
+    )
+
+
+if __name__ == "__main__":
+    main()
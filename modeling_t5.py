@@ -441,10 +441,26 @@ class T5Attention(nn.Module):
         relative_buckets += torch.where(is_small, relative_position, relative_position_if_large)
         return relative_buckets
 
-    def compute_bias(self, query_length, key_length, device=None, cache_position=None):
-        """Compute binned relative position bias"""
+    def compute_bias(self, query_length, key_length, device=None, cache_position=None, position_ids=None):
+        """Compute binned relative position bias
+
+        If `position_ids` of shape (batch_size, seq_length) is given, relative positions are computed per row from
+        these ids instead of from `arange`, e.g. positions that restart at 0 for every packed segment. The returned
+        bias then has shape (batch_size, num_heads, seq_length, seq_length).
+        """
         if device is None:
             device = self.relative_attention_bias.weight.device
+        if position_ids is not None:
+            position_ids = position_ids.to(device)
+            relative_position = position_ids[:, None, :] - position_ids[:, :, None]  # shape (batch_size, q_len, k_len)
+            relative_position_bucket = self._relative_position_bucket(
+                relative_position,
+                bidirectional=(not self.is_decoder),
+                num_buckets=self.relative_attention_num_buckets,
+                max_distance=self.relative_attention_max_distance,
+            )
+            values = self.relative_attention_bias(relative_position_bucket)  # shape (batch_size, q_len, k_len, num_heads)
+            return values.permute([0, 3, 1, 2])  # shape (batch_size, num_heads, q_len, k_len)
         if cache_position is None:
             context_position = torch.arange(query_length, dtype=torch.long, device=device)[:, None]
         else:
@@ -1106,6 +1122,104 @@ class T5Stack(T5PreTrainedModel):
         reduced_attention_mask = torch.gather(attention_mask, dim=1, index=sorted_topk_indices)
 
         return reduced_embeddings, reduced_attention_mask
+
+    @staticmethod
+    def _get_segment_position_ids(segment_ids: torch.Tensor) -> torch.Tensor:
+        """
+        计算打包序列中每个 token 在其所属片段内的位置 (每个片段从 0 开始计数)。
+        要求同一片段的 token 在序列中是连续的。
+
+        参数:
+            segment_ids (torch.Tensor): 形状为 (batch_size, seq_len) 的片段 id, 0 表示 padding。
+
+        返回:
+            torch.Tensor: 形状为 (batch_size, seq_len) 的片段内位置。
+        """
+        positions = torch.arange(segment_ids.size(1), device=segment_ids.device).expand_as(segment_ids)
+        # 片段的起始位置: 与前一个 token 的片段 id 不同
+        is_segment_start = torch.ones_like(segment_ids, dtype=torch.bool)
+        is_segment_start[:, 1:] = segment_ids[:, 1:] != segment_ids[:, :-1]
+        segment_start = torch.where(is_segment_start, positions, torch.zeros_like(positions)).cummax(dim=1).values
+        return positions - segment_start
+
+    @staticmethod
+    def _get_segment_attention_mask(segment_ids: torch.Tensor, dtype: torch.dtype) -> torch.Tensor:
+        """
+        根据片段 id 构造块对角的 4D 注意力掩码: 每个 token 只能关注同一片段内的非 padding token。
+
+        参数:
+            segment_ids (torch.Tensor): 形状为 (batch_size, seq_len) 的片段 id, 0 表示 padding。
+            dtype (torch.dtype): 掩码的数据类型。
+
+        返回:
+            torch.Tensor: 形状为 (batch_size, 1, seq_len, seq_len) 的加性掩码。
+        """
+        is_same_segment = segment_ids[:, :, None] == segment_ids[:, None, :]
+        is_allowed = is_same_segment & (segment_ids[:, None, :] > 0)
+        return (~is_allowed)[:, None, :, :].to(dtype) * torch.finfo(dtype).min
+
+    def _reduce_token_rastp_per_segment(self, representations: torch.Tensor, attention_mask: torch.Tensor,
+                                        attention_weights: torch.Tensor, segment_ids: torch.Tensor
+                                        ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        打包序列上的 rastp: 重要性评分与 _reduce_token_rastp 相同, 但每个片段独立保留
+        max(1, int(片段长度 * ρ)) 个重要性最高的 token, 片段之间互不抢占配额。
+
+        参数:
+            representations (torch.Tensor): 形状为 (batch_size, seq_len, hidden_dim) 的 token 表征。
+            attention_mask (torch.Tensor): 形状为 (batch_size, seq_len) 的注意力掩码。
+            attention_weights (torch.Tensor): 形状为 (batch_size, num_heads, seq_len, seq_len) 的注意力权重。
+            segment_ids (torch.Tensor): 形状为 (batch_size, seq_len) 的片段 id, 0 表示 padding。
+                片段 id 在整个 batch 内唯一。
+
+        返回:
+            tuple: (reduced_embeddings, reduced_attention_mask, reduced_segment_ids)
+                - reduced_embeddings: 形状为 (batch_size, new_seq_len, hidden_dim)。
+                - reduced_attention_mask: 形状为 (batch_size, new_seq_len)。
+                - reduced_segment_ids: 形状为 (batch_size, new_seq_len), padding 位置为 0。
+        """
+        batch_size, seq_len, hidden_dim = representations.shape
+        # --- ρ ---
+        self.reduction_factor = 1.0 / 3.0
+
+        # 1. 重要性评分 I_k^t = S_k^t * ||r_k||_1 (块对角掩码保证 S_k^t 只来自同一片段)
+        representations_l1_norm = torch.sum(torch.abs(representations), dim=-1)
+        cumulative_attention_score = torch.sum(torch.sum(attention_weights, dim=1), dim=1)
+        importance_scores = cumulative_attention_score * representations_l1_norm
+        is_valid = (segment_ids > 0) & (attention_mask > 0)
+        importance_scores = importance_scores.masked_fill(~is_valid, float('-inf'))
+
+        # 2. 每个片段的保留配额
+        segment_lengths = torch.zeros(
+            int(segment_ids.max()) + 1, dtype=torch.long, device=segment_ids.device
+        ).scatter_add_(0, segment_ids.flatten(), is_valid.long().flatten())
+        segment_quota = (segment_lengths.float() * self.reduction_factor).long().clamp(min=1)
+        token_quota = segment_quota[segment_ids]
+
+        # 3. 片段内按重要性降序排名: 先按重要性排序, 再按片段 id 做稳定排序
+        order = torch.sort(importance_scores, dim=1, descending=True, stable=True).indices
+        order = order.gather(1, torch.sort(segment_ids.gather(1, order), dim=1, stable=True).indices)
+        rank_in_order = self._get_segment_position_ids(segment_ids.gather(1, order))
+        rank = torch.empty_like(rank_in_order).scatter_(1, order, rank_in_order)
+        keep = is_valid & (rank < token_quota)
+
+        new_seq_len = max(1, int(keep.sum(dim=1).max()))
+        if new_seq_len >= seq_len:
+            return representations, attention_mask, segment_ids
+
+        # 4. 保留的 token 排在前面且保持原始顺序
+        positions = torch.arange(seq_len, device=segment_ids.device).expand_as(segment_ids)
+        kept_indices = torch.sort((~keep).long() * seq_len + positions, dim=1).indices[:, :new_seq_len]
+        kept_mask = keep.gather(1, kept_indices)
+
+        reduced_embeddings = torch.gather(
+            representations, dim=1, index=kept_indices.unsqueeze(-1).expand(-1, -1, hidden_dim)
+        )
+        reduced_attention_mask = torch.gather(attention_mask, dim=1, index=kept_indices) * kept_mask
+        reduced_segment_ids = torch.gather(segment_ids, dim=1, index=kept_indices) * kept_mask
+
+        return reduced_embeddings, reduced_attention_mask, reduced_segment_ids
+
     def forward(
         self,
         input_ids=None,
@@ -1121,11 +1235,14 @@ class T5Stack(T5PreTrainedModel):
         output_hidden_states=None,
         return_dict=None,
         cache_position=None,
+        segment_ids=None,
     ):
         # Model parallel
         if self.model_parallel:
             torch.cuda.set_device(self.first_device)
             self.embed_tokens = self.embed_tokens.to(self.first_device)
+        if segment_ids is not None and self.is_decoder:
+            raise ValueError("`segment_ids` (packed sequences) are only supported by the encoder stack")
         use_cache = use_cache if use_cache is not None else self.config.use_cache
         output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
         output_attentions = True
@@ -1209,6 +1326,9 @@ class T5Stack(T5PreTrainedModel):
                 past_key_values.self_attention_cache if past_key_values is not None else None,
                 output_attentions,
             )
+        elif segment_ids is not None:
+            # 打包模式: 块对角注意力, 每个片段只关注自身的 token
+            causal_mask = self._get_segment_attention_mask(segment_ids, inputs_embeds.dtype)
         elif attention_mask is not None:
             causal_mask = attention_mask[:, None, None, :]
             causal_mask = causal_mask.to(dtype=inputs_embeds.dtype)
@@ -1237,6 +1357,14 @@ class T5Stack(T5PreTrainedModel):
         all_cross_attentions = () if (output_attentions and self.is_decoder) else None
         position_bias = None
         encoder_decoder_position_bias = None
+        if segment_ids is not None:
+            # 打包模式: 相对位置在每个片段内重新从 0 计数, 由第一层共享给后续层
+            position_bias = self.block[0].layer[0].SelfAttention.compute_bias(
+                seq_length,
+                seq_length,
+                device=inputs_embeds.device,
+                position_ids=self._get_segment_position_ids(segment_ids),
+            ) + causal_mask
 
         hidden_states = self.dropout(inputs_embeds)
 
@@ -1326,15 +1454,25 @@ class T5Stack(T5PreTrainedModel):
                 #     hidden_states, current_attention_mask_2d
                 # )
                 attention_weights = layer_outputs[3]
-                hidden_states, current_attention_mask_2d = self._reduce_token_rastp(
-                    hidden_states, current_attention_mask_2d, attention_weights
-                )
+                if segment_ids is not None:
+                    # 打包模式: 每个片段独立剪枝
+                    hidden_states, current_attention_mask_2d, segment_ids = self._reduce_token_rastp_per_segment(
+                        hidden_states, current_attention_mask_2d, attention_weights, segment_ids
+                    )
+                else:
+                    hidden_states, current_attention_mask_2d = self._reduce_token_rastp(
+                        hidden_states, current_attention_mask_2d, attention_weights
+                    )
                 # 更新 input_shape
                 input_shape = hidden_states.size()[:-1]
-                # 重新生成 4D causal_mask (padding mask)
-                causal_mask = current_attention_mask_2d[:, None, None, :]
-                causal_mask = causal_mask.to(dtype=hidden_states.dtype)
-                causal_mask = (1.0 - causal_mask) * torch.finfo(hidden_states.dtype).min
+                if segment_ids is not None:
+                    # 重新生成块对角 4D mask
+                    causal_mask = self._get_segment_attention_mask(segment_ids, hidden_states.dtype)
+                else:
+                    # 重新生成 4D causal_mask (padding mask)
+                    causal_mask = current_attention_mask_2d[:, None, None, :]
+                    causal_mask = causal_mask.to(dtype=hidden_states.dtype)
+                    causal_mask = (1.0 - causal_mask) * torch.finfo(hidden_states.dtype).min
                 # 重置 position_bias
                 position_bias = None
                 # 重新生成 cache_position
@@ -1363,16 +1501,21 @@ class T5Stack(T5PreTrainedModel):
                     all_hidden_states,
                     all_attentions,
                     all_cross_attentions,
+                    segment_ids,
                 ]
                 if v is not None
             )
-        return BaseModelOutputWithPastAndCrossAttentions(
+        outputs = BaseModelOutputWithPastAndCrossAttentions(
             last_hidden_state=hidden_states,
             past_key_values=next_cache,
             hidden_states=all_hidden_states,
             attentions=all_attentions,
             cross_attentions=all_cross_attentions,
         )
+        if segment_ids is not None:
+            # 剪枝后的片段 id, 解码器需要据此为每个片段构造 cross-attention mask
+            outputs["segment_ids"] = segment_ids
+        return outputs
 
     # Copied from transformers.models.llama.modeling_llama.LlamaModel._update_causal_mask
     def _update_causal_mask(
@@ -2243,8 +2386,13 @@ class T5EncoderModel(T5PreTrainedModel):
         output_attentions: Optional[bool] = None,
         output_hidden_states: Optional[bool] = None,
         return_dict: Optional[bool] = None,
+        segment_ids: Optional[torch.LongTensor] = None,
     ) -> Union[Tuple[torch.FloatTensor], BaseModelOutput]:
         r"""
+        segment_ids (`torch.LongTensor` of shape `(batch_size, sequence_length)`, *optional*):
+            Ids of the packed sequence each token belongs to (0 for padding). When given, attention is restricted to
+            tokens of the same segment and relative positions restart for every segment.
+
         Returns:
 
         Example:
@@ -2270,6 +2418,7 @@ class T5EncoderModel(T5PreTrainedModel):
             output_attentions=output_attentions,
             output_hidden_states=output_hidden_states,
             return_dict=return_dict,
+            segment_ids=segment_ids,
         )
 
         return encoder_outputs
@@ -1,7 +1,9 @@
 from abc import abstractmethod
 from functools import partial
+from typing import Optional
 
 import torch
+import torch.distributed as dist
 import torch.nn as nn
 from pytorch_lightning import LightningModule
 
@@ -29,6 +31,13 @@ class ClusteringInitializer(nn.Module):
         self.n_clusters = n_clusters
         self.initialize_on_cpu = initialize_on_cpu
 
+    def is_distributed(self) -> bool:
+        """
+        Whether the initializer is called on every rank with the buffer of that rank, and
+        returns the same centroids on every rank. Otherwise, it is only called on rank zero.
+        """
+        return False
+
     @abstractmethod
     def forward(self, buffer: torch.Tensor) -> torch.Tensor:
         """
@@ -86,6 +95,17 @@ class KMeansPlusPlusInitInitializer(ClusteringInitializer):
     This class provides a method to initialize centroids using the k-means++
     algorithm, which is a smarter way to choose the initial centroids for k-means
     clustering. It helps in faster convergence and better clustering results.
+
+    With mode="kmeans||", it uses scalable k-means++ (Bahmani et al. 2012) instead: a few
+    rounds sample many candidates at once, and k-means++ then picks the centroids among the
+    candidates weighted by the number of points closest to them. This replaces the
+    n_clusters sequential passes over the buffer by n_rounds passes.
+
+    With distributed=True and DDP, the buffers of all ranks are used: each rank keeps the
+    distances of its own buffer, only the sums of the distances and the chosen points are
+    exchanged, and every rank returns the same centroids.
+
+    Paper reference: https://arxiv.org/abs/1203.6402
     """
 
     def __init__(
@@ -93,6 +113,10 @@ class KMeansPlusPlusInitInitializer(ClusteringInitializer):
         n_clusters: int,
         distance_function: DistanceFunction,
         initialize_on_cpu: bool = True,
+        mode: str = "kmeans++",
+        n_rounds: int = 5,
+        oversampling_factor: float = 2.0,
+        distributed: bool = True,
     ):
         """
         Initializes the KMeansPlusPlusInitInitializer class with the specified parameters.
@@ -101,61 +125,240 @@ class KMeansPlusPlusInitInitializer(ClusteringInitializer):
             distance_function: Function to compute distances between points.
             initialize_on_cpu: Whether to move the tensors to the CPU for computing the
                 initialization.
+            mode: "kmeans++" or "kmeans||".
+            n_rounds: Number of sampling rounds of k-means||.
+            oversampling_factor: Expected number of candidates sampled per round of
+                k-means||, as a multiple of n_clusters.
+            distributed: Whether to use the buffers of all ranks when training with DDP.
         """
         super().__init__(n_clusters=n_clusters, initialize_on_cpu=initialize_on_cpu)
+        if mode not in ("kmeans++", "kmeans||"):
+            raise ValueError(f"mode must be 'kmeans++' or 'kmeans||', got {mode}")
         self.distance_function = distance_function
+        self.mode = mode
+        self.n_rounds = n_rounds
+        self.oversampling_factor = oversampling_factor
+        self.distributed = distributed
+        # the device of the collectives, the buffer may be moved to the CPU
+        self.communication_device = None
+
+    def is_distributed(self) -> bool:
+        return (
+            self.distributed
+            and dist.is_available()
+            and dist.is_initialized()
+            and dist.get_world_size() > 1
+        )
 
-    def forward(self, buffer: torch.Tensor) -> torch.Tensor:
+    def _all_gather(self, tensor: torch.Tensor) -> torch.Tensor:
+        """Concatenate the tensors of all ranks, which may differ in their first dimension."""
+        device = tensor.device
+        tensor = tensor.to(self.communication_device)
+        world_size = dist.get_world_size()
+        size = torch.tensor([tensor.shape[0]], device=tensor.device)
+        sizes = [torch.zeros_like(size) for _ in range(world_size)]
+        dist.all_gather(sizes, size)
+        max_size = int(max(sizes))
+        padded_tensor = torch.zeros(
+            (max_size, *tensor.shape[1:]), dtype=tensor.dtype, device=tensor.device
+        )
+        padded_tensor[: tensor.shape[0]] = tensor
+        gathered = [torch.zeros_like(padded_tensor) for _ in range(world_size)]
+        dist.all_gather(gathered, padded_tensor)
+        return torch.cat(
+            [rank_tensor[: int(rank_size)] for rank_tensor, rank_size in zip(gathered, sizes)]
+        ).to(device)
+
+    def _all_reduce_sum(self, tensor: torch.Tensor) -> torch.Tensor:
+        device = tensor.device
+        tensor = tensor.to(self.communication_device)
+        dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+        return tensor.to(device)
+
+    def _broadcast(self, tensor: torch.Tensor, src: int) -> torch.Tensor:
+        device = tensor.device
+        tensor = tensor.to(self.communication_device).contiguous()
+        dist.broadcast(tensor, src=src)
+        return tensor.to(device)
+
+    def _distributed_kmeans_plus_plus(self, buffer: torch.Tensor) -> torch.Tensor:
         """
-        Initialize centroids using k-means++ algorithm for better convergence.
-        The k-means++ algorithm iteratively samples the next initial centroid by
-        sampling points with probability proportional to their distance to the nearest
-        existing centroid.
+        Choose n_clusters centroids with k-means++ over the buffers of all ranks. Each step
+        samples the rank of the next centroid from the sums of the distances of each rank,
+        with a generator shared by all ranks, and that rank samples and broadcasts the point.
         Args:
-            buffer: Data points of shape (batch_size, n_features)
+            buffer: Data points of this rank of shape (batch_size, n_features)
         Returns:
-            Initialized centroids of shape (n_clusters, n_features)
+            Centroids of shape (n_clusters, n_features), the same on every rank
         """
-        if self.initialize_on_cpu:
-            old_device = buffer.device
-            # Move the buffer to CPU for initialization
-            buffer = buffer.to("cpu")
+        rank = dist.get_rank()
+        seed = self._broadcast(torch.randint(0, 2**31 - 1, (1,)), src=0)
+        generator = torch.Generator().manual_seed(int(seed))
+        centroids = torch.zeros(
+            (self.n_clusters, buffer.shape[1]), dtype=buffer.dtype, device=buffer.device
+        )
+        uniform_weights = torch.ones(buffer.shape[0], device=buffer.device)
+        min_distances = None
+        for i in range(self.n_clusters):
+            sampling_weights = uniform_weights if i == 0 else min_distances.float()
+            rank_totals = self._all_gather(sampling_weights.sum().reshape(1)).cpu()
+            if rank_totals.sum() == 0:
+                # All points are already centroids, so we sample the next one randomly
+                sampling_weights = uniform_weights
+                rank_totals = self._all_gather(sampling_weights.sum().reshape(1)).cpu()
+            owner = int(torch.multinomial(rank_totals, num_samples=1, generator=generator))
+            point = torch.zeros_like(centroids[:1])
+            if rank == owner:
+                point = buffer[torch.multinomial(sampling_weights, num_samples=1)]
+            centroids[i : i + 1] = self._broadcast(point, src=owner)
+            # Only the distances to the new centroid need to be computed
+            new_distances = self.distance_function.compute(
+                buffer, centroids[i : i + 1]
+            ).squeeze(1)
+            min_distances = (
+                new_distances
+                if min_distances is None
+                else torch.minimum(min_distances, new_distances)
+            )
+        return centroids
 
-        n_samples = buffer.shape[0]
-        n_features = buffer.shape[1]
+    def _kmeans_plus_plus(
+        self, points: torch.Tensor, weights: Optional[torch.Tensor] = None
+    ) -> torch.Tensor:
+        """
+        Choose n_clusters centroids among points with k-means++. The distance of each point
+        to its nearest centroid is kept up to date, so each new centroid only costs the
+        distances of the points to it.
+        Args:
+            points: Candidate points of shape (n_points, n_features)
+            weights: Optional weights of the points of shape (n_points,)
+        Returns:
+            Centroids of shape (n_clusters, n_features)
+        """
+        n_samples = points.shape[0]
         centroids = torch.zeros(
-            (self.n_clusters, n_features), dtype=buffer.dtype, device=buffer.device
+            (self.n_clusters, points.shape[1]), dtype=points.dtype, device=points.device
         )
 
         # Choose first centroid randomly
-        first_centroid_idx = torch.randint(0, n_samples, (1,), device=buffer.device)
-        centroids[0] = buffer[first_centroid_idx]
+        if weights is None:
+            first_centroid_idx = torch.randint(0, n_samples, (1,), device=points.device)
+        else:
+            first_centroid_idx = torch.multinomial(weights, num_samples=1)
+        centroids[0] = points[first_centroid_idx]
+        min_distances = self.distance_function.compute(points, centroids[:1]).squeeze(1)
 
         # Choose remaining centroids
         # We cannot vectorize this part because it is inherently sequential
         # However, we only need to execute this loop once at initialization
         for i in range(1, self.n_clusters):
-            # Compute distances to the nearest existing centroid
-            min_distances = torch.min(
-                self.distance_function.compute(buffer, centroids[:i]), dim=1
-            )[0]
-            if min_distances.sum() == 0:
+            sampling_weights = (
+                min_distances if weights is None else min_distances * weights
+            )
+            if sampling_weights.sum() == 0:
                 # All points are already centroids, so we simply assign the remaining
                 # centroids randomly
-                centroids[i:] = buffer[
+                centroids[i:] = points[
                     torch.randint(
-                        0, n_samples, (self.n_clusters - i,), device=buffer.device
+                        0, n_samples, (self.n_clusters - i,), device=points.device
                     )
                 ]
                 break
 
             # Choose the next centroid with probability proportional to distance
-            next_centroid_idx = torch.multinomial(min_distances, num_samples=1)
+            next_centroid_idx = torch.multinomial(sampling_weights.float(), num_samples=1)
 
             # Assign the next centroid
-            # We do not need to remove the point from buffer because the probability
-            # will be zero for all future iterations
-            centroids[i] = buffer[next_centroid_idx]
+            # We do not need to remove the point from the candidates because the
+            # probability will be zero for all future iterations
+            centroids[i] = points[next_centroid_idx]
+            # Only the distances to the new centroid need to be computed
+            min_distances = torch.minimum(
+                min_distances,
+                self.distance_function.compute(points, centroids[i : i + 1]).squeeze(1),
+            )
+
+        return centroids
+
+    def _kmeans_parallel(self, buffer: torch.Tensor) -> torch.Tensor:
+        """
+        Choose n_clusters centroids with k-means||.
+        Args:
+            buffer: Data points of shape (batch_size, n_features)
+        Returns:
+            Centroids of shape (n_clusters, n_features)
+        """
+        is_distributed = self.is_distributed()
+        n_samples = buffer.shape[0]
+        candidates = buffer[torch.randint(0, n_samples, (1,), device=buffer.device)]
+        if is_distributed:
+            # the first candidate is the one of rank zero
+            candidates = self._broadcast(candidates, src=0)
+        min_distances = self.distance_function.compute(buffer, candidates).squeeze(1)
+        expected_candidates_per_round = self.oversampling_factor * self.n_clusters
+        for _ in range(self.n_rounds):
+            cost = min_distances.sum()
+            if is_distributed:
+                cost = self._all_reduce_sum(cost)
+            if cost == 0:
+                break
+            # each point is sampled independently, proportionally to its distance
+            sampling_probabilities = (
+                expected_candidates_per_round * min_distances / cost
+            ).clamp(max=1)
+            is_sampled = torch.rand_like(sampling_probabilities) < sampling_probabilities
+            new_candidates = buffer[is_sampled]
+            if is_distributed:
+                # every rank gets the candidates of all ranks
+                new_candidates = self._all_gather(new_candidates)
+            if new_candidates.shape[0] == 0:
+                continue
+            candidates = torch.cat([candidates, new_candidates], dim=0)
+            _, new_min_distances = self.distance_function.assign(buffer, new_candidates)
+            min_distances = torch.minimum(min_distances, new_min_distances)
+
+        if candidates.shape[0] <= self.n_clusters:
+            # too few candidates (e.g. many duplicated points), we use all the buffer
+            if is_distributed:
+                return self._distributed_kmeans_plus_plus(buffer)
+            return self._kmeans_plus_plus(buffer)
+        # each candidate is weighted by the number of points closest to it
+        assignments, _ = self.distance_function.assign(buffer, candidates)
+        weights = torch.bincount(assignments, minlength=candidates.shape[0]).float()
+        if not is_distributed:
+            return self._kmeans_plus_plus(candidates, weights=weights)
+        weights = self._all_reduce_sum(weights)
+        # the candidates are the same on every rank, rank zero chooses the centroids
+        centroids = torch.zeros(
+            (self.n_clusters, buffer.shape[1]), dtype=buffer.dtype, device=buffer.device
+        )
+        if dist.get_rank() == 0:
+            centroids = self._kmeans_plus_plus(candidates, weights=weights)
+        return self._broadcast(centroids, src=0)
+
+    def forward(self, buffer: torch.Tensor) -> torch.Tensor:
+        """
+        Initialize centroids using k-means++ algorithm for better convergence.
+        The k-means++ algorithm iteratively samples the next initial centroid by
+        sampling points with probability proportional to their distance to the nearest
+        existing centroid.
+        Args:
+            buffer: Data points of shape (batch_size, n_features)
+        Returns:
+            Initialized centroids of shape (n_clusters, n_features)
+        """
+        self.communication_device = buffer.device
+        if self.initialize_on_cpu:
+            old_device = buffer.device
+            # Move the buffer to CPU for initialization
+            buffer = buffer.to("cpu")
+
+        if self.mode == "kmeans||":
+            centroids = self._kmeans_parallel(buffer)
+        elif self.is_distributed():
+            centroids = self._distributed_kmeans_plus_plus(buffer)
+        else:
+            centroids = self._kmeans_plus_plus(buffer)
 
         if self.initialize_on_cpu:
             # Move the centroids back to the original device
@@ -1,7 +1,14 @@
+import time
 from abc import ABC, abstractmethod
-from typing import Optional
+from collections import OrderedDict
+from typing import Optional, Tuple
+
 import torch
 
+from src.utils.pylogger import RankedLogger
+
+command_line_logger = RankedLogger(__name__)
+
 
 class DistanceFunction(ABC):
     @abstractmethod
@@ -18,20 +25,112 @@ class DistanceFunction(ABC):
         """
         pass
 
+    def get_assign_tile_size(self, n1: int, element_size: int) -> int:
+        """The number of centroids compared to the points at a time in assign."""
+        return 1024
+
+    def compute_tile(
+        self, x: torch.Tensor, y: torch.Tensor, start_idx: int, end_idx: int
+    ) -> torch.Tensor:
+        """
+        Compute distances between the rows of x and the rows start_idx to end_idx of y.
+
+        Args:
+            x: Data points of shape (n1, d)
+            y: Centroids of shape (n2, d)
+            start_idx: The first centroid of the tile.
+            end_idx: The end (excluded) of the tile.
+
+        Returns:
+            Distances of shape (n1, end_idx - start_idx)
+        """
+        return self.compute(x, y[start_idx:end_idx])
+
+    def assign(
+        self, x: torch.Tensor, y: torch.Tensor, tile_size: Optional[int] = None
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Assign each row of x to its nearest row of y. The distances are computed over tiles
+        of rows of y while keeping the running minimum, so the peak memory is
+        O(n1 x tile_size) instead of O(n1 x n2).
+
+        Args:
+            x: Data points of shape (n1, d)
+            y: Centroids of shape (n2, d)
+            tile_size: Optional. The number of rows of y to process at a time.
+                       If None, it is chosen by get_assign_tile_size.
+
+        Returns:
+            Tuple of the index of the nearest centroid of each point, of shape (n1,), and
+            the distance to it, of shape (n1,). Ties go to the smallest index, as with argmin.
+        """
+        n1 = x.size(0)
+        n2 = y.size(0)
+        assert n2 > 0, "There must be at least one centroid"
+        if tile_size is None:
+            tile_size = self.get_assign_tile_size(n1, x.element_size())
+
+        ids, min_distances = None, None
+        for start_idx in range(0, n2, tile_size):
+            end_idx = min(start_idx + tile_size, n2)
+            tile_min_distances, tile_ids = self.compute_tile(
+                x, y, start_idx, end_idx
+            ).min(dim=1)
+            if min_distances is None:
+                ids, min_distances = tile_ids, tile_min_distances
+                continue
+            # strictly closer, so ties keep the smallest index
+            is_closer = tile_min_distances < min_distances
+            ids = torch.where(is_closer, tile_ids + start_idx, ids)
+            min_distances = torch.where(is_closer, tile_min_distances, min_distances)
+        return ids, min_distances
+
 
 class SquaredEuclideanDistance(DistanceFunction):
+    def __init__(self, max_chunk_size_in_bytes: int = 256 * 2**20):
+        """
+        Squared Euclidean distance computed as ||x||^2 - 2 x y^T + ||y||^2, so the distances
+        of a chunk of rows of x take a single matrix multiplication.
+
+        Args:
+            max_chunk_size_in_bytes: The maximum size of the distances computed at a time,
+                used to choose the number of rows of x per chunk when batch_size is None.
+        """
+        self.max_chunk_size_in_bytes = max_chunk_size_in_bytes
+
+    def get_chunk_size(self, n2: int, element_size: int) -> int:
+        """The number of rows of x whose distances fit in max_chunk_size_in_bytes."""
+        return max(1, self.max_chunk_size_in_bytes // max(1, n2 * element_size))
+
+    def get_assign_tile_size(self, n1: int, element_size: int) -> int:
+        """The number of centroids whose distances to all of x fit in max_chunk_size_in_bytes."""
+        return self.get_chunk_size(n1, element_size)
+
+    def compute_tile(
+        self, x: torch.Tensor, y: torch.Tensor, start_idx: int, end_idx: int
+    ) -> torch.Tensor:
+        # each tile of y is used once per assign, so the squared norms of all the
+        # centroids are computed once per call, O(n2 x d) next to the O(n1 x n2 x d) GEMMs
+        y_tile = y[start_idx:end_idx]
+        return torch.addmm(
+            x.pow(2).sum(dim=1, keepdim=True) + y_tile.pow(2).sum(dim=1).unsqueeze(0),
+            x,
+            y_tile.t(),
+            alpha=-2,
+        ).clamp_min(0)
+
     def compute(
-        self, x: torch.Tensor, y: torch.Tensor, batch_size: int = 256
+        self, x: torch.Tensor, y: torch.Tensor, batch_size: Optional[int] = None
     ) -> torch.Tensor:
         """
         Compute squared Euclidean distances between the rows of x and the rows of y,
-        with optional batching along the x-axis to manage memory.
+        in chunks of rows of x to bound the memory of the intermediate results.
 
         Args:
             x: Data points of shape (n1, d)
             y: Centroids of shape (n2, d)
             batch_size: Optional. The number of rows from x to process at a time.
-                        If None, no batching is performed (original behavior).
+                        If None, it is chosen from max_chunk_size_in_bytes.
 
         Returns:
             Squared distances of shape (n1, n2)
@@ -43,43 +142,288 @@ class SquaredEuclideanDistance(DistanceFunction):
         assert y.dim() == 2, f"Data must be 2D, got {y.dim()} dimensions"
         assert x.size(1) == y.size(1), f"Data must have the same number of columns"
 
-        n1, d = x.shape
+        n1, _ = x.shape
         n2, _ = y.shape
+        if batch_size is None:
+            batch_size = self.get_chunk_size(n2, x.element_size())
+
+        y_squared_norms = y.pow(2).sum(dim=1).unsqueeze(0)  # Shape (1, n2)
+        y_transposed = y.t()
+        all_sq_distances = []
+        # an empty x still gives one (empty) chunk
+        for start_idx in range(0, max(n1, 1), batch_size):
+            x_batch = x[start_idx : start_idx + batch_size]
+            x_squared_norms = x_batch.pow(2).sum(dim=1, keepdim=True)  # Shape (b, 1)
+            # ||x||^2 + ||y||^2 - 2 x y^T in a single fused matrix multiplication
+            sq_distances_batch = torch.addmm(
+                x_squared_norms + y_squared_norms, x_batch, y_transposed, alpha=-2
+            )
+            # the expansion can be slightly negative due to rounding errors
+            all_sq_distances.append(sq_distances_batch.clamp_min(0))
+
+        if len(all_sq_distances) == 1:
+            return all_sq_distances[0]
+        return torch.cat(all_sq_distances, dim=0)
+
+
+class IVFAssignmentDistance(DistanceFunction):
+    def __init__(
+        self,
+        distance_function: DistanceFunction,
+        n_lists: Optional[int] = None,
+        n_probe: int = 8,
+        min_n_centroids: int = 4096,
+        rebuild_every_n_calls: int = 100,
+        max_relative_drift: float = 0.1,
+        check_drift_every_n_calls: int = 10,
+        n_build_iterations: int = 10,
+        log_every_n_calls: int = 0,
+        max_cached_indices: int = 4,
+    ):
+        """
+        Approximate nearest-centroid assignment for large codebooks with an inverted file
+        (IVF) index over the centroids, wrapping an exact distance function.
+
+        The centroids are clustered into n_lists coarse lists with a few Lloyd iterations.
+        assign compares each point to the coarse centroids, and then only to the centroids
+        of its n_probe nearest lists. The distances themselves are computed by the wrapped
+        distance function, which is also used for compute, so only assign is approximate.
+
+        The index is built for each centroids tensor, and rebuilt as the centroids move:
+        every rebuild_every_n_calls calls, or when the centroids moved by more than
+        max_relative_drift of their norm since the last build, which is checked every
+        check_drift_every_n_calls calls. A stale index only lowers the recall, since the
+        distances to the probed centroids are always exact, and the points whose probed
+        lists are all empty are assigned exactly.
+
+        Args:
+            distance_function: The exact distance function.
+            n_lists: Number of coarse lists. If None, the square root of the number of
+                centroids is used.
+            n_probe: Number of lists searched for each point. This trades the recall
+                against the exact assignment, which is reached with n_probe = n_lists,
+                for speed.
+            min_n_centroids: Codebooks with fewer centroids are assigned exactly.
+            rebuild_every_n_calls: Number of calls to assign after which the index of
+                centroids that are updated in place is rebuilt.
+            max_relative_drift: Relative Frobenius norm of the change of the centroids
+                since the last build above which the index is rebuilt.
+            check_drift_every_n_calls: Number of calls to assign between two checks of
+                the drift of the centroids, which synchronize with the device.
+            n_build_iterations: Number of Lloyd iterations to cluster the centroids.
+            log_every_n_calls: If positive, every log_every_n_calls calls to assign, the
+                mean time per call and the recall of the last batch against the exact
+                assignment are logged. The timing synchronizes CUDA at each call.
+            max_cached_indices: Number of centroids tensors whose indices are kept.
+        """
+        self.distance_function = distance_function
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.min_n_centroids = min_n_centroids
+        self.rebuild_every_n_calls = rebuild_every_n_calls
+        self.max_relative_drift = max_relative_drift
+        self.check_drift_every_n_calls = check_drift_every_n_calls
+        self.n_build_iterations = n_build_iterations
+        self.log_every_n_calls = log_every_n_calls
+        self.max_cached_indices = max_cached_indices
+        # the indices of the last centroids tensors, by storage, shape, dtype and device
+        self._indices = OrderedDict()
+        self._n_timed_calls = 0
+        self._total_assign_seconds = 0.0
+
+    def compute(
+        self, x: torch.Tensor, y: torch.Tensor, batch_size: Optional[int] = None
+    ) -> torch.Tensor:
+        if batch_size is None:
+            return self.distance_function.compute(x, y)
+        return self.distance_function.compute(x, y, batch_size=batch_size)
+
+    def get_assign_tile_size(self, n1: int, element_size: int) -> int:
+        return self.distance_function.get_assign_tile_size(n1, element_size)
+
+    def compute_tile(
+        self, x: torch.Tensor, y: torch.Tensor, start_idx: int, end_idx: int
+    ) -> torch.Tensor:
+        return self.distance_function.compute_tile(x, y, start_idx, end_idx)
+
+    @torch.no_grad()
+    def build_index(self, y: torch.Tensor) -> dict:
+        """
+        Cluster the centroids into coarse lists.
+
+        Args:
+            y: Centroids of shape (n2, d)
+
+        Returns:
+            The index: the coarse centroids of shape (n_lists, d), the ids of the centroids
+            sorted by list of shape (n2,), the start of each list in them, and the centroids
+            at the time of the build.
+        """
+        y = y.detach()
+        n2 = y.shape[0]
+        n_lists = self.n_lists or max(1, int(round(n2**0.5)))
+        n_lists = min(n_lists, n2)
+        coarse_centroids = y[torch.randperm(n2, device=y.device)[:n_lists]].float()
+        for _ in range(self.n_build_iterations):
+            list_ids, _ = self.distance_function.assign(y.float(), coarse_centroids)
+            counts = torch.bincount(list_ids, minlength=n_lists)
+            sums = torch.zeros_like(coarse_centroids).index_add_(0, list_ids, y.float())
+            # empty lists keep their coarse centroid
+            mask = counts != 0
+            coarse_centroids[mask] = sums[mask] / counts[mask].unsqueeze(1)
+        list_ids, _ = self.distance_function.assign(y.float(), coarse_centroids)
+
+        # the centroids of each list are contiguous once sorted by list
+        sorted_centroid_ids = torch.argsort(list_ids, stable=True)
+        list_ends = torch.cumsum(torch.bincount(list_ids, minlength=n_lists), dim=0)
+        list_ends = list_ends.tolist()
+        return {
+            "coarse_centroids": coarse_centroids.to(y.dtype),
+            "sorted_centroid_ids": sorted_centroid_ids,
+            "list_bounds": list(zip([0] + list_ends[:-1], list_ends)),
+            "built_centroids": y.clone(),
+            "n_calls": 0,
+        }
+
+    def get_index(self, y: torch.Tensor) -> dict:
+        """Get the index of the centroids y, building or rebuilding it if needed."""
+        key = (y.data_ptr(), y.shape, y.dtype, y.device)
+        index = self._indices.get(key)
+        if index is not None:
+            index["n_calls"] += 1
+            is_stale = index["n_calls"] >= self.rebuild_every_n_calls
+            if not is_stale and index["n_calls"] % self.check_drift_every_n_calls == 0:
+                built_centroids = index["built_centroids"]
+                drift = torch.linalg.matrix_norm(y.detach() - built_centroids)
+                is_stale = bool(
+                    drift
+                    > self.max_relative_drift * torch.linalg.matrix_norm(built_centroids)
+                )
+            if not is_stale:
+                self._indices.move_to_end(key)
+                return index
+        index = self.build_index(y)
+        self._indices[key] = index
+        self._indices.move_to_end(key)
+        while len(self._indices) > self.max_cached_indices:
+            self._indices.popitem(last=False)
+        return index
+
+    @torch.no_grad()
+    def assign_with_index(
+        self, x: torch.Tensor, y: torch.Tensor, index: dict
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Assign each row of x to its nearest row of y among the centroids of its n_probe
+        nearest lists.
+
+        Args:
+            x: Data points of shape (n1, d)
+            y: Centroids of shape (n2, d)
+            index: The index of y, from get_index.
+
+        Returns:
+            Tuple of the index of the nearest probed centroid of each point, of shape (n1,),
+            and the distance to it, of shape (n1,).
+        """
+        n1 = x.shape[0]
+        coarse_centroids = index["coarse_centroids"]
+        n_probe = min(self.n_probe, coarse_centroids.shape[0])
+        coarse_distances = self.distance_function.compute(x, coarse_centroids)
+        probed_lists = coarse_distances.topk(n_probe, dim=1, largest=False).indices
+
+        # the (point, list) pairs grouped by list, so each list is searched with a single
+        # distance computation between the points that probe it and its centroids
+        flat_lists = probed_lists.reshape(-1)
+        order = torch.argsort(flat_lists, stable=True)
+        point_ids = order // n_probe
+        pairs_per_list = torch.bincount(
+            flat_lists, minlength=coarse_centroids.shape[0]
+        ).tolist()
+        # gathered once per call, so that the centroids of a list are a contiguous tile
+        sorted_centroid_ids = index["sorted_centroid_ids"]
+        sorted_y = y.detach()[sorted_centroid_ids]
+
+        ids = torch.zeros(n1, dtype=torch.long, device=x.device)
+        min_distances = torch.full(
+            (n1,), float("inf"), dtype=coarse_distances.dtype, device=x.device
+        )
+        start_idx = 0
+        for n_pairs, (list_start, list_end) in zip(pairs_per_list, index["list_bounds"]):
+            if n_pairs == 0:
+                continue
+            list_point_ids = point_ids[start_idx : start_idx + n_pairs]
+            start_idx += n_pairs
+            if list_start == list_end:
+                continue
+            list_min_distances, list_ids = self.distance_function.compute_tile(
+                x[list_point_ids], sorted_y, list_start, list_end
+            ).min(dim=1)
+            # each point probes a list at most once, so the indexed updates do not collide
+            is_closer = list_min_distances < min_distances[list_point_ids]
+            closer_point_ids = list_point_ids[is_closer]
+            min_distances[closer_point_ids] = list_min_distances[is_closer]
+            ids[closer_point_ids] = sorted_centroid_ids[
+                list_ids[is_closer] + list_start
+            ]
+
+        # the points whose probed lists are all empty are assigned exactly
+        unassigned_point_ids = torch.isinf(min_distances).nonzero().squeeze(1)
+        if unassigned_point_ids.numel() > 0:
+            unassigned_ids, unassigned_min_distances = self.distance_function.assign(
+                x[unassigned_point_ids], y.detach()
+            )
+            ids[unassigned_point_ids] = unassigned_ids
+            min_distances[unassigned_point_ids] = unassigned_min_distances
+        return ids, min_distances
+
+    def assign(
+        self, x: torch.Tensor, y: torch.Tensor, tile_size: Optional[int] = None
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Assign each row of x to its nearest row of y, approximately with the IVF index if
+        y has at least min_n_centroids rows, exactly otherwise. The approximate distances
+        do not carry gradients.
+
+        Args:
+            x: Data points of shape (n1, d)
+            y: Centroids of shape (n2, d)
+            tile_size: Optional. Used by the exact assignment.
+
+        Returns:
+            Tuple of the index of the nearest centroid of each point, of shape (n1,), and
+            the distance to it, of shape (n1,).
+        """
+        if y.shape[0] < self.min_n_centroids or x.shape[0] == 0:
+            return self.distance_function.assign(x, y, tile_size=tile_size)
+
+        should_log = self.log_every_n_calls > 0
+        if should_log:
+            if x.is_cuda:
+                torch.cuda.synchronize(x.device)
+            start_time = time.perf_counter()
+        ids, min_distances = self.assign_with_index(x, y, self.get_index(y))
+        if not should_log:
+            return ids, min_distances
+
+        if x.is_cuda:
+            torch.cuda.synchronize(x.device)
+        self._total_assign_seconds += time.perf_counter() - start_time
+        self._n_timed_calls += 1
+        if self._n_timed_calls % self.log_every_n_calls == 0:
+            with torch.no_grad():
+                exact_ids, _ = self.distance_function.assign(x, y, tile_size=tile_size)
+            recall = (exact_ids == ids).float().mean().item()
+            mean_milliseconds = 1000 * self._total_assign_seconds / self._n_timed_calls
+            command_line_logger.info(
+                f"IVF assignment of {x.shape[0]} points to {y.shape[0]} centroids with"
+                f" n_probe={self.n_probe}: {mean_milliseconds:.3f} ms per call over the"
+                f" last {self._n_timed_calls} calls, recall {recall:.4f} on the last batch"
+            )
+            self._total_assign_seconds = 0.0
+            self._n_timed_calls = 0
+        return ids, min_distances
 
-        if batch_size is None or batch_size >= n1:
-            # No batching needed or batch_size is larger than n1, compute directly
-            x_expanded = x.unsqueeze(1)  # Shape (n1, 1, d)
-            y_expanded = y.unsqueeze(0)  # Shape (1, n2, d)
-            sq_diffs = (x_expanded - y_expanded).pow(2)  # Shape (n1, n2, d)
-            sq_distances = torch.sum(sq_diffs, dim=2)  # Shape (n1, n2)
-            return sq_distances
-        else:
-            # Perform batching
-            all_sq_distances = []
-            num_batches = (n1 + batch_size - 1) // batch_size  # Ceiling division
-
-            for i in range(num_batches):
-                start_idx = i * batch_size
-                end_idx = min((i + 1) * batch_size, n1)
-                x_batch = x[start_idx:end_idx]  # Shape (current_batch_size, d)
-
-                # Expand and compute for the current batch
-                x_batch_expanded = x_batch.unsqueeze(
-                    1
-                )  # Shape (current_batch_size, 1, d)
-                y_expanded = y.unsqueeze(0)  # Shape (1, n2, d) - y remains the same
-
-                sq_diffs_batch = (x_batch_expanded - y_expanded).pow(
-                    2
-                )  # Shape (current_batch_size, n2, d)
-                sq_distances_batch = torch.sum(
-                    sq_diffs_batch, dim=2
-                )  # Shape (current_batch_size, n2)
-
-                all_sq_distances.append(sq_distances_batch)
-
-            # Concatenate the results from all batches
-            return torch.cat(all_sq_distances, dim=0)
 
 class WeightedSquaredError(torch.nn.Module):
     def __init__(self):
@@ -42,8 +42,7 @@ class QuantizationStrategy(ABC):
         Get the nearest neighbors of the batch in the codebook.
         This is used for the STE and rotation trick quantization strategies.
         """
-        dists = self.distance_function.compute(batch, codebook)
-        ids = torch.argmin(dists, dim=-1)
+        ids, _ = self.distance_function.assign(batch, codebook)
         return ids, codebook[ids]
 
     @abstractmethod
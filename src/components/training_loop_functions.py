@@ -66,6 +66,19 @@ def scale_loss_by_world_size_for_initialization_training_loop(
         world_size: The number of GPUs used for training.
         is_initialized: A boolean indicating whether the model is already initialized.
     """
+    if not loss.requires_grad:
+        # The model was updated without gradients, e.g. k-means layers updated manually, so
+        # there is nothing for the optimizer to do. Stepping it anyway would still advance
+        # the state of a stateful optimizer, so only the step counter that the optimizer
+        # step advances in manual optimization (the global step) is advanced here. As with
+        # the initialization optimizer, the initialization steps are not counted.
+        if is_initialized:
+            optim_step_progress = (
+                model.trainer.fit_loop.epoch_loop.manual_optimization.optim_step_progress
+            )
+            optim_step_progress.increment_ready()
+            optim_step_progress.increment_completed()
+        return
     if not is_initialized:
         # Perform special initialization
         # We scale the loss by the world size for proper initialization
@@ -1,15 +1,21 @@
-from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+import time
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple, Union
 
+import numpy as np
 import torch
 from torch.nn.utils.rnn import pad_sequence
+from torch.utils.data import get_worker_info
 
 from src.data.loading.components.interfaces import (
     LabelFunctionOutput,
+    RaggedSequenceData,
     SequentialModelInputData,
     SequentialModuleLabelData,
+    TokenizerConfig,
 )
 from src.data.loading.utils import combine_list_of_tensor_dicts, pad_or_trim_sequence
 from src.utils.tensor_utils import extract_locations
+from src.utils.utils import load_batch_tokenize
 from src.data.loading.components.interfaces import ItemData
 
 def identity_collate_fn(batch: Any) -> Any:
@@ -17,6 +23,48 @@ def identity_collate_fn(batch: Any) -> Any:
     return batch
 
 
+class TimedCollateFunction:
+    """Wraps a collate function to add its time and number of calls to the data loading
+    statistics of the dataloader worker running it (see UnboundedSequenceIterable.enable_metrics_tracking).
+    """
+
+    def __init__(self, collate_fn: Callable, data_loading_stats: torch.Tensor):
+        self.collate_fn = collate_fn
+        self.data_loading_stats = data_loading_stats
+
+    def __call__(self, batch: Any) -> Any:
+        start_time = time.perf_counter()
+        collated_batch = self.collate_fn(batch)
+        worker_info = get_worker_info()
+        worker_id = worker_info.id if worker_info is not None else 0
+        self.data_loading_stats[worker_id, 2] += time.perf_counter() - start_time
+        self.data_loading_stats[worker_id, 3] += 1
+        return collated_batch
+
+
+class WorkerTaggedBatch(NamedTuple):
+    """A collated batch and the id of the dataloader worker that produced it."""
+
+    worker_id: int
+    batch: Any
+
+
+class WorkerTaggingCollateFunction:
+    """Wraps a collate function to tag every batch with the id of the dataloader worker running
+    it, so the main process knows which worker each batch it consumes comes from without
+    assuming the order in which the dataloader reads its workers (see
+    SequenceDataModule.on_before_batch_transfer).
+    """
+
+    def __init__(self, collate_fn: Callable):
+        self.collate_fn = collate_fn
+
+    def __call__(self, batch: Any) -> WorkerTaggedBatch:
+        worker_info = get_worker_info()
+        worker_id = worker_info.id if worker_info is not None else 0
+        return WorkerTaggedBatch(worker_id, self.collate_fn(batch))
+
+
 def collate_with_sid_causal_duplicate(
     # batch can be a list or a dict
     # this function is used to create the generate contiguous sequences as data augmentation to improve the performance
@@ -31,13 +79,14 @@ def collate_with_sid_causal_duplicate(
         int
     ] = None,  # If oov_token is passed, we remove it from the sequence
     max_batch_size: int = 128,
+    packed_sequence_length: Optional[int] = None,
 ) -> Tuple[SequentialModelInputData, SequentialModuleLabelData]:
     """
         this collate fn is used to create the generate contiguous sequences as data augmentation to improve the performance.
         It does three things
         1. augment the input sequences by creating all possible contiguous sequences
         2. random sample max_batch_size sequences from the augmented sequences to prevent OOM
-        3. run regular collate_fn_train
+        3. run regular collate_fn_train (or collate_fn_packed_train if packed_sequence_length is set)
     Parameters
     ----------
     batch : Union[List[Dict[str, torch.Tensor]], Dict[str, torch.Tensor]]
@@ -59,6 +108,9 @@ def collate_with_sid_causal_duplicate(
         If oov_token is passed, we remove it from the sequence. (not used in this function, passed to collate_fn_train)
     max_batch_size : int
         The maximum batch size to be used after the data augmentation.
+    packed_sequence_length : Optional[int]
+        If set, the augmented sequences, which are mostly much shorter than sequence_length,
+        are packed into rows of this length instead of being padded one per row.
     """
 
     if isinstance(batch, list):
@@ -106,6 +158,19 @@ def collate_with_sid_causal_duplicate(
                             new_batch[field_name].append(batch[field_name][row_index])
                 current_idx += 1
 
+    if packed_sequence_length is not None:
+        return collate_fn_packed_train(
+            batch=new_batch,
+            labels=labels,
+            sequence_field_name=sequence_field_name,
+            sid_hierarchy=sid_hierarchy,
+            packed_sequence_length=packed_sequence_length,
+            sequence_length=sequence_length,
+            masking_token=masking_token,
+            padding_token=padding_token,
+            oov_token=oov_token,
+        )
+
     return collate_fn_train(
         batch=new_batch,
         labels=labels,
@@ -279,11 +344,321 @@ def collate_fn_train(
     return model_input_data, model_label_data  # type: ignore
 
 
+def first_fit_decreasing(
+    item_lengths: torch.Tensor, bin_length: int
+) -> Tuple[torch.Tensor, torch.Tensor, int]:
+    """First-fit decreasing bin packing of items of at most bin_length each.
+
+    First fit puts items of the same length in the first bins with room for them, as many
+    as fit in each bin, and opens new bins for the rest. So the items are placed one length
+    at a time, from the longest, with a cumulative sum of the capacities of the bins, in one
+    iteration per distinct length instead of one per item. Items of the same length are placed
+    in their order in item_lengths.
+
+    Parameters
+    ----------
+    item_lengths : torch.Tensor
+        The (num_items,) lengths of the items.
+    bin_length : int
+        The length of a bin.
+
+    Returns
+    -------
+    Tuple[torch.Tensor, torch.Tensor, int]
+        The bin of each item, the offset of each item in its bin, and the number of bins.
+    """
+    bin_indices = torch.zeros(item_lengths.numel(), dtype=torch.long)
+    offsets = torch.zeros(item_lengths.numel(), dtype=torch.long)
+    remaining_space = torch.zeros(0, dtype=torch.long)
+    for length in torch.unique(item_lengths).flip(0).tolist():
+        item_indices = torch.nonzero(item_lengths == length).flatten()
+        if length == 0:
+            # empty items go to the first bin
+            if remaining_space.numel() == 0:
+                remaining_space = torch.tensor([bin_length])
+            offsets[item_indices] = bin_length - remaining_space[0]
+            continue
+        capacities = remaining_space // length
+        capacity_ends = capacities.cumsum(dim=0)
+        capacity_starts = capacity_ends - capacities
+        num_placed = min(
+            item_indices.numel(), int(capacity_ends[-1]) if capacities.numel() > 0 else 0
+        )
+        # the first num_placed items fill the bins opened before, in order
+        ranks = torch.arange(num_placed)
+        placed_bins = torch.searchsorted(capacity_ends, ranks, right=True)
+        bin_indices[item_indices[:num_placed]] = placed_bins
+        offsets[item_indices[:num_placed]] = (
+            bin_length
+            - remaining_space[placed_bins]
+            + (ranks - capacity_starts[placed_bins]) * length
+        )
+        remaining_space = (
+            remaining_space
+            - (capacity_ends.clamp(max=num_placed) - capacity_starts).clamp(min=0) * length
+        )
+        # the other items open new bins of bin_length // length items each
+        num_new_items = item_indices.numel() - num_placed
+        if num_new_items == 0:
+            continue
+        items_per_bin = bin_length // length
+        ranks = torch.arange(num_new_items)
+        bin_indices[item_indices[num_placed:]] = (
+            remaining_space.numel() + ranks // items_per_bin
+        )
+        offsets[item_indices[num_placed:]] = ranks % items_per_bin * length
+        num_items_per_new_bin = torch.bincount(ranks // items_per_bin)
+        remaining_space = torch.cat(
+            (remaining_space, bin_length - num_items_per_new_bin * length)
+        )
+    return bin_indices, offsets, remaining_space.numel()
+
+
+def collate_fn_packed_train(
+    # batch can be a list or a dict
+    batch: Union[List[Dict[str, torch.Tensor]], Dict[str, torch.Tensor]],
+    labels: Dict[str, callable],  # type: ignore
+    sequence_field_name: str,
+    sid_hierarchy: int,
+    packed_sequence_length: int,
+    sequence_length: int = 200,
+    masking_token: int = 1,
+    padding_token: int = 0,
+    oov_token: Optional[
+        int
+    ] = None,  # If oov_token is passed, we remove it from the sequence
+    data_augmentation_functions: Optional[
+        List[Dict[str, callable]]
+    ] = None,  # type: ignore
+) -> Tuple[SequentialModelInputData, SequentialModuleLabelData]:
+    """The collate function for packed-sequence training. It runs collate_fn_train and then
+    packs the (masked) sequences of sequence_field_name into rows of packed_sequence_length
+    with first-fit decreasing, so several short histories share one encoder row instead of
+    each being padded to sequence_length.
+
+    The packed rows are described by model_input_data.segment_ids, where segment i (starting at 1)
+    holds the tokens of the (i - 1)-th sequence of the batch and 0 marks padding, and by
+    model_input_data.num_segments, the number of sequences of the batch. Labels and all
+    other fields are left unpacked, one row per sequence, so the decoder targets stay per segment.
+
+    Parameters
+    ----------
+    batch : Union[List[Dict[str, torch.Tensor]], Dict[str, torch.Tensor]]
+        The batch of data to be collated. Can be a list of dictionaries, in the case we were
+        loading the data per row, or a dictionary of tensors, in the case we were loading the data per batch.
+    labels : List[Dict[str, callable]]
+        The list of functions to apply to generate the labels.
+    sequence_field_name : str
+        The name of the field that contains the sequence to be packed.
+    sid_hierarchy : int
+        The length of Semantic IDs. Segments are kept aligned to item boundaries.
+    packed_sequence_length : int
+        The length of the packed rows. Must be a multiple of sid_hierarchy and at least sequence_length.
+    sequence_length : int
+        The length of the sequence to be padded or trimmed to before packing.
+    masking_token : int
+        The token used for masking.
+    padding_token : int
+        The token used for padding.
+    oov_token : Optional[int]
+        If oov_token is passed, we remove it from the sequence.
+    data_augmentation_functions : Optional[List[Dict[str, callable]]]
+        The list of functions to apply to augment the data.
+    """
+    if packed_sequence_length % sid_hierarchy != 0:
+        raise ValueError(
+            f"packed_sequence_length ({packed_sequence_length}) should be a multiple of sid_hierarchy ({sid_hierarchy})"
+        )
+    if packed_sequence_length < sequence_length:
+        raise ValueError(
+            f"packed_sequence_length ({packed_sequence_length}) should not be smaller than sequence_length ({sequence_length})"
+        )
+    if sequence_length % sid_hierarchy != 0:
+        # segments are rounded up to whole items, they must fit in the sequence
+        raise ValueError(
+            f"sequence_length ({sequence_length}) should be a multiple of sid_hierarchy ({sid_hierarchy})"
+        )
+
+    model_input_data, model_label_data = collate_fn_train(
+        batch=batch,
+        labels=labels,
+        sequence_length=sequence_length,
+        masking_token=masking_token,
+        padding_token=padding_token,
+        oov_token=oov_token,
+        data_augmentation_functions=data_augmentation_functions,
+    )
+
+    sequences = model_input_data.transformed_sequences[sequence_field_name]
+    mask = model_input_data.mask
+    # sequences are left aligned, a segment spans its valid tokens rounded up to whole items
+    segment_lengths = (
+        (mask.sum(dim=1) + sid_hierarchy - 1) // sid_hierarchy * sid_hierarchy
+    ).long()
+    row_indices, offsets, num_rows = first_fit_decreasing(
+        segment_lengths, packed_sequence_length
+    )
+
+    packed_sequences = torch.full(
+        (num_rows, packed_sequence_length), padding_token, dtype=sequences.dtype
+    )
+    packed_mask = torch.zeros((num_rows, packed_sequence_length), dtype=mask.dtype)
+    segment_ids = torch.zeros((num_rows, packed_sequence_length), dtype=torch.long)
+    # every token of every segment is copied at once to its row and column
+    sequence_indices, positions = torch.nonzero(
+        torch.arange(sequences.size(1)).unsqueeze(0) < segment_lengths.unsqueeze(1),
+        as_tuple=True,
+    )
+    packed_rows = row_indices[sequence_indices]
+    packed_columns = offsets[sequence_indices] + positions
+    segment_mask = mask[sequence_indices, positions]
+    packed_sequences[packed_rows, packed_columns] = sequences[sequence_indices, positions]
+    packed_mask[packed_rows, packed_columns] = segment_mask
+    segment_ids[packed_rows, packed_columns] = (sequence_indices + 1) * segment_mask
+
+    model_input_data.transformed_sequences[sequence_field_name] = packed_sequences
+    model_input_data.mask = packed_mask
+    model_input_data.segment_ids = segment_ids
+    model_input_data.num_segments = segment_lengths.numel()
+    return model_input_data, model_label_data  # type: ignore
+
+
+def collate_fn_ragged_train(
+    # batch can be a list or a dict
+    batch: Union[List[Dict[str, torch.Tensor]], Dict[str, torch.Tensor]],
+    sequence_length: int = 200,
+    oov_token: Optional[
+        int
+    ] = None,  # If oov_token is passed, we remove it from the sequence
+    data_augmentation_functions: Optional[
+        List[Dict[str, callable]]
+    ] = None,  # type: ignore
+    **kwargs,
+) -> RaggedSequenceData:
+    """The worker side of the device collate. Instead of padded int64 tensors, it ships the
+    sequences as int32 (or smaller, e.g. for compact semantic ids) values plus offsets, already
+    trimmed to their last sequence_length tokens.
+    The padding, masking and label construction done by collate_fn_train are then applied on
+    the device by collate_ragged_sequences_on_device, which SequenceDataModule calls in
+    on_after_batch_transfer.
+
+    Parameters
+    ----------
+    batch : Union[List[Dict[str, torch.Tensor]], Dict[str, torch.Tensor]]
+        The batch of data to be collated. Can be a list of dictionaries, in the case we were
+        loading the data per row, or a dictionary of tensors, in the case we were loading the data per batch.
+    sequence_length : int
+        The length of the sequence to be trimmed to.
+    oov_token : Optional[int]
+        If oov_token is passed, we remove it from the sequence.
+    data_augmentation_functions : Optional[List[Dict[str, callable]]]
+        The list of functions to apply to augment the data.
+    kwargs :
+        The labels, masking_token and padding_token passed by the datamodule are only used on the device.
+    """
+
+    if isinstance(batch, list):
+        batch = combine_list_of_tensor_dicts(batch)  # type: ignore
+
+    if data_augmentation_functions:
+        for data_augmentation_function in data_augmentation_functions:
+            batch = data_augmentation_function(batch)
+
+    ragged_data = RaggedSequenceData()
+    for field_name, field_sequence in batch.items():  # type: ignore
+        current_sequence = [sequence.reshape(-1) for sequence in field_sequence]
+        if oov_token:
+            current_sequence = [
+                sequence[sequence != oov_token] for sequence in current_sequence
+            ]
+        # only the last sequence_length tokens survive pad_or_trim_sequence
+        current_sequence = [sequence[-sequence_length:] for sequence in current_sequence]
+        row_lengths = torch.tensor(
+            [sequence.numel() for sequence in current_sequence], dtype=torch.int32
+        )
+        offsets = torch.zeros(len(current_sequence) + 1, dtype=torch.int32)
+        torch.cumsum(row_lengths, dim=0, out=offsets[1:])
+        values = torch.cat(current_sequence)
+        if values.element_size() > 4:
+            values = values.to(torch.int32)
+        ragged_data.values[field_name] = values
+        ragged_data.offsets[field_name] = offsets
+
+    return ragged_data
+
+
+def collate_ragged_sequences_on_device(
+    ragged_data: RaggedSequenceData,
+    labels: Dict[str, callable],  # type: ignore
+    sequence_length: int = 200,
+    masking_token: int = 1,
+    padding_token: int = 0,
+) -> Tuple[SequentialModelInputData, SequentialModuleLabelData]:
+    """The device side of collate_fn_ragged_train. Builds the same output as collate_fn_train
+    from the ragged batch with a single gather per feature, on whichever device the ragged batch is.
+
+    Parameters
+    ----------
+    ragged_data : RaggedSequenceData
+        The ragged batch returned by collate_fn_ragged_train.
+    labels : List[Dict[str, callable]]
+        The list of functions to apply to generate the labels.
+    sequence_length : int
+        The length of the sequence to be padded to.
+    masking_token : int
+        The token used for masking.
+    padding_token : int
+        The token used for padding.
+    """
+    model_input_data = SequentialModelInputData()
+    model_label_data = SequentialModuleLabelData()
+
+    for field_name, values in ragged_data.values.items():
+        offsets = ragged_data.offsets[field_name].long()
+        row_lengths = offsets[1:] - offsets[:-1]
+        # rows are left aligned and padded on the right, as in pad_or_trim_sequence
+        columns = torch.arange(sequence_length, device=values.device)
+        is_content = columns.unsqueeze(0) < row_lengths.unsqueeze(1)
+        value_indices = offsets[:-1].unsqueeze(1) + columns
+        # the sequences keep the dtype of the values, the model widens them before the lookup
+        current_sequence = torch.full(
+            is_content.shape, padding_token, dtype=values.dtype, device=values.device
+        )
+        current_sequence[is_content] = values[value_indices[is_content]]
+
+        if field_name in labels:
+            label_function = labels[field_name].transform
+            label_function_output: LabelFunctionOutput = label_function.transform_label(
+                sequence=current_sequence,
+                padding_token=padding_token,
+                masking_token=masking_token,
+            )
+            model_label_data.labels[field_name] = label_function_output.labels
+            model_label_data.label_location[
+                field_name
+            ] = label_function_output.label_location
+            model_label_data.attention_mask[
+                field_name
+            ] = label_function_output.attention_mask
+            model_input_data.transformed_sequences[
+                field_name
+            ] = label_function_output.sequence
+        else:
+            model_input_data.transformed_sequences[field_name] = current_sequence
+
+        if model_input_data.mask is None:
+            model_input_data.mask = (current_sequence != padding_token).long()
+
+    return model_input_data, model_label_data  # type: ignore
+
+
 def collate_fn_items(
     # batch can be a list or a dict
     batch: Union[List[Dict[str, torch.Tensor]], Dict[str, torch.Tensor]],
     item_id_field: str,
     feature_to_input_name: Dict[str, str],  # type: ignore
+    tokenizer_config: Optional[TokenizerConfig] = None,
+    text_features_to_tokenize: Optional[List[str]] = None,
 ) -> ItemData:
     """The collate function passed to the item dataloader.
 
@@ -297,6 +672,11 @@ def collate_fn_items(
         The name of the field in the batch that contains the item IDs.
     feature_to_input_name : Dict[str, str]
         The mapping from raw feature name to input feature name in ItemData.
+    tokenizer_config : Optional[TokenizerConfig]
+        If given, the text features in text_features_to_tokenize are tokenized here, with a
+        single tokenizer call for the whole batch. The mask of feature k is stored as k_mask.
+    text_features_to_tokenize : Optional[List[str]]
+        The names of the raw text features to tokenize. Each item has a single text.
 
     Returns:
     --------
@@ -309,6 +689,17 @@ def collate_fn_items(
         batch = combine_list_of_tensor_dicts(batch)  # type: ignore
         # does not change shape of text tokens
 
+    if tokenizer_config is not None:
+        batch_tokenize = load_batch_tokenize(config=tokenizer_config)
+        for field_name in text_features_to_tokenize or []:
+            texts = [
+                str(np.asarray(text).reshape(-1)[0]) for text in batch[field_name]
+            ]
+            tokenized_texts = batch_tokenize(texts)
+            # the tensors are already stacked, with one row per item
+            batch[field_name] = tokenized_texts["input_ids"]
+            batch["_".join([field_name, "mask"])] = tokenized_texts["attention_mask"]
+
     model_input_data = ItemData()
 
     for field_name, field_value in batch.items():  # type: ignore
@@ -319,7 +710,8 @@ def collate_fn_items(
             # In this case, field_value is a list of tensors, each representing the
             # features of a single item. We stack these tensors along the batch
             # dimension to create a single tensor for the batch of items.
-            field_value = torch.stack(field_value, dim=0)
+            if not isinstance(field_value, torch.Tensor):
+                field_value = torch.stack(field_value, dim=0)
             model_input_data.transformed_features[
                 feature_to_input_name[field_name]
             ] = field_value
@@ -1,5 +1,23 @@
+import array
+import atexit
+import fcntl
+import mmap
+import multiprocessing
+import os
+import pickle
+import queue
+import select
+import shutil
+import struct
+import termios
+import threading
 import time
+import traceback
+from itertools import islice
+from typing import Any, Callable, Iterator, List, NamedTuple, Optional, Tuple
 
+import torch
+from lightning_utilities.core.apply_func import apply_to_collection
 from torch.utils.data import _utils
 from torch.utils.data.dataloader import (
     DataLoader,
@@ -44,12 +62,616 @@ class DataloaderWithIterationRetry(DataLoader):
     def __init__(self, max_retries=3, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._max_retries = max_retries
+        self._last_iterator = None
+
+    @property
+    def queue_depth(self) -> int:
+        """The number of batches collated by the workers and not taken by the main process
+        yet, or 0 if it is not known (no workers, or no queue size on the platform)."""
+        if not isinstance(self._last_iterator, _MultiProcessingDataLoaderIter):
+            return 0
+        try:
+            return self._last_iterator._data_queue.qsize()
+        except NotImplementedError:
+            return 0
 
     def _get_iterator(self) -> "_BaseDataLoaderIter":
         if self.num_workers == 0:
-            return _SingleProcessDataLoaderIter(self)
+            self._last_iterator = _SingleProcessDataLoaderIter(self)
         else:
             self.check_worker_number_rationality()
-            return _MultiProcessingDataLoaderIterWithRetry(
+            self._last_iterator = _MultiProcessingDataLoaderIterWithRetry(
                 self, max_retries=self._max_retries
             )
+        return self._last_iterator
+
+
+class DevicePrefetchLoader:
+    """Wraps a dataloader to overlap loading batch N+1 with the computation on batch N.
+
+    A background thread gets the batches from the dataloader (so collation keeps running while
+    the model computes) and pins them if the device is a GPU. On a GPU, the copy of the next
+    batch is issued with non_blocking=True on a side CUDA stream before the current batch is
+    returned, so the transfer overlaps with the step. Tensors nested in dicts, lists, tuples and
+    dataclasses (e.g. SequentialModelInputData) are all transferred. On CPU, only the
+    background thread is used.
+
+    Parameters
+    ----------
+    dataloader: DataLoader
+        The dataloader to wrap. It should not pin memory itself.
+    device: torch.device
+        The device to move the batches to.
+    num_batches_to_prefetch: int
+        The number of collated batches kept ready by the background thread.
+    """
+
+    _END_OF_DATA = object()
+
+    def __init__(
+        self,
+        dataloader: DataLoader,
+        device: torch.device,
+        num_batches_to_prefetch: int = 2,
+    ):
+        self.dataloader = dataloader
+        self.device = torch.device(device)
+        self.num_batches_to_prefetch = num_batches_to_prefetch
+        self.is_cuda = self.device.type == "cuda" and torch.cuda.is_available()
+        self._batch_queue = None
+
+    @property
+    def queue_depth(self) -> int:
+        """The number of batches ready in the prefetch queue."""
+        return self._batch_queue.qsize() if self._batch_queue is not None else 0
+
+    def __len__(self) -> int:
+        # raises a TypeError for iterable datasets, as the wrapped dataloader does
+        return len(self.dataloader)
+
+    def __getattr__(self, name: str) -> Any:
+        # expose the attributes of the wrapped dataloader (e.g. dataset, batch_size)
+        if name == "dataloader":
+            raise AttributeError(name)
+        return getattr(self.dataloader, name)
+
+    def _load_batches(self, batch_queue: queue.Queue, stop_event: threading.Event):
+        try:
+            for batch in self.dataloader:
+                if self.is_cuda:
+                    batch = apply_to_collection(
+                        batch, torch.Tensor, lambda tensor: tensor.pin_memory()
+                    )
+                if not self._put(batch_queue, batch, stop_event):
+                    return
+        except Exception as exception:
+            # re-raised in the main thread
+            self._put(batch_queue, exception, stop_event)
+            return
+        self._put(batch_queue, self._END_OF_DATA, stop_event)
+
+    @staticmethod
+    def _put(batch_queue: queue.Queue, item: Any, stop_event: threading.Event) -> bool:
+        # we time out periodically so that the thread stops if the consumer stopped iterating
+        while not stop_event.is_set():
+            try:
+                batch_queue.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _transfer(self, batch: Any, stream: Optional["torch.cuda.Stream"]) -> Any:
+        if batch is self._END_OF_DATA or stream is None:
+            return batch
+        with torch.cuda.stream(stream):
+            return apply_to_collection(
+                batch,
+                torch.Tensor,
+                lambda tensor: tensor.to(self.device, non_blocking=True),
+            )
+
+    def __iter__(self) -> Iterator[Any]:
+        batch_queue = queue.Queue(maxsize=max(1, self.num_batches_to_prefetch))
+        self._batch_queue = batch_queue
+        stop_event = threading.Event()
+        loading_thread = threading.Thread(
+            target=self._load_batches, args=(batch_queue, stop_event), daemon=True
+        )
+        loading_thread.start()
+        stream = torch.cuda.Stream(device=self.device) if self.is_cuda else None
+
+        def get_next_batch() -> Any:
+            batch = batch_queue.get()
+            if isinstance(batch, Exception):
+                raise batch
+            return self._transfer(batch, stream)
+
+        try:
+            next_batch = get_next_batch()
+            while next_batch is not self._END_OF_DATA:
+                batch = next_batch
+                if stream is not None:
+                    # the compute stream waits for the copy, and the memory of the copied
+                    # tensors must not be reused before the compute stream is done with them
+                    current_stream = torch.cuda.current_stream(self.device)
+                    current_stream.wait_stream(stream)
+                    apply_to_collection(
+                        batch,
+                        torch.Tensor,
+                        lambda tensor: tensor.record_stream(current_stream),
+                    )
+                # the copy of the next batch starts before the current one is used
+                next_batch = get_next_batch()
+                yield batch
+        finally:
+            stop_event.set()
+
+
+class _SlotTensor(NamedTuple):
+    """The place of a tensor of a batch in a shared memory slot."""
+
+    dtype: torch.dtype
+    shape: Tuple[int, ...]
+    offset: int
+    num_bytes: int
+
+
+class _SharedMemorySlot:
+    """A slot of the ring buffer of SharedPreprocessingLoader: a file in shared memory holding
+    one collated batch, mapped by the producer writing it and by the GPU reading it.
+
+    The slot starts with the length of a pickled copy of the batch in which every tensor is
+    replaced by its place in the slot, followed by the bytes of the tensors. Writing and reading
+    a batch is then one copy of its tensors, without serializing them. The file grows when a
+    batch does not fit, and is mapped again by the reader when its size changed.
+    """
+
+    _ALIGNMENT = 64
+    _HEADER_LENGTH_FORMAT = "<Q"
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+        self._mmap: Optional[mmap.mmap] = None
+
+    @classmethod
+    def _align(cls, offset: int) -> int:
+        return (offset + cls._ALIGNMENT - 1) // cls._ALIGNMENT * cls._ALIGNMENT
+
+    def _map(self, min_size: int = 0):
+        if self._file is None:
+            self._file = open(self.path, "a+b")
+        size = os.fstat(self._file.fileno()).st_size
+        if size < min_size:
+            # the slot grows geometrically, so it is only resized a few times
+            size = max(min_size, 2 * size)
+            os.ftruncate(self._file.fileno(), size)
+        if self._mmap is None or len(self._mmap) != size:
+            if self._mmap is not None:
+                self._mmap.close()
+            self._mmap = mmap.mmap(self._file.fileno(), size)
+
+    def write(self, batch: Any):
+        tensors = []
+        data_size = 0
+
+        def place_tensor(tensor: torch.Tensor) -> _SlotTensor:
+            nonlocal data_size
+            tensor = tensor.detach().cpu().contiguous()
+            offset = self._align(data_size)
+            num_bytes = tensor.numel() * tensor.element_size()
+            data_size = offset + num_bytes
+            tensors.append((tensor, offset, num_bytes))
+            return _SlotTensor(tensor.dtype, tuple(tensor.shape), offset, num_bytes)
+
+        header = pickle.dumps(
+            apply_to_collection(batch, torch.Tensor, place_tensor),
+            protocol=pickle.HIGHEST_PROTOCOL,
+        )
+        header_end = struct.calcsize(self._HEADER_LENGTH_FORMAT) + len(header)
+        data_start = self._align(header_end)
+        self._map(min_size=data_start + data_size)
+        struct.pack_into(self._HEADER_LENGTH_FORMAT, self._mmap, 0, len(header))
+        self._mmap[header_end - len(header) : header_end] = header
+        for tensor, offset, num_bytes in tensors:
+            if num_bytes > 0:
+                torch.frombuffer(
+                    self._mmap, dtype=torch.uint8, count=num_bytes, offset=data_start + offset
+                ).copy_(tensor.view(-1).view(torch.uint8))
+
+    def read(self) -> Any:
+        self._map()
+        header_length = struct.unpack_from(self._HEADER_LENGTH_FORMAT, self._mmap, 0)[0]
+        header_end = struct.calcsize(self._HEADER_LENGTH_FORMAT) + header_length
+        data_start = self._align(header_end)
+
+        def copy_tensor(slot_tensor: _SlotTensor) -> torch.Tensor:
+            if slot_tensor.num_bytes == 0:
+                return torch.empty(slot_tensor.shape, dtype=slot_tensor.dtype)
+            # the batch is copied out, so the slot can be reused right away
+            return (
+                torch.frombuffer(
+                    self._mmap,
+                    dtype=torch.uint8,
+                    count=slot_tensor.num_bytes,
+                    offset=data_start + slot_tensor.offset,
+                )
+                .clone()
+                .view(slot_tensor.dtype)
+                .view(slot_tensor.shape)
+            )
+
+        return apply_to_collection(
+            pickle.loads(self._mmap[header_end - header_length : header_end]),
+            _SlotTensor,
+            copy_tensor,
+        )
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class SharedPreprocessingLoader:
+    """Feeds all the GPUs of a node from one pool of preprocessing processes, so the CPU capacity
+    used for decoding, preprocessing and collation does not depend on the number of GPUs.
+
+    The local rank 0 starts num_producers processes. Each of them iterates over its share of the
+    files of the node (the union of the files of the GPUs of the node, so no file is decoded
+    twice), collates the batches and sends them round robin to the GPUs of the node.
+
+    The batches go through a ring buffer in shared_memory_dir (RAM backed by default): each
+    producer has buffer_size slots per GPU (see _SharedMemorySlot), reused in turn. Two named
+    pipes per producer and GPU carry one token per slot: the producer writes a token to the
+    ready pipe once a slot is filled, and the GPU writes a token to the free pipe once it copied
+    the batch out of the slot. The producer waits for a free token before reusing a slot, and
+    the GPU waits on the ready pipes of all the producers at once, so neither of them polls.
+
+    A producer sends its batches in rounds of one batch per GPU and drops its last incomplete
+    round, so all the GPUs of the node get the same number of batches and none of them waits
+    in a collective for a batch the others do not have. Each GPU acknowledges an iteration once
+    it stops reading it. Its directory is removed by the local rank 0 once all the GPUs
+    acknowledged it and its producers were stopped.
+
+    Parameters
+    ----------
+    dataset: IterableDataset
+        The dataset, with the files of the whole node (see BaseDataset.set_local_worker).
+    collate_fn: Callable
+        The collate function applied to each batch.
+    batch_size: Optional[int]
+        The number of rows collated together, or None if the dataset yields batches.
+    drop_last: bool
+        Whether to drop the last incomplete batch of each producer.
+    num_producers: int
+        The number of preprocessing processes of the node.
+    local_rank: int
+        The rank of this GPU within the node.
+    num_local_ranks: int
+        The number of GPUs of the node.
+    run_id: str
+        An id of the run, shared by the GPUs of the node, used to name the ring buffer.
+    shared_memory_dir: str
+        The directory of the ring buffer.
+    buffer_size: int
+        The number of batches each producer may have ready for each GPU.
+    timeout: int
+        The maximum number of seconds to wait for a batch. 0 waits indefinitely.
+    """
+
+    # tokens of the ready pipes
+    _BATCH_TOKEN = b"b"
+    _DONE_TOKEN = b"d"
+    _ERROR_TOKEN = b"e"
+    # tokens of the free pipes
+    _FREE_TOKEN = b"f"
+    # the other GPUs wait this long between checks for the iteration set up by local rank 0
+    _SETUP_POLL_INTERVAL_SECONDS = 0.01
+
+    def __init__(
+        self,
+        dataset: Any,
+        collate_fn: Callable,
+        batch_size: Optional[int],
+        drop_last: bool,
+        num_producers: int,
+        local_rank: int,
+        num_local_ranks: int,
+        run_id: str,
+        shared_memory_dir: str = "/dev/shm",
+        buffer_size: int = 8,
+        timeout: int = 0,
+    ):
+        self.dataset = dataset
+        self.collate_fn = collate_fn
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.num_producers = num_producers
+        self.local_rank = local_rank
+        self.num_local_ranks = num_local_ranks
+        self.buffer_dir = os.path.join(
+            shared_memory_dir, f"shared_preprocessing_{run_id}"
+        )
+        self.buffer_size = max(1, buffer_size)
+        self.timeout = timeout
+        self.num_iterations = 0
+        self._ready_fds: List[int] = []
+        self.producers: List[multiprocessing.Process] = []
+        if self.local_rank == 0:
+            atexit.register(self.close)
+
+    @property
+    def queue_depth(self) -> int:
+        """The number of batches ready for this GPU in the ring buffer."""
+        num_tokens = array.array("i", [0])
+        queue_depth = 0
+        for ready_fd in self._ready_fds:
+            try:
+                fcntl.ioctl(ready_fd, termios.FIONREAD, num_tokens)
+            except OSError:
+                continue
+            queue_depth += num_tokens[0]
+        return queue_depth
+
+    def _get_iteration_dir(self) -> str:
+        return os.path.join(self.buffer_dir, f"iteration_{self.num_iterations}")
+
+    @staticmethod
+    def _get_rank_dir(iteration_dir: str, rank: int) -> str:
+        return os.path.join(iteration_dir, f"rank_{rank}")
+
+    @staticmethod
+    def _get_slot_path(rank_dir: str, producer_id: int, slot_index: int) -> str:
+        return os.path.join(rank_dir, f"{producer_id}_{slot_index}.slot")
+
+    @staticmethod
+    def _get_pipe_path(rank_dir: str, producer_id: int, pipe_name: str) -> str:
+        return os.path.join(rank_dir, f"{producer_id}.{pipe_name}")
+
+    @staticmethod
+    def _open_pipe(path: str, non_blocking: bool = False) -> int:
+        # opening for reading and writing never blocks waiting for the other end, and a pipe
+        # open for writing by its reader never reaches the end of file
+        return os.open(path, os.O_RDWR | (os.O_NONBLOCK if non_blocking else 0))
+
+    @staticmethod
+    def _get_batches(
+        dataset: Any, batch_size: Optional[int], drop_last: bool
+    ) -> Iterator[Any]:
+        # batches the rows like a DataLoader does
+        rows = iter(dataset)
+        if batch_size is None:
+            yield from rows
+            return
+        while rows_of_batch := list(islice(rows, batch_size)):
+            if drop_last and len(rows_of_batch) < batch_size:
+                return
+            yield rows_of_batch
+
+    @staticmethod
+    def _get_consumed_marker_path(iteration_dir: str, rank: int) -> str:
+        return os.path.join(iteration_dir, f"rank_{rank}.consumed")
+
+    @staticmethod
+    def _get_setup_marker_path(iteration_dir: str) -> str:
+        return os.path.join(iteration_dir, "ready")
+
+    @staticmethod
+    def _write_marker(path: str, content: str):
+        with open(f"{path}.tmp", "w") as f:
+            f.write(content)
+        os.replace(f"{path}.tmp", path)
+
+    @classmethod
+    def _produce_batches(
+        cls,
+        dataset: Any,
+        collate_fn: Callable,
+        batch_size: Optional[int],
+        drop_last: bool,
+        producer_id: int,
+        num_producers: int,
+        iteration_dir: str,
+        num_local_ranks: int,
+        buffer_size: int,
+    ):
+        rank_dirs = [
+            cls._get_rank_dir(iteration_dir, rank) for rank in range(num_local_ranks)
+        ]
+        ready_fds = [
+            cls._open_pipe(cls._get_pipe_path(rank_dir, producer_id, "ready"))
+            for rank_dir in rank_dirs
+        ]
+        free_fds = [
+            cls._open_pipe(cls._get_pipe_path(rank_dir, producer_id, "free"))
+            for rank_dir in rank_dirs
+        ]
+        slots = [
+            [
+                _SharedMemorySlot(cls._get_slot_path(rank_dir, producer_id, slot_index))
+                for slot_index in range(buffer_size)
+            ]
+            for rank_dir in rank_dirs
+        ]
+        num_batches_per_rank = [0] * num_local_ranks
+        try:
+            dataset.set_local_worker(worker_id=producer_id, num_workers=num_producers)
+            batches = cls._get_batches(dataset, batch_size, drop_last)
+            # a round holds one batch per GPU, the last incomplete round is dropped
+            while len(round_batches := list(islice(batches, num_local_ranks))) == (
+                num_local_ranks
+            ):
+                for rank, batch in enumerate(round_batches):
+                    batch_index = num_batches_per_rank[rank]
+                    if batch_index >= buffer_size:
+                        # blocks until the GPU copied out the batch written buffer_size
+                        # batches ago
+                        os.read(free_fds[rank], 1)
+                    slots[rank][batch_index % buffer_size].write(collate_fn(batch))
+                    os.write(ready_fds[rank], cls._BATCH_TOKEN)
+                    num_batches_per_rank[rank] += 1
+        except Exception:
+            for rank_dir, ready_fd in zip(rank_dirs, ready_fds):
+                cls._write_marker(
+                    os.path.join(rank_dir, f"{producer_id}.error"), traceback.format_exc()
+                )
+                os.write(ready_fd, cls._ERROR_TOKEN)
+            raise
+        for ready_fd in ready_fds:
+            os.write(ready_fd, cls._DONE_TOKEN)
+
+    def _is_iteration_consumed(self, iteration_dir: str) -> bool:
+        return all(
+            os.path.exists(self._get_consumed_marker_path(iteration_dir, rank))
+            for rank in range(self.num_local_ranks)
+        )
+
+    def _remove_consumed_iterations(self):
+        """Remove the directories of the iterations acknowledged by all the GPUs. The producers
+        must be stopped before, as they may still be writing to the last iteration."""
+        for iteration in range(1, self.num_iterations + 1):
+            iteration_dir = os.path.join(self.buffer_dir, f"iteration_{iteration}")
+            if os.path.isdir(iteration_dir) and self._is_iteration_consumed(iteration_dir):
+                shutil.rmtree(iteration_dir, ignore_errors=True)
+
+    def _stop_producers(self):
+        for producer in self.producers:
+            if producer.is_alive():
+                producer.terminate()
+            producer.join()
+        self.producers = []
+
+    def _start_producers(self, iteration_dir: str):
+        # the other GPUs may still be reading the previous iteration, its directory is
+        # only removed once they all acknowledged it
+        self._stop_producers()
+        self._remove_consumed_iterations()
+        for rank in range(self.num_local_ranks):
+            rank_dir = self._get_rank_dir(iteration_dir, rank)
+            os.makedirs(rank_dir, exist_ok=True)
+            for producer_id in range(self.num_producers):
+                for pipe_name in ("ready", "free"):
+                    os.mkfifo(self._get_pipe_path(rank_dir, producer_id, pipe_name))
+        self._write_marker(self._get_setup_marker_path(iteration_dir), "")
+        for producer_id in range(self.num_producers):
+            producer = multiprocessing.Process(
+                target=self._produce_batches,
+                kwargs=dict(
+                    dataset=self.dataset,
+                    collate_fn=self.collate_fn,
+                    batch_size=self.batch_size,
+                    drop_last=self.drop_last,
+                    producer_id=producer_id,
+                    num_producers=self.num_producers,
+                    iteration_dir=iteration_dir,
+                    num_local_ranks=self.num_local_ranks,
+                    buffer_size=self.buffer_size,
+                ),
+                daemon=True,
+            )
+            producer.start()
+            self.producers.append(producer)
+        command_line_logger.info(
+            f"Started {self.num_producers} preprocessing processes for {self.num_local_ranks}"
+            f" GPUs writing to {iteration_dir}"
+        )
+
+    def close(self):
+        """Stop the preprocessing processes and remove the ring buffer (local rank 0 only)."""
+        self._stop_producers()
+        if self.local_rank == 0:
+            shutil.rmtree(self.buffer_dir, ignore_errors=True)
+
+    def _wait_for_setup(self, iteration_dir: str):
+        """Wait for the local rank 0 to create the pipes of the iteration."""
+        setup_marker_path = self._get_setup_marker_path(iteration_dir)
+        wait_start_time = time.monotonic()
+        while not os.path.exists(setup_marker_path):
+            if self.timeout > 0 and time.monotonic() - wait_start_time > self.timeout:
+                raise RuntimeError(
+                    f"The preprocessing processes were not started in {self.timeout} seconds"
+                )
+            time.sleep(self._SETUP_POLL_INTERVAL_SECONDS)
+
+    def _raise_producer_error(self, rank_dir: str, producer_id: int):
+        with open(os.path.join(rank_dir, f"{producer_id}.error"), "r") as f:
+            raise RuntimeError(f"Preprocessing process {producer_id} failed:\n{f.read()}")
+
+    def __iter__(self) -> Iterator[Any]:
+        self.num_iterations += 1
+        iteration_dir = self._get_iteration_dir()
+        if self.local_rank == 0:
+            self._start_producers(iteration_dir)
+        else:
+            self._wait_for_setup(iteration_dir)
+        rank_dir = self._get_rank_dir(iteration_dir, self.local_rank)
+
+        ready_fds = [
+            self._open_pipe(
+                self._get_pipe_path(rank_dir, producer_id, "ready"), non_blocking=True
+            )
+            for producer_id in range(self.num_producers)
+        ]
+        free_fds = [
+            self._open_pipe(self._get_pipe_path(rank_dir, producer_id, "free"))
+            for producer_id in range(self.num_producers)
+        ]
+        self._ready_fds = ready_fds
+        producer_ids = {ready_fd: producer_id for producer_id, ready_fd in enumerate(ready_fds)}
+        slots = [
+            [
+                _SharedMemorySlot(self._get_slot_path(rank_dir, producer_id, slot_index))
+                for slot_index in range(self.buffer_size)
+            ]
+            for producer_id in range(self.num_producers)
+        ]
+        poller = select.poll()
+        for ready_fd in ready_fds:
+            poller.register(ready_fd, select.POLLIN)
+        next_batch_index = [0] * self.num_producers
+        num_active_producers = self.num_producers
+        try:
+            while num_active_producers > 0:
+                # blocks until a producer has a batch ready, the batches of the producers
+                # that are ready together are taken round robin
+                events = poller.poll(self.timeout * 1000 if self.timeout > 0 else None)
+                if not events:
+                    raise RuntimeError(
+                        "No batch received from the preprocessing processes in"
+                        f" {self.timeout} seconds"
+                    )
+                for ready_fd, _ in events:
+                    producer_id = producer_ids[ready_fd]
+                    token = os.read(ready_fd, 1)
+                    if token == self._ERROR_TOKEN:
+                        self._raise_producer_error(rank_dir, producer_id)
+                    if token == self._DONE_TOKEN:
+                        poller.unregister(ready_fd)
+                        num_active_producers -= 1
+                        continue
+                    slot_index = next_batch_index[producer_id] % self.buffer_size
+                    batch = slots[producer_id][slot_index].read()
+                    os.write(free_fds[producer_id], self._FREE_TOKEN)
+                    next_batch_index[producer_id] += 1
+                    yield batch
+        finally:
+            self._ready_fds = []
+            for fd in ready_fds + free_fds:
+                os.close(fd)
+            for producer_slots in slots:
+                for slot in producer_slots:
+                    slot.close()
+            # acknowledge the iteration, also when the iteration is stopped early
+            self._write_marker(
+                self._get_consumed_marker_path(iteration_dir, self.local_rank), ""
+            )
+            if self.local_rank == 0 and self._is_iteration_consumed(iteration_dir):
+                # no GPU reads the iteration anymore, its producers are stopped before its
+                # directory is removed. Otherwise, both happen when the next iteration starts.
+                self._stop_producers()
+                self._remove_consumed_iterations()
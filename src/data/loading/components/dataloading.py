@@ -1,12 +1,22 @@
 import copy
-from typing import Any, List, Optional
+import random
+import time
+from itertools import islice
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
 
+import torch
 from torch.utils.data import IterableDataset, get_worker_info
 
 from src.data.loading.components.interfaces import BaseDatasetConfig
 from src.utils.pylogger import RankedLogger
 
 command_line_logger = RankedLogger(__name__, rank_zero_only=True)
+# columns of the data loading statistics before the preprocessing times
+DATA_LOADING_STATS_NUM_COLUMNS = 4
+# columns of a cursor, see BaseDataset.enable_cursor_tracking
+CURSOR_NUM_COLUMNS = 5
+# logs from every GPU, e.g. for statistics of every dataloader worker
+all_ranks_logger = RankedLogger(__name__, rank_zero_only=False)
 
 
 class BaseDataset:
@@ -18,6 +28,8 @@ class BaseDataset:
         batch_size: int = 1,
         is_for_training: bool = True,
         assign_all_files_per_worker: bool = False,
+        shuffle_buffer_size: int = 0,
+        seed: Optional[int] = None,
     ):
         """
         Base class for all datasets. This class is used to set up the dataset and provide the list of files to be used.
@@ -31,6 +43,9 @@ class BaseDataset:
                 This will enable each worker to access all files. Each worker will locally shuffle the files.
                 This would be useful for small datasets. In smaller datasets, if each worker only observes a subset of the files,
                 it may not be able to learn the distribution of the data.
+            shuffle_buffer_size (int): Number of rows (or batches, if not iterating per row) kept in the
+                shuffle buffer when should_shuffle_rows is True. 0 disables the buffer.
+            seed (Optional[int]): Base seed for shuffling. Each worker and epoch derive their own seed from it.
         """
         self.dataset_config = dataset_config
         self.should_shuffle_rows = should_shuffle_rows
@@ -39,19 +54,46 @@ class BaseDataset:
         self.batch_size = batch_size
         self.is_for_training = is_for_training
         self.assign_all_files_per_worker = assign_all_files_per_worker
+        self.worker_file_map = None
+        self.local_worker = None
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.seed = seed
+        self.epoch = 0
+        # cursor tracking, see enable_cursor_tracking
+        self.cursor_history = None
+        self.resume_cursors = None
+        self.num_rows_read = 0
+        self.num_rows_yielded = 0
+        self.num_rows_shuffled = 0
+        self.num_rows_per_batch = 1
+        # metrics tracking, see enable_metrics_tracking
+        self.data_loading_stats = None
+        self.preprocessing_times = None
 
     def set_list_of_files(self, list_of_files: List[str]):
         self.list_of_file_paths = list_of_files
 
+    def set_worker_file_map(self, worker_file_map: Optional[Dict[int, List[str]]]):
+        """Set the files of each dataloader worker, if they were already assigned per worker
+        (see assign_files_to_ranks_and_workers). Otherwise, the files are split across the workers."""
+        self.worker_file_map = worker_file_map
+
     def set_distributed_params(self, total_workers: int, global_worker_id: int):
         # TODO (lneves): figure out how to do this in LightningDataModule
         self.total_workers = total_workers
         self.global_worker_id = global_worker_id
 
+    def set_local_worker(self, worker_id: int, num_workers: int):
+        """Set the worker id and number of workers of the node, for a dataset iterated by other
+        processes than DataLoader workers (see SharedPreprocessingLoader)."""
+        self.local_worker = (worker_id, num_workers)
+
     def get_worker_id_and_num_workers(self):
         worker_info = get_worker_info()
 
-        if worker_info is None:
+        if self.local_worker is not None:
+            worker_id, num_workers = self.local_worker
+        elif worker_info is None:
             # Single-worker setup (no multiprocessing)
             worker_id = 0
             num_workers = 1
@@ -63,14 +105,25 @@ class BaseDataset:
         self.global_dataloader_worker_id = (
             self.global_worker_id * num_workers + worker_id
         )
+        self.worker_id = worker_id
 
         return worker_id, num_workers
 
     def get_list_of_worker_files(self):
         # Get information about worker and then separate only files that belong to this worker
         worker_id, num_workers = self.get_worker_id_and_num_workers()
-        if self.assign_all_files_per_worker:
+        data_iterator = getattr(self.dataset_config, "data_iterator", None)
+        if data_iterator is not None and data_iterator.shards_within_files:
+            # Every worker of every GPU gets all files and reads only its shard of them.
+            worker_files = self.list_of_file_paths
+            data_iterator.set_shard(
+                shard_id=self.global_dataloader_worker_id,
+                num_shards=self.total_workers * num_workers,
+            )
+        elif self.assign_all_files_per_worker:
             worker_files = self.list_of_file_paths
+        elif self.worker_file_map is not None and len(self.worker_file_map) == num_workers:
+            worker_files = self.worker_file_map[worker_id]
         else:
             worker_files = self.list_of_file_paths[worker_id::num_workers]
         command_line_logger.debug(
@@ -78,6 +131,155 @@ class BaseDataset:
         )
         return worker_files
 
+    def enable_cursor_tracking(
+        self, num_workers: int, num_rows_per_batch: int, history_size: int = 256
+    ):
+        """Make every dataloader worker record its cursor after each batch it produces, so that
+        the reading can be resumed from a checkpoint.
+
+        A cursor is (batch index, epoch, rows read, rows yielded, rows shuffled), where rows read
+        counts the rows taken from the data iterator in the current epoch, rows yielded counts the
+        rows yielded by the worker over all epochs and rows shuffled counts the rows taken out of
+        the shuffle buffer in the current epoch. The cursors of the last history_size batches of
+        each worker are kept in shared memory, which lets the main process get the cursor of
+        the last batch it consumed even though the workers run ahead of it.
+
+        The rows read include the rows still waiting in the shuffle buffer. On resume, the
+        buffer is rebuilt by replaying the shuffling over the row indices (see
+        replay_shuffle_buffer), so these rows are read again and none of them is lost.
+
+        Args:
+            num_workers (int): The number of dataloader workers (0 is treated as 1).
+            num_rows_per_batch (int): The number of rows the dataset yields per batch.
+            history_size (int): The number of batches kept per worker. Must be larger than the
+                number of batches prefetched by the dataloader.
+        """
+        self.num_rows_per_batch = num_rows_per_batch
+        self.cursor_history = torch.full(
+            (max(1, num_workers), history_size, CURSOR_NUM_COLUMNS), -1, dtype=torch.long
+        ).share_memory_()
+
+    def get_cursor(self, worker_id: int, batch_index: int) -> Optional[torch.Tensor]:
+        """Get the cursor of a worker after the batch batch_index, if it is still in the history."""
+        cursor = self.cursor_history[
+            worker_id, batch_index % self.cursor_history.size(1)
+        ].clone()
+        return cursor if cursor[0].item() == batch_index else None
+
+    def set_resume_cursors(self, resume_cursors: torch.Tensor):
+        """Set the cursors (one row per worker, see enable_cursor_tracking) to resume from.
+        Workers with a negative batch index start from the beginning."""
+        self.resume_cursors = resume_cursors
+
+    def record_cursor(self):
+        """Record the cursor of this worker if a batch was just completed."""
+        if (
+            self.cursor_history is None
+            or self.num_rows_yielded % self.num_rows_per_batch != 0
+        ):
+            return
+        batch_index = self.num_rows_yielded // self.num_rows_per_batch - 1
+        self.cursor_history[
+            self.worker_id, batch_index % self.cursor_history.size(1)
+        ] = torch.tensor(
+            [
+                batch_index,
+                self.epoch,
+                self.num_rows_read,
+                self.num_rows_yielded,
+                self.num_rows_shuffled,
+            ]
+        )
+
+    def count_rows_read(self, iterable: Iterable) -> Iterator:
+        for row_or_batch in iterable:
+            self.num_rows_read += 1
+            yield row_or_batch
+
+    def get_shuffle_seed(self) -> int:
+        """Get the shuffling seed of this worker for the current epoch. Workers need different
+        seeds so that workers reading the same files don't return the same examples, and epochs
+        need different seeds so that every epoch sees a different order."""
+        base_seed = self.seed if self.seed is not None else 0
+        return (
+            (base_seed * 1_000_003 + self.epoch) * 1_000_003
+            + self.global_dataloader_worker_id
+        ) % (2**32)
+
+    def replay_shuffle_buffer(
+        self, seed: int, num_rows_read: int
+    ) -> Tuple[random.Random, List[int]]:
+        """Replay shuffle_with_buffer over the indices of the first num_rows_read rows of an
+        epoch, without reading them. This takes one random draw per row, which is much cheaper
+        than reading the rows again.
+
+        Returns the random generator in the state it had after these rows, and the index of the
+        row in each slot of the buffer.
+        """
+        rng = random.Random(seed)
+        buffer_rows = list(range(min(num_rows_read, self.shuffle_buffer_size)))
+        for row_index in range(len(buffer_rows), num_rows_read):
+            buffer_rows[rng.randrange(self.shuffle_buffer_size)] = row_index
+        return rng, buffer_rows
+
+    def shuffle_with_buffer(
+        self,
+        iterable: Iterable,
+        seed: int,
+        num_rows_read: int = 0,
+        num_rows_shuffled: int = 0,
+    ) -> Iterator:
+        """Shuffle a stream with a buffer of shuffle_buffer_size elements. Once the buffer is full,
+        every new element replaces a random element of the buffer, which is yielded.
+
+        To resume after num_rows_shuffled rows were yielded out of the num_rows_read rows read,
+        the stream must start at the first row still in the buffer (see resume_shuffle_buffer),
+        and the buffer is filled again from it. The order is then the same as without resuming.
+        """
+        self.num_rows_shuffled = num_rows_shuffled
+        iterator = iter(iterable)
+        if num_rows_read > 0:
+            rng, buffer_rows = self.replay_shuffle_buffer(seed, num_rows_read)
+            first_row = min(buffer_rows, default=num_rows_read)
+            slots = {row_index: slot for slot, row_index in enumerate(buffer_rows)}
+            buffer = [None] * len(buffer_rows)
+            for row_index, element in enumerate(
+                islice(iterator, num_rows_read - first_row), start=first_row
+            ):
+                if row_index in slots:
+                    buffer[slots[row_index]] = element
+            # empty slots are only left if the data changed since the cursor was saved
+            buffer = [element for element in buffer if element is not None]
+        else:
+            rng = random.Random(seed)
+            buffer = []
+        # the rows of the end of the epoch, once the data iterator is exhausted
+        num_rows_drained = num_rows_shuffled - max(
+            0, num_rows_read - self.shuffle_buffer_size
+        )
+        if num_rows_drained <= 0:
+            for element in iterator:
+                if len(buffer) < self.shuffle_buffer_size:
+                    buffer.append(element)
+                    continue
+                index = rng.randrange(self.shuffle_buffer_size)
+                self.num_rows_shuffled += 1
+                yield buffer[index]
+                buffer[index] = element
+            num_rows_drained = 0
+        rng.shuffle(buffer)
+        for element in buffer[num_rows_drained:]:
+            self.num_rows_shuffled += 1
+            yield element
+
+    def resume_shuffle_buffer(self, num_rows_read: int) -> int:
+        """Get the number of rows of the epoch to skip to rebuild the shuffle buffer after
+        num_rows_read rows, i.e. the index of the oldest row still in the buffer."""
+        _, buffer_rows = self.replay_shuffle_buffer(
+            self.get_shuffle_seed(), num_rows_read
+        )
+        return min(buffer_rows, default=num_rows_read)
+
     def setup(self):
         pass
 
@@ -95,6 +297,8 @@ class UnboundedSequenceIterable(BaseDataset, IterableDataset):
         batch_size: int = 1,
         is_for_training: bool = True,
         assign_all_files_per_worker: bool = False,
+        shuffle_buffer_size: int = 0,
+        seed: Optional[int] = None,
     ):
         super().__init__(
             dataset_config=dataset_config,
@@ -103,6 +307,8 @@ class UnboundedSequenceIterable(BaseDataset, IterableDataset):
             batch_size=batch_size,
             is_for_training=is_for_training,
             assign_all_files_per_worker=assign_all_files_per_worker,
+            shuffle_buffer_size=shuffle_buffer_size,
+            seed=seed,
         )
         self.data_iterator = dataset_config.data_iterator
         self.dataset_to_iterate = None
@@ -110,23 +316,62 @@ class UnboundedSequenceIterable(BaseDataset, IterableDataset):
     def setup(self):
         # We update each worker's data iterator with the files just for that worker.
         self.data_iterator.update_list_of_file_paths(self.get_list_of_worker_files())
+        num_rows_read = 0
+        num_rows_shuffled = 0
+        if self.resume_cursors is not None:
+            if self.worker_id < self.resume_cursors.size(0):
+                (
+                    batch_index,
+                    epoch,
+                    num_rows_read,
+                    num_rows_yielded,
+                    num_rows_shuffled,
+                ) = self.resume_cursors[self.worker_id].tolist()
+                if batch_index >= 0:
+                    # the shuffling seeds depend on the epoch, so the order is the same as before
+                    self.epoch = epoch
+                    self.num_rows_yielded = num_rows_yielded
+                else:
+                    num_rows_read = 0
+                    num_rows_shuffled = 0
+            # we only resume once
+            self.resume_cursors = None
+        use_shuffle_buffer = self.should_shuffle_rows and self.shuffle_buffer_size > 0
+        # the rows still in the shuffle buffer are read again to rebuild it
+        num_rows_to_skip = (
+            self.resume_shuffle_buffer(num_rows_read)
+            if use_shuffle_buffer and num_rows_read > 0
+            else num_rows_read
+        )
+        self.num_rows_read = num_rows_to_skip
+        # Iterators that support it only read the features that will be kept.
+        self.data_iterator.update_features_to_consider(
+            self.dataset_config.get("features_to_consider", None) or []
+        )
         self.data_iterator = (
-            # here we use global_dataloader_worker_id as the seed for shuffling
-            # this doesn't matter for the case where workers have non-overlapping files
-            # but it does matter for the case where workers have all files
-            # (e.g. when using assign_all_files_per_worker)
-            # the same seed is used for all workers would cause duplicated examples returned by different workers
-            self.data_iterator.shuffle(seed=self.global_dataloader_worker_id)
+            # the seed depends on the worker and the epoch (see get_shuffle_seed)
+            self.data_iterator.shuffle(seed=self.get_shuffle_seed())
             if self.should_shuffle_rows
             else self.data_iterator
         )
         self.data_iterator.should_shuffle_rows = self.should_shuffle_rows
         # We provide the flexibility to iterate per row, if per row preprocessing is needed, or per batch.
-        self.dataset_to_iterate = (
-            self.data_iterator.iterrows()
-            if self.dataset_config.iterate_per_row
-            else self.data_iterator.iter_batches(self.batch_size)
-        )
+        if self.dataset_config.iterate_per_row:
+            # the iterator skips the rows before parsing them
+            self.data_iterator.set_num_rows_to_skip(num_rows_to_skip)
+            self.dataset_to_iterate = self.data_iterator.iterrows()
+        else:
+            self.dataset_to_iterate = islice(
+                self.data_iterator.iter_batches(self.batch_size), num_rows_to_skip, None
+            )
+        self.dataset_to_iterate = self.count_rows_read(self.dataset_to_iterate)
+        if use_shuffle_buffer:
+            self.dataset_to_iterate = self.shuffle_with_buffer(
+                self.dataset_to_iterate,
+                seed=self.get_shuffle_seed(),
+                num_rows_read=num_rows_read,
+                num_rows_shuffled=num_rows_shuffled,
+            )
 
         command_line_logger.debug(
             f"GLOBAL ID {self.global_dataloader_worker_id} GPU Worker: {self.global_worker_id}/{self.total_workers} with {len(self.data_iterator.list_of_file_paths)} files\
@@ -140,24 +385,110 @@ class UnboundedSequenceIterable(BaseDataset, IterableDataset):
         # If the dataset is for training, we want to keep iterating over the dataset infinitely.
         # On a streaming dataset, we will always be on Epoch 0.
         finished_iteration = False
+        profile_interval = self.dataset_config.get("preprocessing_profile_interval", 0)
         while not finished_iteration:
 
             for row_or_batch in self.dataset_to_iterate:
-                for (
-                    preprocessing_function
-                ) in self.dataset_config.preprocessing_functions:
-                    row_or_batch = preprocessing_function(
-                        row_or_batch, dataset_config=self.dataset_config
+                if profile_interval > 0 or self.data_loading_stats is not None:
+                    row_or_batch = self.apply_preprocessing_functions_with_timing(
+                        row_or_batch, profile_interval
                     )
-                    if row_or_batch is None:
-                        break
+                else:
+                    for (
+                        preprocessing_function
+                    ) in self.dataset_config.preprocessing_functions:
+                        row_or_batch = preprocessing_function(
+                            row_or_batch, dataset_config=self.dataset_config
+                        )
+                        if row_or_batch is None:
+                            break
                 if row_or_batch:
+                    self.num_rows_yielded += 1
+                    self.record_cursor()
+                    self.record_metrics()
                     yield row_or_batch
             # if the dataset is not for training, we stop the loop. Otherwise, we continue.
             finished_iteration = not self.is_for_training
             if not finished_iteration:
+                self.epoch += 1
                 self.setup()
         # We reset the dataset to iterate to None, so that it is set up again in the next iteration.
         # This is required for validation when persitent_workers = True.
         self.dataset_to_iterate = None
-        return None
\ No newline at end of file
+        return None
+
+    def get_preprocessing_function_names(self) -> List[str]:
+        # the preprocessing functions are usually partials
+        return [
+            f"{index}_"
+            + getattr(getattr(function, "func", function), "__name__", "")
+            for index, function in enumerate(self.dataset_config.preprocessing_functions)
+        ]
+
+    def enable_metrics_tracking(self, num_workers: int):
+        """Make every dataloader worker report its data loading statistics in shared memory,
+        so they can be logged by the main process (see DataLoadingMonitor).
+
+        Each row of data_loading_stats holds the statistics of a worker: the number of rows
+        yielded, the wall time of the last update, the time spent in the collate function, the
+        number of collated batches, and then the time spent in each preprocessing function.
+        Times are in seconds and cumulative.
+        """
+        self.data_loading_stats = torch.zeros(
+            (
+                max(1, num_workers),
+                DATA_LOADING_STATS_NUM_COLUMNS
+                + len(self.dataset_config.preprocessing_functions),
+            ),
+            dtype=torch.float64,
+        ).share_memory_()
+
+    def apply_preprocessing_functions_with_timing(
+        self, row_or_batch: Any, profile_interval: int
+    ):
+        """Apply the preprocessing functions while timing each of them. If profile_interval is
+        positive, the average time per row (or batch) of each function is logged every
+        profile_interval rows."""
+        if self.preprocessing_times is None:
+            self.preprocessing_times = [0.0] * len(
+                self.dataset_config.preprocessing_functions
+            )
+            self.num_profiled = 0
+        for index, preprocessing_function in enumerate(
+            self.dataset_config.preprocessing_functions
+        ):
+            start_time = time.perf_counter()
+            row_or_batch = preprocessing_function(
+                row_or_batch, dataset_config=self.dataset_config
+            )
+            self.preprocessing_times[index] += time.perf_counter() - start_time
+            if row_or_batch is None:
+                break
+        self.num_profiled += 1
+
+        if profile_interval > 0 and self.num_profiled % profile_interval == 0:
+            average_times = ", ".join(
+                f"{name}: {1e6 * total_time / self.num_profiled:.1f}us"
+                for name, total_time in zip(
+                    self.get_preprocessing_function_names(), self.preprocessing_times
+                )
+            )
+            all_ranks_logger.info(
+                f"Worker {self.global_dataloader_worker_id} preprocessing time per "
+                f"example over {self.num_profiled} examples: {average_times}"
+            )
+        return row_or_batch
+
+    def record_metrics(self):
+        """Report the statistics of this worker once per batch, see enable_metrics_tracking."""
+        if (
+            self.data_loading_stats is None
+            or self.num_rows_yielded % self.num_rows_per_batch != 0
+        ):
+            return
+        worker_stats = self.data_loading_stats[self.worker_id]
+        worker_stats[0] = self.num_rows_yielded
+        worker_stats[1] = time.time()
+        worker_stats[DATA_LOADING_STATS_NUM_COLUMNS:] = torch.tensor(
+            self.preprocessing_times, dtype=torch.float64
+        )
@@ -7,6 +7,7 @@ import transformers
 from torch.utils.data import IterableDataset
 
 from src.data.loading.components.iterators import RawDataIterator
+from src.utils.tensor_utils import compact_integer_tensor
 
 
 class BaseDatasetConfig:
@@ -67,6 +68,9 @@ class SequenceDatasetConfig(BaseDatasetConfig):
         For example, if the data iterator reads tfrecord files at the first level of the data_folder,
         this can be set to "tfrecord.gz". If we want to retrieve all tfrecord files in subdirectories as well,
         we can set it to "*/*tfrecord.gz".
+    preprocessing_profile_interval: int
+        If positive, every dataloader worker logs the average time spent in each preprocessing
+        function every preprocessing_profile_interval rows (or batches). 0 disables it.
     """
 
     user_id_field: str
@@ -80,6 +84,7 @@ class SequenceDatasetConfig(BaseDatasetConfig):
     feature_map: Optional[dict] = None
     features_to_consider: list[str] = field(default_factory=list)
     file_format: str = None
+    preprocessing_profile_interval: int = 0
 
 
 @dataclass
@@ -130,6 +135,31 @@ class SequenceDataloaderConfig(BaseDataloaderConfig):
         Whether to assign all files to each worker.
         (NOTE: this should only be activated for training, not for evaluation,
         as it will cause the workers to have overlapping files.)
+    seed: int = None
+        Base seed for shuffling, combined with the worker id and the epoch.
+    shuffle_buffer_size: int = 0
+        Number of rows the dataset shuffles over when should_shuffle_rows is
+        True. 0 disables the buffer.
+    prefetch_to_device: bool = False
+        Whether to collate and pin the next batches in a background thread and
+        copy the next batch to the device on a side CUDA stream while the
+        current batch is used.
+    num_batches_to_prefetch: int = 2
+        The number of batches collated ahead when prefetch_to_device is True.
+    shared_preprocessing_num_producers: int = 0
+        If above 0, the data of all the GPUs of a node is decoded, preprocessed
+        and collated by this many processes shared by the GPUs, instead of by
+        num_workers workers per GPU (see SharedPreprocessingLoader). Each file
+        of the node is then read once, even with assign_all_files_per_worker.
+    shared_preprocessing_buffer_size: int = 8
+        The number of batches each preprocessing process may have ready for
+        each GPU.
+    shared_preprocessing_dir: str = "/dev/shm"
+        The directory of the shared buffer of collated batches.
+    track_data_loading_metrics: bool = False
+        Whether the training dataloader workers record their data loading statistics
+        (rows yielded, preprocessing and collate times) for DataLoadingMonitor. The
+        timing adds a small cost per row, so it is off unless the monitor is used.
     """
 
     dataset_class: IterableDataset
@@ -151,6 +181,13 @@ class SequenceDataloaderConfig(BaseDataloaderConfig):
     timeout: int = 0
     assign_all_files_per_worker: bool = False
     seed: int = None
+    shuffle_buffer_size: int = 0
+    prefetch_to_device: bool = False
+    num_batches_to_prefetch: int = 2
+    shared_preprocessing_num_producers: int = 0
+    shared_preprocessing_buffer_size: int = 8
+    shared_preprocessing_dir: str = "/dev/shm"
+    track_data_loading_metrics: bool = False
 
 
 @dataclass
@@ -209,6 +246,14 @@ class SequentialModelInputData:
     mask: torch.Tensor
         The mask for the sequence data.
         (batch_size_per_device x sequence length)
+    segment_ids: Optional[torch.Tensor]
+        Only set for packed sequences. The id (starting at 1, unique in the batch) of the
+        original sequence each token belongs to, 0 for padding. Segment i corresponds to
+        row i - 1 of the labels and of the non-packed fields.
+        (number of packed rows x packed sequence length)
+    num_segments: Optional[int]
+        Only set for packed sequences. The number of original sequences in the batch,
+        including the ones without valid tokens, which have no token in segment_ids.
     """
 
     user_id_list: Union[torch.Tensor, List[str], None] = None
@@ -216,6 +261,37 @@ class SequentialModelInputData:
     mask: torch.Tensor = (
         None  # Single mask if needed as all sequences are padded the same way.
     )
+    segment_ids: Optional[torch.Tensor] = None
+    num_segments: Optional[int] = None
+
+
+@dataclass
+class RaggedSequenceData:
+    """Compact ragged representation of a batch of variable length sequences, used to ship
+    batches from the dataloader workers to the device without padding. The padding, trimming,
+    masking and label construction then happen on the device (see
+    collate_functions.collate_ragged_sequences_on_device).
+
+    Parameters
+    ----------
+    values: Dict[str, torch.Tensor]
+        Dictionary of sequence_name to the int32 tokens of all rows concatenated.
+        (total number of tokens,)
+    offsets: Dict[str, torch.Tensor]
+        Dictionary of sequence_name to int32 row offsets, row i of the batch is
+        values[offsets[i]:offsets[i + 1]].
+        (batch_size_per_device + 1,)
+    """
+
+    values: Dict[str, torch.Tensor] = field(default_factory=dict)
+    offsets: Dict[str, torch.Tensor] = field(default_factory=dict)
+
+    def pin_memory(self) -> "RaggedSequenceData":
+        """Called by the DataLoader when pin_memory is set."""
+        return RaggedSequenceData(
+            values={k: v.pin_memory() for k, v in self.values.items()},
+            offsets={k: v.pin_memory() for k, v in self.offsets.items()},
+        )
 
 
 @dataclass
@@ -230,13 +306,39 @@ class SemanticIDDatasetConfig(SequenceDatasetConfig):
     -----------
     semantic_id_map: Optional[Dict[str, torch.Tensor]]
         The semantic id map from field name to a 2-D tensor.
+    transposed_semantic_id_map: Optional[Dict[str, torch.Tensor]]
+        The contiguous N x D transposes of the semantic id maps, looked up by
+        map_sparse_id_to_semantic_id. They should be loaded once per host with
+        load_tensor_to_shared_memory(transpose=True, compact=True), so that every process
+        maps the same pages. The fields missing from it are transposed in each process.
     keep_user_id: bool
         Whether to keep the user id in the dataset. If set to True, the user id
         will be included in the dataset and can be used for inference or evaluation.
+    compact_semantic_ids: bool
+        Whether to store the semantic ids in the smallest integer dtype (int16 or int32)
+        that holds the values of the semantic id map. The semantic ids then stay compact
+        through collation and the transfer to the device, and are only widened to int64
+        before the embedding lookup of the model.
     """
 
     semantic_id_map: Optional[Dict[str, torch.Tensor]] = None
+    transposed_semantic_id_map: Optional[Dict[str, torch.Tensor]] = None
     keep_user_id: bool = False
+    compact_semantic_ids: bool = True
+
+    def __post_init__(self):
+        # The semantic id maps are D x N. We look up a contiguous N x D copy so that the
+        # semantic ids of a sequence are contiguous rows. The copies that are not given
+        # (shared between processes) are created here, in each process.
+        self.transposed_semantic_id_map = dict(self.transposed_semantic_id_map or {})
+        for k, v in (self.semantic_id_map or {}).items():
+            if not isinstance(v, torch.Tensor) or k in self.transposed_semantic_id_map:
+                continue
+            transposed_id_map = v.t().contiguous()
+            if self.compact_semantic_ids:
+                # -1 is kept representable as it is a common padding token
+                transposed_id_map = compact_integer_tensor(transposed_id_map)
+            self.transposed_semantic_id_map[k] = transposed_id_map
 
 
 @dataclass
@@ -259,6 +361,9 @@ class TokenizerConfig:
         Whether to add special tokens.
     postprocess_eos_token: Optional[bool]
         Whether to postprocess the eos token.
+    is_tokenizer_prepared: bool
+        Whether the special tokens and the eos post-processor were already added to the
+        tokenizer (see get_prepared_tokenizer). Not an argument.
     """
 
     tokenizer: transformers.PreTrainedTokenizer
@@ -268,6 +373,7 @@ class TokenizerConfig:
     special_tokens: Optional[Dict[str, str]] = field(default_factory=dict)
     add_special_tokens: bool = True
     postprocess_eos_token: Optional[bool] = False
+    is_tokenizer_prepared: bool = field(default=False, init=False, repr=False)
 
 
 @dataclass
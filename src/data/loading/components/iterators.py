@@ -1,8 +1,13 @@
 import os
 import random
+import threading
 from abc import ABC, abstractmethod
-from typing import Callable, Dict, List
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
 
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 from src.utils.decorators import retry
 from src.utils.file_utils import open_pyarrow_file
@@ -32,10 +37,39 @@ class RawDataIterator(ABC):
     ):
         self.list_of_file_paths = None
         self.should_shuffle_rows = None
+        self.shard_id = 0
+        self.num_shards = 1
+        self.num_rows_to_skip = 0
 
     def update_list_of_file_paths(self, list_of_file_paths: List[str]):
         self.list_of_file_paths = list_of_file_paths
 
+    @property
+    def shards_within_files(self) -> bool:
+        """Whether the iterator splits the work inside files (see set_shard). If so, every
+        dataloader worker receives all files and reads only its shard of them."""
+        return False
+
+    def set_shard(self, shard_id: int, num_shards: int):
+        """Set which of the num_shards parts of the files this iterator reads. Only used
+        by iterators that shard within files."""
+        self.shard_id = shard_id
+        self.num_shards = num_shards
+
+    def get_num_records(self, file_path: str) -> Optional[int]:
+        """Get the number of records of a file if it can be known without reading the file."""
+        return None
+
+    def set_num_rows_to_skip(self, num_rows_to_skip: int):
+        """Skip the first num_rows_to_skip rows of the next call to iterrows, e.g. to resume
+        reading where a checkpoint stopped. The rows are skipped before being parsed."""
+        self.num_rows_to_skip = num_rows_to_skip
+
+    def update_features_to_consider(self, features_to_consider: List[str]):
+        """Iterators that can read a subset of the columns override this to only read the
+        features that the dataset will keep."""
+        pass
+
     @abstractmethod
     def get_file_suffix(self) -> str:
         raise NotImplementedError("Must be implemented in child classes")
@@ -62,41 +96,184 @@ class RawDataIterator(ABC):
 class ParquetDataIterator(RawDataIterator):
     """Data iterator class for parquet files
 
+    The files are read one row group at a time. A background thread decodes the next
+    num_row_groups_to_prefetch row groups while the current one is consumed.
+
     Parameters
     ----------
-    list_of_file_paths : List[str]
-        the list of file paths to read from
+    buffer_size : int
+        the number of rows decoded at once when iterating per row
+    features_to_consider : List[str]
+        the columns to read. If empty, the features_to_consider of the dataset config are used,
+        and if those are empty too, all columns are read.
+    should_shard_row_groups : bool
+        if True, every dataloader worker (across all DDP ranks) receives all files and reads
+        every num_shards-th row group of them, so a few large files still keep all workers busy.
+    num_row_groups_to_prefetch : int
+        the number of row groups decoded ahead of the one being consumed.
     """
 
-    def __init__(self, buffer_size=1000, features_to_consider=[], *args, **kwargs):
+    def __init__(
+        self,
+        buffer_size=1000,
+        features_to_consider=[],
+        should_shard_row_groups: bool = False,
+        num_row_groups_to_prefetch: int = 1,
+        *args,
+        **kwargs,
+    ):
         super().__init__(*args, **kwargs)
         self.buffer_size = buffer_size
         self.features_to_consider = features_to_consider
+        self.should_shard_row_groups = should_shard_row_groups
+        self.num_row_groups_to_prefetch = num_row_groups_to_prefetch
+        self.shuffle_seed = None
+        # the last file opened by each thread (the main thread and the prefetch thread), as
+        # (file path, file handle, ParquetFile), consecutive row groups of the same file reuse it
+        self._open_files: Dict[int, Tuple[str, pa.NativeFile, pq.ParquetFile]] = {}
+
+    @property
+    def shards_within_files(self) -> bool:
+        return self.should_shard_row_groups
+
+    def get_num_records(self, file_path: str) -> Optional[int]:
+        # only the footer of the file is read
+        with open_pyarrow_file(file_path) as f:
+            return pq.ParquetFile(f).metadata.num_rows
+
+    def update_features_to_consider(self, features_to_consider: List[str]):
+        if not len(self.features_to_consider):
+            self.features_to_consider = list(features_to_consider)
 
     def iterrows(self):
         assert self.list_of_file_paths is not None, "list_of_file_paths is not set"
 
-        for batch in self.iter_batches(batch_size=self.buffer_size):
+        num_rows_to_skip = self.num_rows_to_skip
+        self.num_rows_to_skip = 0
+        for batch in self.iter_batches(
+            batch_size=self.buffer_size, num_rows_to_skip=num_rows_to_skip
+        ):
             for row in batch.to_pylist():
                 yield row
 
-    def iter_batches(self, batch_size: int) -> Dict[str, tf.Tensor]:  # type: ignore
+    def _get_parquet_file(self, file_path: str) -> pq.ParquetFile:
+        """Get the ParquetFile of file_path opened by the calling thread. The file and its
+        footer are only read again when the thread moves to another file."""
+        thread_id = threading.get_ident()
+        open_file = self._open_files.get(thread_id)
+        if open_file is not None and open_file[0] == file_path:
+            return open_file[2]
+        self._close_parquet_file()
+        file_handle = open_pyarrow_file(file_path)
+        try:
+            parquet_file = pq.ParquetFile(file_handle)
+        except Exception:
+            file_handle.close()
+            raise
+        self._open_files[thread_id] = (file_path, file_handle, parquet_file)
+        return parquet_file
+
+    def _close_parquet_file(self):
+        """Close the file opened by the calling thread."""
+        open_file = self._open_files.pop(threading.get_ident(), None)
+        if open_file is not None:
+            open_file[1].close()
+
+    def _list_row_groups(self) -> List[Tuple[str, int]]:
+        """List the (file path, row group index) pairs this iterator reads, in reading order."""
+        if not self.should_shard_row_groups:
+            return [
+                (file_path, row_group)
+                for file_path in self.list_of_file_paths
+                for row_group in range(
+                    self._get_parquet_file(file_path).num_row_groups
+                )
+            ]
+
+        # every shard enumerates the row groups in the same order, so the shards are disjoint
+        all_row_groups = [
+            (file_path, row_group)
+            for file_path in sorted(self.list_of_file_paths)
+            for row_group in range(self._get_parquet_file(file_path).num_row_groups)
+        ]
+        row_groups = all_row_groups[self.shard_id :: self.num_shards]
+        if self.should_shuffle_rows:
+            random.Random(self.shuffle_seed).shuffle(row_groups)
+        return row_groups
+
+    @retry()
+    def _read_row_group(
+        self, file_path: str, row_group: int, batch_size: int
+    ) -> List[pa.RecordBatch]:
+        try:
+            parquet_file = self._get_parquet_file(file_path)
+            # only read the requested columns that exist in the file
+            columns = [
+                column
+                for column in self.features_to_consider
+                if column in parquet_file.schema_arrow.names
+            ]
+            table = parquet_file.read_row_group(
+                row_group, columns=columns if len(columns) else None
+            )
+        except Exception:
+            # the handle may be broken, the retry opens the file again
+            self._close_parquet_file()
+            raise
+        return table.to_batches(max_chunksize=batch_size)
+
+    def iter_batches(
+        self, batch_size: int, num_rows_to_skip: int = 0
+    ) -> Dict[str, tf.Tensor]:  # type: ignore
         assert self.list_of_file_paths is not None, "list_of_file_paths is not set"
-        for file_path in self.list_of_file_paths:
-            with open_pyarrow_file(file_path) as f:
-                parquet_file = pq.ParquetFile(f)
-
-                for batch in parquet_file.iter_batches(
-                    columns=self.features_to_consider
-                    if len(self.features_to_consider)
-                    else None,
-                    batch_size=batch_size,
-                ):
-                    yield batch
+        row_groups = self._list_row_groups()
+
+        # whole row groups are skipped using the metadata, without reading them
+        while num_rows_to_skip > 0 and len(row_groups):
+            file_path, row_group = row_groups[0]
+            row_group_num_rows = (
+                self._get_parquet_file(file_path).metadata.row_group(row_group).num_rows
+            )
+            if row_group_num_rows > num_rows_to_skip:
+                break
+            num_rows_to_skip -= row_group_num_rows
+            row_groups = row_groups[1:]
+
+        for batch in self._iter_row_group_batches(row_groups, batch_size):
+            if num_rows_to_skip >= batch.num_rows:
+                num_rows_to_skip -= batch.num_rows
+                continue
+            if num_rows_to_skip > 0:
+                batch = batch.slice(num_rows_to_skip)
+                num_rows_to_skip = 0
+            yield batch
+
+    def _iter_row_group_batches(
+        self, row_groups: List[Tuple[str, int]], batch_size: int
+    ):
+        # a single thread decodes row groups in order, pyarrow releases the GIL while decoding.
+        # It reads through its own file handle, the main thread only reads the metadata.
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            try:
+                pending_row_groups = deque()
+                for file_path, row_group in row_groups:
+                    pending_row_groups.append(
+                        executor.submit(
+                            self._read_row_group, file_path, row_group, batch_size
+                        )
+                    )
+                    if len(pending_row_groups) > self.num_row_groups_to_prefetch:
+                        yield from pending_row_groups.popleft().result()
+                while pending_row_groups:
+                    yield from pending_row_groups.popleft().result()
+            finally:
+                executor.submit(self._close_parquet_file).result()
+                self._close_parquet_file()
 
     def shuffle(self, seed=42) -> RawDataIterator:
         random.seed(seed)
         random.shuffle(self.list_of_file_paths)  # type: ignore
+        self.shuffle_seed = seed
         return self
 
     def get_file_suffix(self) -> str:
@@ -112,6 +289,17 @@ class TFRecordIterator(RawDataIterator):
         A list of tensorflow functions to apply to the batches.
     should_drop_last_batch: bool
         Whether to drop the last batch if it is not a multiple of the batch size.
+    seed: int
+        The seed used to shuffle the records if shuffle was not called with a seed.
+    shuffle_buffer_size: int
+        The number of records tensorflow shuffles over. 0 disables the shuffling of records here,
+        e.g. when the dataset already shuffles rows with its own buffer.
+    should_shard_rows: bool
+        If True, every dataloader worker (across all DDP ranks) receives all files and reads
+        its shard of them. If there are at least as many files as workers, the files are
+        split between the workers, so each file is decompressed once. Otherwise every worker
+        keeps every num_shards-th record of all files, and records are decompressed by every
+        worker, since gzip files cannot be split.
     """
 
     def __init__(
@@ -120,6 +308,8 @@ class TFRecordIterator(RawDataIterator):
         batch_tf_processing_functions: List[Callable] = [],
         should_drop_last_batch: bool = True,
         seed: int = None,
+        shuffle_buffer_size: int = 128,
+        should_shard_rows: bool = False,
         **kwargs,
     ):
         super().__init__(**kwargs)
@@ -128,6 +318,47 @@ class TFRecordIterator(RawDataIterator):
         self.batch_tf_processing_functions = batch_tf_processing_functions
         self.should_drop_last_batch = should_drop_last_batch
         self.seed = seed
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.should_shard_rows = should_shard_rows
+        self.shuffle_seed = None
+
+    @property
+    def shards_within_files(self) -> bool:
+        return self.should_shard_rows
+
+    def get_raw_dataset(self) -> tf.data.TFRecordDataset:
+        """Create the record dataset of the files, sharded and shuffled if needed."""
+        if self.should_shard_rows and len(self.list_of_file_paths) >= self.num_shards:
+            # every shard must split the files in the same order so the shards are disjoint,
+            # the files of the shard are then read in the (shuffled) order of the list
+            shard_file_paths = set(
+                sorted(self.list_of_file_paths)[self.shard_id :: self.num_shards]
+            )
+            raw_dataset = tf.data.TFRecordDataset(
+                [path for path in self.list_of_file_paths if path in shard_file_paths],
+                compression_type="GZIP",
+            )
+        elif self.should_shard_rows:
+            # every shard must see the records in the same order so the shards are disjoint
+            raw_dataset = tf.data.TFRecordDataset(
+                sorted(self.list_of_file_paths), compression_type="GZIP"
+            ).shard(num_shards=self.num_shards, index=self.shard_id)
+        else:
+            raw_dataset = tf.data.TFRecordDataset(
+                self.list_of_file_paths, compression_type="GZIP"
+            )
+
+        if self.should_shuffle_rows and self.shuffle_buffer_size > 0:
+            # the buffer here is the number of records to shuffle
+            # the larger the buffer, the more memory it will use
+            # too large might cause OOM
+            # the seed changes every epoch, so we don't need tensorflow to reshuffle
+            raw_dataset = raw_dataset.shuffle(
+                buffer_size=self.shuffle_buffer_size,
+                seed=self.shuffle_seed if self.shuffle_seed is not None else self.seed,
+                reshuffle_each_iteration=False,
+            )
+        return raw_dataset
 
     def initialize_feature_description(self, raw_dataset: tf.data.TFRecordDataset):
         """
@@ -142,17 +373,13 @@ class TFRecordIterator(RawDataIterator):
 
     def iterrows(self):
         assert self.list_of_file_paths is not None, "list_of_file_paths is not set"
-        raw_dataset = tf.data.TFRecordDataset(
-            [self.list_of_file_paths], compression_type="GZIP"
-        )
-        if self.should_shuffle_rows:
-            # the buffer here is the number of records to shuffle
-            # the larger the buffer, the more memory it will use
-            # too large might cause OOM
-            # Use fixed seed for reproducible shuffling
-            raw_dataset = raw_dataset.shuffle(buffer_size=128, seed=self.seed, reshuffle_each_iteration=False)
+        raw_dataset = self.get_raw_dataset()
 
         self.initialize_feature_description(raw_dataset)
+        if self.num_rows_to_skip > 0:
+            # the skipped records are not parsed
+            raw_dataset = raw_dataset.skip(self.num_rows_to_skip)
+            self.num_rows_to_skip = 0
         # We create an iterator and manually iterate to allow for retrying the
         # "next" operation in case of a failure.
         dataset_iterator = iter(raw_dataset)
@@ -164,17 +391,7 @@ class TFRecordIterator(RawDataIterator):
 
     def iter_batches(self, batch_size: int) -> Dict[str, tf.Tensor]:  # type: ignore
         assert self.list_of_file_paths is not None, "list_of_file_paths is not set"
-        raw_dataset = tf.data.TFRecordDataset(
-            self.list_of_file_paths, compression_type="GZIP"
-        )
-
-        if self.should_shuffle_rows:
-            # the buffer here is the number of records to shuffle
-            # the larger the buffer, the more memory it will use
-            # too large might cause OOM
-            # Use fixed seed for reproducible shuffling
-            # raw_dataset = raw_dataset.shuffle(buffer_size=128)
-            raw_dataset = raw_dataset.shuffle(buffer_size=128, seed=self.seed, reshuffle_each_iteration=False)
+        raw_dataset = self.get_raw_dataset()
 
         self.initialize_feature_description(raw_dataset)
         # to avoid the issues with tf record warnings, we drop the last instances
@@ -223,10 +440,11 @@ class TFRecordIterator(RawDataIterator):
         return example
 
     def shuffle(self, seed=42) -> RawDataIterator:
-        # TODO(lneves): Unify the shuffle method for all iterators
-        # Currently this one shuffles only files, parquet shuffles rows.
+        # Like the parquet iterator, this shuffles the file order. Rows are shuffled
+        # by the tensorflow buffer above and/or the shuffle buffer of the dataset.
         random.seed(seed)
         random.shuffle(self.list_of_file_paths)  # type: ignore
+        self.shuffle_seed = seed
         return self
 
     def get_file_suffix(self) -> str:
@@ -159,7 +159,9 @@ class NextKTokenMasking(LabelFunction):
         label_start_indices = unpadded_seq_lengths - self.next_k  # shape: (batch_size,)
 
         # for each row, we select [label_start_indices, label_start_indices + 1, ..., label_start_indices + next_k - 1]
-        label_col_offset = torch.arange(self.next_k)  # shape: (next_k,)
+        label_col_offset = torch.arange(
+            self.next_k, device=sequence.device
+        )  # shape: (next_k,)
         label_col_indices = (
             label_start_indices.unsqueeze(1) + label_col_offset
         )  # shape: (batch_size, next_k)
@@ -168,7 +170,9 @@ class NextKTokenMasking(LabelFunction):
         )  # shape: (batch_size * next_k,)
 
         # To get the row indices, we repeat each row index next_k times
-        row_orig_indices = torch.arange(sequence.size(0))  # shape: (batch_size,)
+        row_orig_indices = torch.arange(
+            sequence.size(0), device=sequence.device
+        )  # shape: (batch_size,)
         row_interleaved_indices = row_orig_indices.repeat_interleave(
             self.next_k
         )  # shape: (batch_size * next_k,)
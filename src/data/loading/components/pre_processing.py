@@ -1,4 +1,5 @@
-from typing import Any, Dict, List, Optional, Union
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 import numpy as np
 import tensorflow as tf
@@ -10,7 +11,8 @@ from src.data.loading.components.interfaces import (
 )
 
 from src.data.loading.components.interfaces import TokenizerConfig
-from src.utils.utils import load_tokenize
+from src.utils.tensor_utils import gather_rows
+from src.utils.utils import load_batch_tokenize, load_tokenize
 
 # support functions
 
@@ -67,6 +69,39 @@ def convert_to_dense_numpy_array(
     return batch_or_row
 
 
+def convert_sparse_to_tensors(
+    batch_or_row: Dict[str, tf.Tensor],
+    dataset_config: BaseDatasetConfig,
+    features_to_apply: Optional[List[str]] = [],
+    **kwargs,
+) -> Dict[str, Any]:
+    # Transform a tfrecord example to a dictionary of torch tensors in a single step. This replaces
+    # convert_to_dense_numpy_array followed by convert_fields_to_tensors.
+    # For a row, the values of a sparse tensor are already the dense sequence, so we skip
+    # to_dense and share the numpy memory with torch. Text features are kept as numpy arrays.
+    for k, v in batch_or_row.items():
+        if is_feature_in_features_to_apply(features_to_apply, k):
+            if isinstance(v, tf.SparseTensor):
+                array = (
+                    v.values.numpy()
+                    if v.shape.rank == 1
+                    else tf.sparse.to_dense(v).numpy()
+                )
+            else:
+                array = v.numpy()
+            if array.dtype.kind in ("S", "U", "O"):
+                batch_or_row[k] = array
+                continue
+            dtype = dataset_config.field_type_map.get(k, torch.long)  # type: ignore
+            if array.flags.writeable:
+                tensor = torch.from_numpy(array)
+            else:
+                tensor = torch.tensor(array)
+            # only copies if the dtype of the file differs from the expected one
+            batch_or_row[k] = tensor.to(dtype)
+    return batch_or_row
+
+
 def map_feature_names(
     batch_or_row: Dict[str, np.ndarray],
     dataset_config: BaseDatasetConfig,
@@ -129,21 +164,27 @@ def map_sparse_id_to_semantic_id(
     based on the id_map in the dataset config.
     """
 
+    transposed_semantic_id_map = getattr(
+        dataset_config, "transposed_semantic_id_map", {}
+    )
     for k, v in row.items():
         if is_feature_in_features_to_apply(features_to_apply, k):
-            id_map: torch.Tensor = dataset_config.semantic_id_map.get(k, None)
-            # id_map is a D x N tensor
+            # transposed_id_map is a contiguous N x D tensor
             # where N is the number of unique items in the dataset
             # and D is the number of hierarchies (semantic id digits)
-            if id_map is not None:
+            transposed_id_map: torch.Tensor = transposed_semantic_id_map.get(k, None)
+            if transposed_id_map is None:
+                id_map: torch.Tensor = dataset_config.semantic_id_map.get(k, None)
+                transposed_id_map = id_map.t() if id_map is not None else None
+            if transposed_id_map is not None:
                 # flatten the semantic id sequence
                 if num_hierarchies is None:
-                    row[k] = id_map.t()[v].view(-1)
+                    row[k] = transposed_id_map[v].reshape(-1)
                 else:
-                    assert num_hierarchies <= id_map.size(
-                        0
+                    assert num_hierarchies <= transposed_id_map.size(
+                        1
                     ), "num_hierarchies must be less than or equal to the number of hierarchies in the semantic id map."
-                    row[k] = id_map[:num_hierarchies].t()[v].view(-1)
+                    row[k] = transposed_id_map[v, :num_hierarchies].reshape(-1)
             else:
                 raise ValueError(f"Semantic id map not found for feature {k}")
     return row
@@ -202,18 +243,20 @@ def tokenize_text_features(
     # Tokenize text features. features_to_apply must contain only text features.
     # This works for both rows and batches.
     tokenize = load_tokenize(config=tokenizer_config)
+    batch_tokenize = load_batch_tokenize(config=tokenizer_config)
     batch_or_row_masks = {}
     for k, v in batch_or_row.items():
         if is_feature_in_features_to_apply(features_to_apply, k):
             k_mask = "_".join([k, "mask"])
             if isinstance(v, np.ndarray) or isinstance(v, list):
-                tokenized_seq_list = [tokenize(s) for s in v]
-                batch_or_row[k] = torch.stack(
-                    [seq["input_ids"].flatten() for seq in tokenized_seq_list]
-                )  # seq_length x token_seq_length x 1
-                batch_or_row_masks[k_mask] = torch.stack(
-                    [seq["attention_mask"].flatten() for seq in tokenized_seq_list]
-                )  # seq_length x token_seq_length x 1
+                # all the texts are tokenized in a single call
+                tokenized_seqs = batch_tokenize([str(s) for s in v])
+                batch_or_row[k] = tokenized_seqs[
+                    "input_ids"
+                ]  # seq_length x token_seq_length
+                batch_or_row_masks[k_mask] = tokenized_seqs[
+                    "attention_mask"
+                ]  # seq_length x token_seq_length
             else:
                 tokenized_seq = tokenize(v)
                 batch_or_row[k] = tokenized_seq[
@@ -227,10 +270,39 @@ def tokenize_text_features(
     return batch_or_row
 
 
+@lru_cache(maxsize=None)
+def load_category_lookup(mapping_file: str) -> Tuple[np.ndarray, np.ndarray]:
+    """Load a category to index mapping as a sorted array of categories and the array of their
+    indices, so that a whole array of values can be translated with np.searchsorted.
+    The mapping is loaded once per process (i.e. once per dataloader worker)."""
+    category_to_idx = load_json(mapping_file)
+    categories = np.array(list(category_to_idx.keys()), dtype=str)
+    indices = np.array(list(category_to_idx.values()), dtype=np.int64)
+    order = np.argsort(categories)
+    return categories[order], indices[order]
+
+
+def translate_categories_to_indices(
+    values: np.ndarray,
+    categories: np.ndarray,
+    indices: np.ndarray,
+    oov_index: int = 0,
+) -> np.ndarray:
+    """Translate an array of categories to their indices, categories not in the mapping get oov_index."""
+    values = np.asarray(values).astype(str)
+    if len(categories) == 0:
+        return np.full(values.shape, oov_index, dtype=np.int64)
+    positions = np.searchsorted(categories, values)
+    positions = np.minimum(positions, len(categories) - 1)
+    is_found = categories[positions] == values
+    return np.where(is_found, indices[positions], oov_index)
+
+
 def preprocess_categorical_feature_to_idx(
     batch_or_row: Dict[str, Any],
     features_to_apply: Optional[List[str]] = [],
     mapping_file: Optional[str] = "",
+    oov_index: int = 0,
     **kwargs,
 ) -> Dict[str, Any]:
     # Translate categorical features to indices by looking at the mapping provided.
@@ -239,29 +311,50 @@ def preprocess_categorical_feature_to_idx(
 
     # Load the mapping if a mapping file is provided
     if mapping_file:
-        category_to_idx = load_json(mapping_file)
+        categories, indices = load_category_lookup(mapping_file)
     else:
         raise ValueError("A valid path to the mapping file must be provided.")
 
     # Helper function to translate feature values to index
-    def translate_to_index(value: Union[str, List[str]]) -> Union[int, List[int]]:
-        if isinstance(value, list):
-            return [
-                category_to_idx.get(v, 0) for v in value
-            ]  # Translate each element in the list
-        else:
-            return category_to_idx.get(
-                value, 0
-            )  # Default to 0 (e.g., '<OOV>') if not found
+    def translate_to_index(
+        value: Union[str, List[str], np.ndarray]
+    ) -> Union[int, List[int], np.ndarray]:
+        translated = translate_categories_to_indices(
+            value, categories, indices, oov_index=oov_index
+        )
+        if isinstance(value, np.ndarray):
+            return translated
+        # keep the type of the input for lists and scalars
+        return translated.tolist()
 
     # Determine if we are handling a single row or a batch of rows
     is_batch = isinstance(batch_or_row, list)
     # Apply the mapping to the appropriate features
     if is_batch:
-        for row in batch_or_row:
-            for feature in features_to_apply:
-                if feature in row:
-                    row[feature] = translate_to_index(row[feature])
+        for feature in features_to_apply:
+            rows_with_feature = [row for row in batch_or_row if feature in row]
+            if not rows_with_feature:
+                continue
+            # we translate the values of all rows at once and split them back per row
+            row_values = [
+                np.asarray(row[feature]).reshape(-1) for row in rows_with_feature
+            ]
+            translated = translate_categories_to_indices(
+                np.concatenate(row_values),
+                categories,
+                indices,
+                oov_index=oov_index,
+            )
+            row_translations = np.split(
+                translated, np.cumsum([len(v) for v in row_values])[:-1]
+            )
+            for row, row_translation in zip(rows_with_feature, row_translations):
+                if isinstance(row[feature], np.ndarray):
+                    row[feature] = row_translation.reshape(row[feature].shape)
+                elif isinstance(row[feature], list):
+                    row[feature] = row_translation.tolist()
+                else:
+                    row[feature] = row_translation.item()
     else:
         for feature in features_to_apply:
             if feature in batch_or_row:
@@ -270,7 +363,6 @@ def preprocess_categorical_feature_to_idx(
     return batch_or_row
 
 
-
 def map_sparse_id_to_embedding(
     row: Dict[str, Any],
     dataset_config = None,
@@ -288,7 +380,14 @@ def map_sparse_id_to_embedding(
     # where N is the number of unique items in the dataset
     # and d is the dimension of the embedding
     if embedding_map is not None:
-        row[embedding_field_to_add] = embedding_map[row[sparse_id_field]].squeeze()
+        # works for rows and batches, the rows of a batch are read in sorted order
+        embedding = gather_rows(
+            embedding_map, torch.as_tensor(row[sparse_id_field])
+        ).squeeze()
+        # tables stored in half precision are widened after the lookup
+        if embedding.dtype in (torch.float16, torch.bfloat16):
+            embedding = embedding.float()
+        row[embedding_field_to_add] = embedding
     else:
         raise ValueError(f"Embedding map not found")
     return row
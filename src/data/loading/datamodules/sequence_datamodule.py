@@ -1,16 +1,37 @@
 """Wrapper around a LightningDataModule."""
 
 import logging
+import uuid
 from functools import partial
 from typing import Any, Dict, List, Optional
 
 from lightning import LightningDataModule
 from lightning.pytorch.trainer.states import TrainerFn
+from lightning_utilities.core.apply_func import apply_to_collection
+import torch
 from torch.utils.data import DataLoader
 
-from src.data.loading.components.custom_dataloader import DataloaderWithIterationRetry
-from src.data.loading.components.interfaces import BaseDataloaderConfig
-from src.data.loading.utils import assign_files_to_workers
+from src.data.loading.components.collate_functions import (
+    TimedCollateFunction,
+    WorkerTaggedBatch,
+    WorkerTaggingCollateFunction,
+    collate_ragged_sequences_on_device,
+)
+from src.data.loading.components.custom_dataloader import (
+    DataloaderWithIterationRetry,
+    DevicePrefetchLoader,
+    SharedPreprocessingLoader,
+)
+from src.data.loading.components.dataloading import CURSOR_NUM_COLUMNS
+from src.data.loading.components.interfaces import (
+    BaseDataloaderConfig,
+    RaggedSequenceData,
+)
+from src.data.loading.utils import (
+    assign_files_to_ranks_and_workers,
+    assign_files_to_workers,
+    get_file_weights,
+)
 from src.utils.file_utils import list_files
 
 
@@ -55,6 +76,17 @@ class SequenceDataModule(LightningDataModule):
         }
 
         self.stage_to_file_map: Dict[TrainerFn, Dict[int, List[str]]] = dict()
+        # files of each dataloader worker of each GPU, when assigned per worker
+        self.stage_to_worker_file_map: Dict[
+            TrainerFn, Dict[int, Dict[int, List[str]]]
+        ] = dict()
+        self.stage_to_dataset: Dict[TrainerFn, Any] = dict()
+        self.shared_preprocessing_loaders: List[SharedPreprocessingLoader] = []
+
+        # To resume reading the training data from a checkpoint, we count the training
+        # batches consumed from each dataloader worker (see state_dict).
+        self.train_batches_consumed_per_worker = None
+        self.train_cursors_to_resume = None
 
     def _get_partial_collate_fn(
         self, dataloader_config: BaseDataloaderConfig
@@ -121,6 +153,55 @@ class SequenceDataModule(LightningDataModule):
                     if hasattr(config, "limit_files") and config.limit_files:
                         list_of_files = list_of_files[: config.limit_files]
 
+                    # Iterators that shard within files need every GPU to see all files.
+                    shards_within_files = getattr(
+                        config.dataset_config.data_iterator,
+                        "shards_within_files",
+                        False,
+                    )
+                    assign_all_files_per_worker = (
+                        config.assign_all_files_per_worker
+                        if hasattr(config, "assign_all_files_per_worker")
+                        else False
+                    ) or shards_within_files
+                    num_workers_per_rank = max(1, config.num_workers)
+                    if (
+                        config.assign_files_by_size
+                        and not assign_all_files_per_worker
+                        and num_workers_per_rank > 1
+                        and len(list_of_files)
+                        >= self.trainer.world_size * num_workers_per_rank
+                    ):
+                        # We balance the files across the workers of all GPUs at once.
+                        # The weights read the metadata of every file, so they are computed
+                        # on rank 0 only and broadcast to the other ranks.
+                        file_weights = None
+                        if self.trainer.is_global_zero:
+                            file_weights = get_file_weights(
+                                list_of_files,
+                                get_num_records=config.dataset_config.data_iterator.get_num_records,
+                            )
+                        file_weights = self.trainer.strategy.broadcast(file_weights, src=0)
+                        self.stage_to_worker_file_map[
+                            stage
+                        ] = assign_files_to_ranks_and_workers(
+                            list_of_files=list_of_files,
+                            total_ranks=self.trainer.world_size,
+                            num_workers_per_rank=num_workers_per_rank,
+                            file_weights=file_weights,
+                        )
+                        self.stage_to_file_map[stage] = {
+                            rank: [
+                                file
+                                for worker_files in worker_to_files.values()
+                                for file in worker_files
+                            ]
+                            for rank, worker_to_files in self.stage_to_worker_file_map[
+                                stage
+                            ].items()
+                        }
+                        continue
+
                     self.stage_to_file_map[stage], _ = assign_files_to_workers(
                         list_of_files=list_of_files,
                         total_workers=self.trainer.world_size,
@@ -128,9 +209,7 @@ class SequenceDataModule(LightningDataModule):
                         should_shuffle_rows=config.should_shuffle_rows
                         if hasattr(config, "should_shuffle_rows")
                         else False,
-                        assign_all_files_per_worker=config.assign_all_files_per_worker
-                        if hasattr(config, "assign_all_files_per_worker")
-                        else False,
+                        assign_all_files_per_worker=assign_all_files_per_worker,
                         seed = config.seed
                         if hasattr(config, "seed")
                         else None,
@@ -173,23 +252,42 @@ class SequenceDataModule(LightningDataModule):
             batch_size=curr_config.batch_size_per_device,
             is_for_training=stage == TrainerFn.FITTING,
             assign_all_files_per_worker=assign_all_files_per_worker,
+            shuffle_buffer_size=curr_config.get("shuffle_buffer_size", 0),
+            seed=curr_config.get("seed", None),
         )  # type: ignore
 
+        if curr_config.get("shared_preprocessing_num_producers", 0) > 0:
+            return (self._get_shared_preprocessing_loader(dataset, stage),)  # type: ignore
+
         device_file_list = self.stage_to_file_map[stage].get(
             self.trainer.global_rank, []
         )
 
         dataset.set_list_of_files(list_of_files=device_file_list)
+        dataset.set_worker_file_map(
+            self.stage_to_worker_file_map.get(stage, {}).get(
+                self.trainer.global_rank, None
+            )
+        )
         # set the number of total GPUs and GPU index
         dataset.set_distributed_params(
             total_workers=self.trainer.world_size,
             global_worker_id=self.trainer.global_rank,
         )
+        if stage == TrainerFn.FITTING and hasattr(dataset, "enable_cursor_tracking"):
+            self._setup_train_cursors(dataset, curr_config)
 
         # Any additional parameters for the masking function should be added to
         # the config and passed there. This is required because we can't pickle
         # lambda functions but the collate fn needs to receive just the batch.
         collate_fn_partial = self._get_partial_collate_fn(curr_config)
+        if getattr(dataset, "data_loading_stats", None) is not None:
+            collate_fn_partial = TimedCollateFunction(
+                collate_fn_partial, dataset.data_loading_stats
+            )
+        if getattr(dataset, "cursor_history", None) is not None:
+            # the worker of each batch is counted in on_before_batch_transfer
+            collate_fn_partial = WorkerTaggingCollateFunction(collate_fn_partial)
 
         if curr_config.num_workers == 0:
             persistent_workers = False
@@ -200,22 +298,204 @@ class SequenceDataModule(LightningDataModule):
         else:
             persistent_workers = curr_config.persistent_workers
 
-        return (
-            DataloaderWithIterationRetry(
-                dataset=dataset,
-                batch_size=curr_config.batch_size_per_device
-                if curr_config.dataset_config.iterate_per_row
-                else None,
-                num_workers=curr_config.num_workers,  # num workers per GPU
-                pin_memory=curr_config.pin_memory,
-                persistent_workers=persistent_workers,
-                drop_last=curr_config.drop_last
-                if curr_config.dataset_config.iterate_per_row
-                else False,
-                collate_fn=collate_fn_partial,
-                timeout=curr_config.timeout,
+        prefetch_to_device = curr_config.get("prefetch_to_device", False)
+        dataloader = DataloaderWithIterationRetry(
+            dataset=dataset,
+            batch_size=curr_config.batch_size_per_device
+            if curr_config.dataset_config.iterate_per_row
+            else None,
+            num_workers=curr_config.num_workers,  # num workers per GPU
+            # the prefetch loader pins the batches itself
+            pin_memory=curr_config.pin_memory and not prefetch_to_device,
+            persistent_workers=persistent_workers,
+            drop_last=curr_config.drop_last
+            if curr_config.dataset_config.iterate_per_row
+            else False,
+            collate_fn=collate_fn_partial,
+            timeout=curr_config.timeout,
+        )
+        if prefetch_to_device:
+            dataloader = DevicePrefetchLoader(
+                dataloader,
+                device=self.trainer.strategy.root_device,
+                num_batches_to_prefetch=curr_config.get("num_batches_to_prefetch", 2),
+            )
+        return (dataloader,)  # type: ignore
+
+    def _get_shared_preprocessing_loader(self, dataset: Any, stage: TrainerFn) -> Any:
+        """Construct the loader of a GPU reading from the preprocessing processes shared by
+        the GPUs of its node (see SharedPreprocessingLoader).
+
+        The dataset gets the files of all the GPUs of the node, split across the preprocessing
+        processes, which act as the dataloader workers of the node. The training cursors are
+        not tracked, as the batches of the workers are spread across the GPUs.
+
+        :param dataset: The dataset, not set up yet.
+        :param stage: The stage of the dataloader.
+        :return: The loader of this GPU.
+        """
+        curr_config = self.stage_to_config[stage]
+        num_local_ranks = self.trainer.num_devices
+        num_nodes = max(1, self.trainer.world_size // num_local_ranks)
+        node_rank = self.trainer.global_rank // num_local_ranks
+        # the same file is listed once, even if it was given to every GPU
+        node_file_list = list(
+            dict.fromkeys(
+                file
+                for rank in range(
+                    node_rank * num_local_ranks, (node_rank + 1) * num_local_ranks
+                )
+                for file in self.stage_to_file_map[stage].get(rank, [])
+            )
+        )
+        dataset.set_list_of_files(list_of_files=node_file_list)
+        dataset.assign_all_files_per_worker = False
+        dataset.set_distributed_params(total_workers=num_nodes, global_worker_id=node_rank)
+
+        # a fresh id per dataloader, so a buffer left by another run is never read
+        run_id = self.trainer.strategy.broadcast(f"{uuid.uuid4().hex}_{stage}", src=0)
+        dataloader = SharedPreprocessingLoader(
+            dataset=dataset,
+            collate_fn=self._get_partial_collate_fn(curr_config),
+            batch_size=curr_config.batch_size_per_device
+            if curr_config.dataset_config.iterate_per_row
+            else None,
+            drop_last=curr_config.drop_last,
+            num_producers=curr_config.shared_preprocessing_num_producers,
+            local_rank=self.trainer.local_rank,
+            num_local_ranks=num_local_ranks,
+            run_id=run_id,
+            shared_memory_dir=curr_config.get("shared_preprocessing_dir", "/dev/shm"),
+            buffer_size=curr_config.get("shared_preprocessing_buffer_size", 8),
+            timeout=curr_config.timeout,
+        )
+        self.shared_preprocessing_loaders.append(dataloader)
+        if curr_config.get("prefetch_to_device", False):
+            dataloader = DevicePrefetchLoader(
+                dataloader,
+                device=self.trainer.strategy.root_device,
+                num_batches_to_prefetch=curr_config.get("num_batches_to_prefetch", 2),
+            )
+        return dataloader
+
+    def _setup_train_cursors(self, dataset: Any, config: BaseDataloaderConfig) -> None:
+        """Track the cursors of the training dataloader workers and resume from the restored
+        cursors, if any.
+
+        :param dataset: The training dataset.
+        :param config: The training dataloader config.
+        """
+        num_workers = max(1, config.num_workers)
+        dataset.enable_cursor_tracking(
+            num_workers=num_workers,
+            num_rows_per_batch=config.batch_size_per_device
+            if config.dataset_config.iterate_per_row
+            else 1,
+        )
+        if config.get("track_data_loading_metrics", False):
+            # the statistics are logged by DataLoadingMonitor
+            dataset.enable_metrics_tracking(num_workers=num_workers)
+        self.stage_to_dataset[TrainerFn.FITTING] = dataset
+        self.train_batches_consumed_per_worker = [0] * num_workers
+
+        if self.train_cursors_to_resume is None:
+            return
+        if self.train_cursors_to_resume.size(0) != num_workers:
+            logging.warning(
+                "The number of dataloader workers changed since the checkpoint, the training"
+                " data is read from the beginning."
+            )
+        elif self.train_cursors_to_resume.size(1) != CURSOR_NUM_COLUMNS:
+            logging.warning(
+                "The cursors of the checkpoint have an older format, the training data is"
+                " read from the beginning."
+            )
+        else:
+            dataset.set_resume_cursors(self.train_cursors_to_resume)
+            # the batch index of the cursor is the last batch consumed from that worker
+            self.train_batches_consumed_per_worker = [
+                max(0, batch_index + 1)
+                for batch_index in self.train_cursors_to_resume[:, 0].tolist()
+            ]
+        self.train_cursors_to_resume = None
+
+    def _get_train_cursors(self) -> Optional[torch.Tensor]:
+        """Get the cursor of the last batch consumed from each worker of the training dataloader.
+
+        Every training batch is tagged with the worker that produced it (see
+        WorkerTaggingCollateFunction), so the number of batches consumed from each worker is
+        counted exactly, whatever the order in which the dataloader reads its workers.
+
+        :return: A (num_workers, CURSOR_NUM_COLUMNS) tensor of cursors, with -1 for the workers
+            whose cursor is unknown, or None if the training cursors are not tracked.
+        """
+        dataset = self.stage_to_dataset.get(TrainerFn.FITTING, None)
+        if dataset is None or dataset.cursor_history is None:
+            return None
+        num_workers = len(self.train_batches_consumed_per_worker)
+        cursors = torch.full((num_workers, CURSOR_NUM_COLUMNS), -1, dtype=torch.long)
+        for worker_id, num_batches_consumed in enumerate(
+            self.train_batches_consumed_per_worker
+        ):
+            if num_batches_consumed == 0:
+                continue
+            cursor = dataset.get_cursor(worker_id, num_batches_consumed - 1)
+            if cursor is None:
+                logging.warning(
+                    f"The cursor of dataloader worker {worker_id} is not available anymore,"
+                    " it will read its data from the beginning on resume."
+                )
+                continue
+            cursors[worker_id] = cursor
+        return cursors
+
+    def _get_running_stage_config(self) -> Optional[BaseDataloaderConfig]:
+        """Return the dataloader config of the loop the trainer is currently running."""
+        if self.trainer.training:
+            return self.stage_to_config[TrainerFn.FITTING]
+        if self.trainer.validating or self.trainer.sanity_checking:
+            return self.stage_to_config[TrainerFn.VALIDATING]
+        if self.trainer.testing:
+            return self.stage_to_config[TrainerFn.TESTING]
+        return self.stage_to_config[TrainerFn.PREDICTING]
+
+    def on_before_batch_transfer(self, batch: Any, dataloader_idx: int) -> Any:
+        """Lightning hook called before the batch is moved to the device. Training batches
+        tagged with their dataloader worker are counted per worker and untagged here.
+
+        :param batch: The batch, as returned by the dataloader.
+        :param dataloader_idx: The index of the dataloader the batch comes from.
+        :return: The batch without its worker tag.
+        """
+        if not isinstance(batch, WorkerTaggedBatch):
+            return batch
+        if self.trainer.training:
+            self.train_batches_consumed_per_worker[batch.worker_id] += 1
+        return batch.batch
+
+    def on_after_batch_transfer(self, batch: Any, dataloader_idx: int) -> Any:
+        """Lightning hook called once the batch is on the device. Batches collated with
+        collate_fn_ragged_train are padded, masked and labeled here, on the device.
+
+        :param batch: The batch, already on the device.
+        :param dataloader_idx: The index of the dataloader the batch comes from.
+        :return: The batch with every RaggedSequenceData replaced by the collated
+            (SequentialModelInputData, SequentialModuleLabelData) tuple.
+        """
+        config = self._get_running_stage_config()
+        if config is None:
+            return batch
+        return apply_to_collection(
+            batch,
+            RaggedSequenceData,
+            partial(
+                collate_ragged_sequences_on_device,
+                labels=config.get("labels", {}),
+                sequence_length=config.get("sequence_length", 200),
+                masking_token=config.get("masking_token", 1),
+                padding_token=config.get("padding_token", 0),
             ),
-        )  # type: ignore
+        )
 
     def train_dataloader(self) -> DataLoader[Any]:
         """Create and return the train dataloader.
@@ -251,16 +531,36 @@ class SequenceDataModule(LightningDataModule):
 
         :param stage: The stage being torn down. Defaults to ``None``.
         """
-        pass
+        for shared_preprocessing_loader in self.shared_preprocessing_loaders:
+            shared_preprocessing_loader.close()
+        self.shared_preprocessing_loaders = []
 
     def state_dict(self) -> Dict[Any, Any]:
         """Called when saving a checkpoint. Implement to generate and save the
         datamodule state.
 
+        The state holds the cursors of the training dataloader workers of every GPU,
+        so the training data can be resumed from the next unread row. This is called
+        on every GPU, as it gathers the cursors of all GPUs.
+
         :return: A dictionary containing the datamodule state that you want to
             save.
         """
-        return {}
+        cursors = self._get_train_cursors()
+        if cursors is None:
+            return {}
+        if self.trainer.world_size > 1:
+            # (world_size, num_workers, CURSOR_NUM_COLUMNS)
+            cursors = (
+                self.trainer.strategy.all_gather(
+                    cursors.to(self.trainer.strategy.root_device)
+                )
+                .cpu()
+                .long()
+            )
+        else:
+            cursors = cursors.unsqueeze(0)
+        return {"train_cursors": cursors}
 
     def load_state_dict(self, state_dict: Dict[str, Any]) -> None:
         """Called when loading a checkpoint. Implement to reload datamodule
@@ -268,7 +568,16 @@ class SequenceDataModule(LightningDataModule):
 
         :param state_dict: The datamodule state returned by `self.state_dict()`.
         """
-        pass
+        cursors = state_dict.get("train_cursors", None)
+        if cursors is None:
+            return
+        if cursors.size(0) != self.trainer.world_size:
+            logging.warning(
+                "The number of GPUs changed since the checkpoint, the training data is"
+                " read from the beginning."
+            )
+            return
+        self.train_cursors_to_resume = cursors[self.trainer.global_rank]
 
 
 class ItemDataModule(SequenceDataModule):
@@ -348,6 +657,8 @@ class ItemDataModule(SequenceDataModule):
             batch_size=curr_config.batch_size_per_device,
             is_for_training=stage == TrainerFn.FITTING,
             assign_all_files_per_worker=assign_all_files_per_worker,
+            shuffle_buffer_size=curr_config.get("shuffle_buffer_size", 0),
+            seed=curr_config.get("seed", None),
         )  # type: ignore
 
         device_file_list = self.stage_to_file_map[stage].get(
@@ -355,6 +666,11 @@ class ItemDataModule(SequenceDataModule):
         )
 
         dataset.set_list_of_files(list_of_files=device_file_list)
+        dataset.set_worker_file_map(
+            self.stage_to_worker_file_map.get(stage, {}).get(
+                self.trainer.global_rank, None
+            )
+        )
         # set the number of total GPUs and GPU index
         dataset.set_distributed_params(
             total_workers=self.trainer.world_size,
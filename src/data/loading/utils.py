@@ -3,11 +3,15 @@
 import heapq
 import random
 from collections import defaultdict
-from typing import Dict, List
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
 
 import torch
 
 from src.utils.file_utils import get_file_size
+from src.utils.pylogger import RankedLogger
+
+command_line_logger = RankedLogger(__name__, rank_zero_only=True)
 
 
 def assign_files_to_workers(
@@ -85,6 +89,88 @@ def assign_files_to_workers(
     return worker_to_files, False
 
 
+def get_file_weights(
+    list_of_files: List[str],
+    get_num_records: Optional[Callable[[str], Optional[int]]] = None,
+    num_threads: int = 16,
+) -> Dict[str, int]:
+    """Get the weight of each file used to balance the files across workers.
+
+    The files are read by num_threads threads, as reading the metadata of remote files is
+    dominated by the latency of the requests. In distributed runs, call it on a single rank
+    and broadcast the result.
+
+    :param list_of_files: List of file paths.
+    :param get_num_records: Function returning the number of records of a file, or None
+        if it is not available without reading the file (e.g. for tfrecords).
+    :param num_threads: The number of threads reading the files.
+
+    :return: The number of records of each file if it is available for all files,
+        otherwise the size of each file in bytes.
+    """
+    with ThreadPoolExecutor(max_workers=max(1, num_threads)) as executor:
+        if get_num_records is not None:
+            num_records = dict(
+                zip(list_of_files, executor.map(get_num_records, list_of_files))
+            )
+            if all(
+                file_num_records is not None for file_num_records in num_records.values()
+            ):
+                return num_records
+        return dict(zip(list_of_files, executor.map(get_file_size, list_of_files)))
+
+
+def assign_files_to_ranks_and_workers(
+    list_of_files: List[str],
+    total_ranks: int,
+    num_workers_per_rank: int,
+    file_weights: Dict[str, int],
+) -> Dict[int, Dict[int, List[str]]]:
+    """Assign each file to a single dataloader worker of a single GPU, balancing the total
+    weight (records or bytes) of the files across all total_ranks x num_workers_per_rank workers.
+
+    Balancing the GPUs only and then splitting the files of each GPU across its workers
+    can leave a worker with much more data than the others, which stalls the whole step
+    once the other workers run out of data or wait on it.
+
+    :param list_of_files: List of file paths to be assigned.
+    :param total_ranks: The number of GPUs.
+    :param num_workers_per_rank: The number of dataloader workers per GPU.
+    :param file_weights: The weight of each file, see `get_file_weights`.
+
+    :return: A dictionary mapping GPU indices to a dictionary mapping the dataloader
+        worker indices of that GPU to their file paths.
+    """
+    total_workers = total_ranks * num_workers_per_rank
+    sorted_files = sorted(list_of_files, key=lambda file: file_weights[file], reverse=True)
+
+    worker_to_files = {i: [] for i in range(total_workers)}
+    worker_loads = [(0, worker_id) for worker_id in range(total_workers)]
+    for file in sorted_files:
+        # assign file to the worker with the smallest load
+        worker_load, min_worker_load_index = heapq.heappop(worker_loads)
+        worker_to_files[min_worker_load_index].append(file)
+        heapq.heappush(
+            worker_loads, (worker_load + file_weights[file], min_worker_load_index)
+        )
+
+    loads = [load for load, _ in worker_loads]
+    mean_load = sum(loads) / len(loads)
+    command_line_logger.info(
+        f"Expected load per dataloader worker over {total_workers} workers: "
+        f"min {min(loads)}, max {max(loads)}, mean {mean_load:.1f} "
+        f"(max / mean = {max(loads) / max(mean_load, 1e-9):.3f})"
+    )
+
+    return {
+        rank: {
+            worker: worker_to_files[rank * num_workers_per_rank + worker]
+            for worker in range(num_workers_per_rank)
+        }
+        for rank in range(total_ranks)
+    }
+
+
 def pad_or_trim_sequence(
     padded_sequence: torch.Tensor, sequence_length: int, padding_token: int = 0
 ) -> torch.Tensor:
@@ -109,11 +195,12 @@ def pad_or_trim_sequence(
 
     # additional padding
     if padded_sequence.size(1) < sequence_length:
-        padding_tensor = (
-            padding_token
-            * torch.ones(
-                (padded_sequence.shape[0], sequence_length - padded_sequence.size(1))
-            ).long()
+        # the padding keeps the dtype of the sequence, which may be a compact integer dtype
+        padding_tensor = torch.full(
+            (padded_sequence.shape[0], sequence_length - padded_sequence.size(1)),
+            padding_token,
+            dtype=padded_sequence.dtype,
+            device=padded_sequence.device,
         )
         padded_sequence = torch.cat([padded_sequence, padding_tensor], dim=-1)
     return padded_sequence
@@ -0,0 +1,56 @@
+import hydra
+import lightning as L
+import rootutils
+import torch
+from omegaconf import DictConfig
+
+rootutils.setup_root(__file__, indicator=".project-root", pythonpath=True)
+
+from src.utils import RankedLogger, extras
+from src.utils.custom_hydra_resolvers import *
+from src.utils.file_utils import open_local_or_remote
+
+command_line_logger = RankedLogger(__name__, rank_zero_only=True)
+
+
+def inference_bulk(cfg: DictConfig) -> None:
+    """Assigns semantic ids to the whole embedding matrix with a trained residual
+    quantization model, and writes them to a single tensor.
+
+    :param cfg: A DictConfig configuration composed by Hydra.
+    """
+    if cfg.get("seed"):
+        L.seed_everything(cfg.seed, workers=True)
+
+    command_line_logger.info(f"Instantiating model <{cfg.model._target_}>")
+    model = hydra.utils.instantiate(cfg.model)
+
+    command_line_logger.info(f"Loading checkpoint {cfg.ckpt_path}")
+    with open_local_or_remote(cfg.ckpt_path, "rb") as file:
+        checkpoint = torch.load(file, map_location="cpu", weights_only=False)
+    model.on_load_checkpoint(checkpoint)
+    model.load_state_dict(checkpoint["state_dict"])
+
+    command_line_logger.info(f"Loading embeddings <{cfg.embeddings._target_}>")
+    embeddings = hydra.utils.instantiate(cfg.embeddings)
+
+    command_line_logger.info(f"Instantiating predictor <{cfg.predictor._target_}>")
+    predictor = hydra.utils.instantiate(cfg.predictor)
+
+    command_line_logger.info("Starting inference!")
+    cluster_ids = predictor.predict(model, embeddings)
+    predictor.save_semantic_ids(cluster_ids, cfg.output_path)
+
+
+@hydra.main(version_base="1.3", config_path="../configs", config_name="inference.yaml")
+def main(cfg: DictConfig) -> None:
+    """Main entry point for bulk semantic id inference.
+
+    :param cfg: DictConfig configuration composed by Hydra.
+    """
+    extras(cfg)
+    inference_bulk(cfg)
+
+
+if __name__ == "__main__":
+    main()
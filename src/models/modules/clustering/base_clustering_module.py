@@ -22,7 +22,7 @@ class BaseClusteringModule(LightningModule):
         optimizer: torch.optim.Optimizer,
         scheduler: Optional[torch.optim.lr_scheduler._LRScheduler] = None,
         init_buffer_size: int = 1000,
-        update_manually: bool = False,
+        update_manually: Optional[bool] = False,
     ):
         """
         Initialize the base clustering module.
@@ -37,6 +37,8 @@ class BaseClusteringModule(LightningModule):
             scheduler: Learning rate scheduler to use for training.
             init_buffer_size: Number of points to buffer for initialization.
             update_manually: Whether to manually update the centroids without gradients.
+                If None, they are updated manually unless training with DDP without
+                synchronized updates.
         """
         super(BaseClusteringModule, self).__init__()
 
@@ -62,6 +64,35 @@ class BaseClusteringModule(LightningModule):
         self.is_initial_step = False
         self.train_loss = MeanMetric()
 
+    @staticmethod
+    def is_distributed() -> bool:
+        """Whether training with more than one process, e.g. with DDP."""
+        return (
+            torch.distributed.is_available()
+            and torch.distributed.is_initialized()
+            and torch.distributed.get_world_size() > 1
+        )
+
+    def synchronizes_updates(self) -> bool:
+        """
+        Whether the manual updates are computed from statistics synchronized across ranks,
+        so that the centroids of all ranks stay the same without averaging gradients.
+        """
+        return False
+
+    def should_update_manually(self) -> bool:
+        """
+        Whether the centroids are updated manually, without gradients.
+
+        Returns:
+            update_manually if it is set. Otherwise, True unless training with DDP without
+            synchronized updates, where the centroids are updated through the gradients
+            averaged across ranks.
+        """
+        if self.update_manually is not None:
+            return self.update_manually
+        return not self.is_distributed() or self.synchronizes_updates()
+
     def _buffer_points(self, batch: torch.Tensor) -> None:
         """
         Buffer points for initialization.
@@ -75,11 +106,14 @@ class BaseClusteringModule(LightningModule):
         )
         self.init_buffer = torch.cat([self.init_buffer, batch[:n_to_add]], dim=0)
 
-    @rank_zero_only
     def compute_initial_centroids(self, buffer: torch.Tensor) -> None:
         """
         Initialize the centroids by setting `self.init_centroids`.
 
+        If the initializer is distributed, it is called on every rank with the buffer of
+        that rank and sets the same centroids on every rank. Otherwise, only the buffer
+        of rank zero is used and the centroids are only set on rank zero.
+
         Args:
             buffer: Data points of shape (batch_size, n_features)
 
@@ -92,6 +126,13 @@ class BaseClusteringModule(LightningModule):
                 f" {self.n_clusters}."
             )
 
+        if self.initializer.is_distributed():
+            self.init_centroids = self.initializer(buffer)
+        else:
+            self._compute_initial_centroids_on_rank_zero(buffer)
+
+    @rank_zero_only
+    def _compute_initial_centroids_on_rank_zero(self, buffer: torch.Tensor) -> None:
         self.init_centroids = self.initializer(buffer)
 
     def initialization_step(
@@ -131,23 +172,38 @@ class BaseClusteringModule(LightningModule):
             self.init_centroids = torch.zeros_like(
                 self.centroids.data, dtype=batch.dtype, device=self.device
             )
-            # This function is rank zero only, so only the buffer from the first device
+            # Unless the initializer is distributed, only the buffer from the first device
             # is used to initialize the centroids
             self.compute_initial_centroids(self.init_buffer)
             self.is_initial_step = True
             self.init_buffer = torch.tensor([], device=self.device)
 
-            if self.update_manually:
+            if self.should_update_manually():
+                if self.is_distributed() and not self.initializer.is_distributed():
+                    # Only rank zero computed the initial centroids
+                    torch.distributed.broadcast(self.init_centroids, src=0)
                 # If we are updating manually, we set the centroids to the initial
                 # centroids without gradients
-                self.centroids[:] = self.init_centroids.data
-                distances = self.distance_function.compute(batch, self.centroids.data)
-                assignments = torch.argmin(distances, dim=1).to(self.device)
-                return assignments, self.centroids[assignments], None
-
-            loss = self.init_loss_function(self.centroids, self.init_centroids)
-            distances = self.distance_function.compute(batch, self.init_centroids)
-            assignments = torch.argmin(distances, dim=1).to(self.device)
+                with torch.no_grad():
+                    self.centroids[:] = self.init_centroids.data
+                centroids = self.centroids.detach()
+                assignments, _ = self.distance_function.assign(batch, centroids)
+                assignments = assignments.to(self.device)
+                # the detached initialization loss, so that train/loss is still logged
+                loss = self.init_loss_function(centroids, self.init_centroids.detach())
+                return assignments, centroids[assignments], loss
+
+            # The training loop scales the loss by the world size and the gradients are
+            # averaged across ranks, so only rank zero pulls the centroids to the initial
+            # centroids, even if every rank computed them
+            init_loss_target = (
+                self.init_centroids
+                if self.global_rank == 0
+                else torch.zeros_like(self.init_centroids)
+            )
+            loss = self.init_loss_function(self.centroids, init_loss_target)
+            assignments, _ = self.distance_function.assign(batch, self.init_centroids)
+            assignments = assignments.to(self.device)
             return assignments, self.init_centroids[assignments], loss
 
     def forward(self, batch: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, bool]:
@@ -234,9 +290,8 @@ class BaseClusteringModule(LightningModule):
         """
         batch = batch.to(self.device)
         with torch.no_grad():
-            centroids = self.get_centroids().data
-            distances = self.distance_function.compute(batch, centroids)
-            assignments = torch.argmin(distances, dim=1)
+            centroids = self.get_centroids().detach()
+            assignments, _ = self.distance_function.assign(batch, centroids)
             if not return_embeddings:
                 return assignments
             return assignments, centroids[assignments]
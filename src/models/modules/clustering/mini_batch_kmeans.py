@@ -2,7 +2,6 @@ import functools
 from typing import Optional, Tuple
 
 import torch
-import torch.nn as nn
 
 from src.components.distance_functions import DistanceFunction
 from src.components.clustering_initializers import (
@@ -26,7 +25,8 @@ class MiniBatchKMeans(BaseClusteringModule):
             lr=0.5,
         ),
         init_buffer_size: int = 1000,
-        update_manually: bool = False,
+        update_manually: Optional[bool] = None,
+        synchronize_statistics: bool = True,
     ):
         """
         Initialize an implementation of the mini-batch k-Means algorithm (Sculley 2010).
@@ -41,6 +41,16 @@ class MiniBatchKMeans(BaseClusteringModule):
             optimizer: Optimizer to use for training.
             initializer: Initialization method.
             init_buffer_size: Number of points to buffer for initialization.
+            update_manually: Whether to apply the mini-batch k-means update to the
+                centroids directly, without autograd. If None, the centroids are updated
+                manually unless training with DDP without synchronize_statistics, where
+                the gradients are averaged to keep the centroids of all ranks in sync.
+            synchronize_statistics: Whether to sum the per-cluster counts and sums of
+                the batches of all ranks when training with DDP. Every rank then applies
+                the same update as a single process with the concatenated batch. This
+                requires the manual update: with update_manually=False, the gradients of
+                the global statistics would be averaged again across ranks, so the two
+                cannot be combined under DDP.
         """
         super().__init__(
             n_clusters=n_clusters,
@@ -52,8 +62,12 @@ class MiniBatchKMeans(BaseClusteringModule):
             init_buffer_size=init_buffer_size,
             update_manually=update_manually,
         )
+        self.synchronize_statistics = synchronize_statistics
         self.cluster_counts = torch.zeros(self.n_clusters)
 
+    def synchronizes_updates(self) -> bool:
+        return self.synchronize_statistics
+
     def forward(
         self, batch: torch.Tensor
     ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
@@ -61,7 +75,9 @@ class MiniBatchKMeans(BaseClusteringModule):
         Perform a forward pass of the K-Means model on the input batch.
 
         This function computes the cluster assignments for each input point, the number
-        of points in each cluster, and the sum of points in each cluster.
+        of points in each cluster, and the sum of points in each cluster. With
+        synchronize_statistics and DDP, the counts and sums are over the batches of all
+        ranks.
 
         Args:
             batch: Data points of shape (batch_size, n_features)
@@ -75,14 +91,27 @@ class MiniBatchKMeans(BaseClusteringModule):
         # Note that assignments is automatically detached from the computation graph
         # because it results from argmin
         assignments = self.predict_step(batch, return_embeddings=False)
-        assignments_one_hot = (
-            nn.functional.one_hot(assignments, self.n_clusters)
-        ).detach()
         # Count points in each cluster
-        batch_cluster_counts = torch.sum(assignments_one_hot, dim=0)
+        batch_cluster_counts = torch.bincount(assignments, minlength=self.n_clusters)
+        # Accumulate points for each cluster, O(batch_size x n_features) instead of
+        # a (n_clusters x batch_size) one-hot matrix multiplication
+        batch_cluster_sums = torch.zeros(
+            self.n_clusters, batch.size(1), dtype=batch.dtype, device=batch.device
+        ).index_add(0, assignments, batch)
+        if self.synchronize_statistics and self.is_distributed():
+            if not self.should_update_manually():
+                raise ValueError(
+                    "synchronize_statistics requires the centroids to be updated manually"
+                    " when training with DDP, set update_manually to True or None, or"
+                    " synchronize_statistics to False to average the gradients instead."
+                )
+            # The statistics are those of the global batch, so that the global
+            # cluster_counts, and hence the per-cluster learning rates, are the same
+            # as with a single process
+            torch.distributed.all_reduce(batch_cluster_counts)
+            batch_cluster_sums = batch_cluster_sums.detach()
+            torch.distributed.all_reduce(batch_cluster_sums)
         self.cluster_counts += batch_cluster_counts
-        # Accumulate points for each cluster
-        batch_cluster_sums = torch.mm(assignments_one_hot.float().t(), batch)
 
         return assignments, batch_cluster_counts, batch_cluster_sums
 
@@ -107,7 +136,9 @@ class MiniBatchKMeans(BaseClusteringModule):
         Returns:
             assignments: Cluster assignments of shape (batch_size,)
             embeddings: Embeddings of shape (batch_size, n_features)
-            loss: Loss value. Tensor of shape (1,), or None if update_manually is True.
+            loss: Loss value. Tensor of shape (1,). When the centroids are updated manually,
+                it is the same loss detached, computed before the update, so that train/loss
+                is comparable between the two paths.
         """
         batch = batch.to(self.device)
 
@@ -127,11 +158,16 @@ class MiniBatchKMeans(BaseClusteringModule):
         mask_target = batch_cluster_sums[mask] / batch_cluster_counts[mask].unsqueeze(1)
         centroid_weights = batch_cluster_counts[mask] / self.cluster_counts[mask]
 
-        if self.update_manually:
-            self.centroids[mask] = self.centroids[mask].data - (
-                (centroids[mask].data - mask_target) * centroid_weights.unsqueeze(1)
-            )
-            return assignments, centroids[assignments], None
+        if self.should_update_manually():
+            with torch.no_grad():
+                loss = self.loss_function(
+                    centroids[mask], mask_target, centroid_weights
+                ).detach()
+                self.centroids[mask] = self.centroids[mask] - (
+                    (self.centroids[mask] - mask_target)
+                    * centroid_weights.unsqueeze(1)
+                )
+            return assignments, centroids.detach()[assignments], loss
         else:
             # The MiniBatchKMeans algorithm update above is equivalent to an SGD step
             # with learning rate 0.5 on the loss function below
@@ -193,8 +193,9 @@ class SemanticIDGenerativeRecommender(TransformerBaseModule):
         # Repeat the offsets and slice to match the number of columns
         repeated_offsets = offsets.repeat(num_repeats)[:num_cols]
 
-        # Add the repeated offsets to each row using broadcasting
-        input_sids_with_offsets = input_sids + repeated_offsets
+        # Add the repeated offsets to each row using broadcasting. The sids may be stored in a
+        # compact integer dtype (see SemanticIDDatasetConfig), so they are widened first.
+        input_sids_with_offsets = input_sids.long() + repeated_offsets
         if attention_mask is not None:
             input_sids_with_offsets = input_sids_with_offsets * attention_mask
         return input_sids_with_offsets
@@ -386,6 +387,8 @@ class SemanticIDGenerativeRecommender(TransformerBaseModule):
 
         generated_ids, marginal_probs = self.generate(
             attention_mask=model_input.mask,
+            segment_ids=model_input.segment_ids,
+            num_segments=model_input.num_segments,
             **{
                 self.feature_to_model_input_map.get(k, k): v
                 for k, v in model_input.transformed_sequences.items()
@@ -455,6 +458,33 @@ class SemanticIDGenerativeRecommender(TransformerBaseModule):
         super().on_train_start()
         self._make_deterministic(is_training=True)
 
+    def on_train_batch_start(self, batch: Any, batch_idx: int):
+        self._train_batch_start_time = time.perf_counter()
+
+    def on_train_batch_end(self, outputs: Any, batch: Any, batch_idx: int):
+        """
+        Log the encoder padding ratio and the number of non-padding encoder tokens processed
+        per second, so padded and packed (see collate_fn_packed_train) training can be compared.
+        """
+        # Lightning wraps the training batch in a tuple, see TransformerBaseModule.training_step
+        encoder_mask = batch[0][0].mask
+        num_tokens = encoder_mask.sum().float()
+        elapsed_time = time.perf_counter() - self._train_batch_start_time
+        self.log(
+            "train/padding_ratio",
+            1.0 - num_tokens / encoder_mask.numel(),
+            on_step=True,
+            on_epoch=False,
+            logger=True,
+        )
+        self.log(
+            "train/tokens_per_sec",
+            num_tokens / elapsed_time,
+            on_step=True,
+            on_epoch=False,
+            logger=True,
+        )
+
 
 class SemanticIDEncoderDecoder(SemanticIDGenerativeRecommender):
     """
@@ -586,6 +616,8 @@ class SemanticIDEncoderDecoder(SemanticIDGenerativeRecommender):
         attention_mask: torch.Tensor,
         input_ids: torch.Tensor,
         user_id: torch.Tensor,
+        segment_ids: Optional[torch.Tensor] = None,
+        num_segments: Optional[int] = None,
     ) -> torch.Tensor:
         """
         Forward pass for the encoder module.
@@ -594,7 +626,13 @@ class SemanticIDEncoderDecoder(SemanticIDGenerativeRecommender):
             attention_mask (torch.Tensor): The attention mask for the encoder.
             input_ids (torch.Tensor): The input IDs for the encoder.
             user_id (torch.Tensor): The user IDs for the encoder.
+            segment_ids (Optional[torch.Tensor]): The segment ids of packed sequences (see collate_fn_packed_train).
+                If passed, the encoder output is unpacked to one row per segment before being returned.
+            num_segments (Optional[int]): The number of packed sequences, including the ones without
+                valid tokens (see SequentialModelInputData.num_segments).
         """
+        if segment_ids is not None and user_id is not None and self.user_embedding is not None:
+            raise ValueError("user embeddings are not supported with packed sequences")
 
         # we shift the IDs here to match the hierarchy structure
         # so that we can use a single embedding table to store the embeddigns for all hierarchies
@@ -618,6 +656,15 @@ class SemanticIDEncoderDecoder(SemanticIDGenerativeRecommender):
                 sep_token=self.sep_token,
                 num_hierarchies=self.num_hierarchies,
             )
+            if segment_ids is not None:
+                # the sep token belongs to the segment of the item it follows
+                # and is masked the same way as the last token of that item
+                reshaped_segment_ids = segment_ids.view(
+                    segment_ids.size(0), -1, self.num_hierarchies
+                )
+                segment_ids = torch.cat(
+                    [reshaped_segment_ids, reshaped_segment_ids[:, :, [-1]]], dim=-1
+                ).reshape(segment_ids.size(0), -1)
 
         # we enter this loop if we want to use user_id
         if user_id is not None and self.user_embedding is not None:
@@ -652,12 +699,75 @@ class SemanticIDEncoderDecoder(SemanticIDGenerativeRecommender):
         else:
             attention_mask_for_encoder = attention_mask
 
+        if segment_ids is not None:
+            if num_segments is None:
+                num_segments = int(segment_ids.max())
+            encoder_output, encoder_segment_ids = self.encoder(
+                sequence_embedding=inputs_embeds_for_encoder,
+                attention_mask=attention_mask_for_encoder,
+                segment_ids=segment_ids,
+            )
+            return self._unpack_segments(
+                encoder_output=encoder_output,
+                segment_ids=encoder_segment_ids,
+                num_segments=num_segments,
+            )
+
         encoder_output = self.encoder(
             sequence_embedding=inputs_embeds_for_encoder,
             attention_mask=attention_mask_for_encoder,
         )
         return encoder_output, attention_mask_for_encoder
 
+    def _unpack_segments(
+        self,
+        encoder_output: torch.Tensor,
+        segment_ids: torch.Tensor,
+        num_segments: int,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Map the output of the encoder over packed rows back to one row per segment, so the
+        decoder can run unchanged with one target per original sequence. Only the tokens of each
+        segment are gathered, left aligned, so the decoder attends over the longest segment
+        instead of whole packed rows.
+
+        Parameters:
+            encoder_output (torch.Tensor): The encoder output of shape (num_rows, seq_len, emb_dim).
+            segment_ids (torch.Tensor): The segment ids of the encoder output of shape (num_rows, seq_len).
+            num_segments (int): The number of segments in the batch.
+
+        Returns:
+        Tuple[torch.Tensor, torch.Tensor]:
+        encoder_output: The tokens of each segment of shape (num_segments, max_segment_len, emb_dim).
+        attention_mask: The mask of the tokens of each segment of shape (num_segments, max_segment_len).
+        """
+        # the tokens are taken in row-major order, which keeps their order within each segment
+        is_valid = segment_ids > 0
+        segment_of_token = segment_ids[is_valid] - 1
+        token_order = torch.argsort(segment_of_token, stable=True)
+        sorted_segment_of_token = segment_of_token[token_order]
+
+        segment_lengths = torch.bincount(segment_of_token, minlength=num_segments)
+        segment_starts = torch.cumsum(segment_lengths, dim=0) - segment_lengths
+        position_in_segment = (
+            torch.arange(sorted_segment_of_token.numel(), device=segment_ids.device)
+            - segment_starts[sorted_segment_of_token]
+        )
+        # segments without valid tokens keep one masked position
+        max_segment_length = max(int(segment_lengths.max()), 1) if num_segments else 1
+
+        unpacked_encoder_output = encoder_output.new_zeros(
+            num_segments, max_segment_length, encoder_output.size(-1)
+        )
+        unpacked_encoder_output[
+            sorted_segment_of_token, position_in_segment
+        ] = encoder_output[is_valid][token_order]
+        attention_mask = torch.zeros(
+            num_segments, max_segment_length, dtype=torch.long, device=segment_ids.device
+        )
+        attention_mask[sorted_segment_of_token, position_in_segment] = 1
+        return unpacked_encoder_output, attention_mask
+
     def decoder_forward_pass(
         self,
         attention_mask: Optional[
@@ -740,6 +850,8 @@ class SemanticIDEncoderDecoder(SemanticIDGenerativeRecommender):
         attention_mask: torch.Tensor,
         input_ids: torch.Tensor,
         user_id: torch.Tensor = None,
+        segment_ids: Optional[torch.Tensor] = None,
+        num_segments: Optional[int] = None,
     ) -> torch.Tensor:
         """
         Generate the semantic id given the current model in the sequence using beam search.
@@ -747,6 +859,8 @@ class SemanticIDEncoderDecoder(SemanticIDGenerativeRecommender):
             attention_mask (torch.Tensor): The attention mask for the encoder.
             input_ids (torch.Tensor): The input IDs for the encoder.
             user_id (torch.Tensor): The user IDs for the encoder.
+            segment_ids (Optional[torch.Tensor]): The segment ids if input_ids are packed sequences.
+            num_segments (Optional[int]): The number of packed sequences.
         """
 
         # getting encoder output
@@ -756,6 +870,8 @@ class SemanticIDEncoderDecoder(SemanticIDGenerativeRecommender):
             attention_mask=attention_mask,
             input_ids=input_ids,
             user_id=user_id,
+            segment_ids=segment_ids,
+            num_segments=num_segments,
         )
 
         # initilize cached generated ids to None
@@ -821,7 +937,8 @@ class SemanticIDEncoderDecoder(SemanticIDGenerativeRecommender):
                 marginal_log_prob=marginal_log_prob,
                 past_key_values=past_key_values,
                 hierarchy=hierarchy,
-                batch_size=input_ids.size(0),
+                # one beam group per sequence, which differs from input_ids.size(0) for packed sequences
+                batch_size=encoder_output.size(0),
             )
 
         return generated_ids, marginal_log_prob
@@ -833,6 +950,8 @@ class SemanticIDEncoderDecoder(SemanticIDGenerativeRecommender):
         user_id: Optional[torch.Tensor] = None,
         future_ids: Optional[torch.Tensor] = None,
         attention_mask_decoder: Optional[torch.Tensor] = None,
+        segment_ids: Optional[torch.Tensor] = None,
+        num_segments: Optional[int] = None,
         **kwargs: Any,
     ) -> torch.Tensor:
         """
@@ -843,12 +962,16 @@ class SemanticIDEncoderDecoder(SemanticIDGenerativeRecommender):
             user_id (torch.Tensor): The user IDs for the encoder.
             future_ids (Optional[torch.Tensor]): The future IDs for the decoder.
             attention_mask_decoder (Optional[torch.Tensor]): The attention mask for the decoder.
+            segment_ids (Optional[torch.Tensor]): The segment ids if input_ids are packed sequences.
+            num_segments (Optional[int]): The number of packed sequences.
         """
 
         encoder_output, attention_mask_for_encoder = self.encoder_forward_pass(
             attention_mask=attention_mask_encoder,
             input_ids=input_ids,
             user_id=user_id,
+            segment_ids=segment_ids,
+            num_segments=num_segments,
         )
 
         decoder_output = self.decoder_forward_pass(
@@ -915,6 +1038,8 @@ class SemanticIDEncoderDecoder(SemanticIDGenerativeRecommender):
             # this is inference stage
             generated_ids, marginal_probs = self.generate(
                 attention_mask=model_input.mask,
+                segment_ids=model_input.segment_ids,
+                num_segments=model_input.num_segments,
                 **{
                     self.feature_to_model_input_map.get(k, k): v
                     for k, v in model_input.transformed_sequences.items()
@@ -922,15 +1047,23 @@ class SemanticIDEncoderDecoder(SemanticIDGenerativeRecommender):
             )
             return generated_ids, 0  # returning 0 here because we don't have a loss
 
+        # packed rows hold several sequences, labels have one row per sequence (segment)
+        num_sequences = (
+            model_input.mask.size(0)
+            if model_input.segment_ids is None
+            else model_input.num_segments
+        )
         fut_ids = None
         for label in label_data.labels:
             curr_label = label_data.labels[label]
-            fut_ids = curr_label.reshape(model_input.mask.size(0), -1)
+            fut_ids = curr_label.reshape(num_sequences, -1)
         # here we pass labels in to the forward function
         # because the decoder is causal and we are doing shifted prediction
         model_output = self.forward(
             attention_mask_encoder=model_input.mask,
             future_ids=fut_ids,
+            segment_ids=model_input.segment_ids,
+            num_segments=model_input.num_segments,
             **{
                 self.feature_to_model_input_map.get(k, k): v
                 for k, v in model_input.transformed_sequences.items()
@@ -1064,7 +1197,23 @@ class SemanticIDEncoderModule(torch.nn.Module):
         self,
         attention_mask: torch.Tensor,
         sequence_embedding: torch.Tensor,
-    ) -> torch.Tensor:
+        segment_ids: Optional[torch.Tensor] = None,
+    ) -> Union[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]:
+        """
+        Forward pass for the encoder module.
+        Parameters:
+            attention_mask (torch.Tensor): The attention mask for the encoder.
+            sequence_embedding (torch.Tensor): The input sequence embedding for the encoder.
+            segment_ids (Optional[torch.Tensor]): The segment ids of packed sequences. If passed,
+                the segment ids of the output tokens (after token pruning) are returned as well.
+        """
+        if segment_ids is not None:
+            encoder_output = self.encoder(
+                inputs_embeds=sequence_embedding,
+                attention_mask=attention_mask,
+                segment_ids=segment_ids,
+            )
+            return encoder_output.last_hidden_state, encoder_output.segment_ids
 
         encoder_output = self.encoder(
             inputs_embeds=sequence_embedding,
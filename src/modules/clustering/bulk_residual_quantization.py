@@ -0,0 +1,119 @@
+import copy
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import torch
+from fsspec.core import url_to_fs
+
+from src.modules.clustering.residual_quantization import ResidualQuantization
+from src.utils.file_utils import open_local_or_remote
+from src.utils.pylogger import RankedLogger
+from src.utils.tensor_utils import deduplicate_rows, get_smallest_integer_dtype
+
+command_line_logger = RankedLogger(__name__, rank_zero_only=True)
+
+
+class BulkResidualQuantizationPredictor:
+    def __init__(
+        self,
+        chunk_size: int = 65536,
+        device: Optional[str] = None,
+        num_workers: int = 1,
+        num_threads: Optional[int] = None,
+    ):
+        """
+        Assign semantic ids to a whole embedding matrix with a trained residual
+        quantization model, without going through the dataloaders and prediction writers.
+
+        The rows of the embedding matrix, which can be memory mapped, are assigned in large
+        chunks, and the ids are written directly into a preallocated tensor.
+
+        Args:
+            chunk_size: Number of rows of the embedding matrix assigned at a time.
+            device: Device to run the assignments on. If None, the GPU is used if available.
+            num_workers: Number of threads assigning chunks concurrently on CPU, so that
+                reading the memory-mapped rows overlaps with the assignments. Each thread
+                uses its own copy of the model, as the caches of the distance functions
+                (e.g. the index of IVFAssignmentDistance) are not thread-safe.
+            num_threads: Number of threads used by torch for the operations on CPU.
+                If None, the torch default is kept.
+        """
+        self.chunk_size = chunk_size
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.device = torch.device(device)
+        self.num_workers = num_workers
+        self.num_threads = num_threads
+
+    @torch.no_grad()
+    def predict(
+        self, model: ResidualQuantization, embeddings: torch.Tensor
+    ) -> torch.Tensor:
+        """
+        Assign the cluster ids of each layer to all the rows of embeddings.
+
+        Args:
+            model: The trained residual quantization model.
+            embeddings: The embedding matrix of shape (n_items, n_features), where row i
+                is the embedding of item i.
+
+        Returns:
+            The cluster ids of shape (n_items, n_layers).
+        """
+        if self.num_threads is not None:
+            torch.set_num_threads(self.num_threads)
+        model.to(self.device)
+        model.eval()
+
+        max_cluster_id = max(layer.n_clusters for layer in model.quantization_layer_list)
+        cluster_ids = torch.empty(
+            (embeddings.shape[0], model.n_layers),
+            dtype=get_smallest_integer_dtype(0, max_cluster_id - 1),
+        )
+
+        def assign_chunk(start_idx: int, chunk_model: ResidualQuantization) -> None:
+            chunk = embeddings[start_idx : start_idx + self.chunk_size]
+            chunk = chunk.to(self.device, dtype=torch.float32, non_blocking=True)
+            chunk_cluster_ids = chunk_model.predict_cluster_ids(chunk)
+            cluster_ids[start_idx : start_idx + chunk.shape[0]] = chunk_cluster_ids.to(
+                "cpu", dtype=cluster_ids.dtype
+            )
+
+        chunk_starts = range(0, embeddings.shape[0], self.chunk_size)
+        if self.device.type == "cpu" and self.num_workers > 1:
+            thread_state = threading.local()
+
+            def assign_chunk_in_thread(start_idx: int) -> None:
+                if not hasattr(thread_state, "model"):
+                    thread_state.model = copy.deepcopy(model)
+                assign_chunk(start_idx, thread_state.model)
+
+            # torch releases the GIL in its operations, so the chunks run in parallel
+            with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+                list(executor.map(assign_chunk_in_thread, chunk_starts))
+        else:
+            for start_idx in chunk_starts:
+                assign_chunk(start_idx, model)
+        return cluster_ids
+
+    def save_semantic_ids(self, cluster_ids: torch.Tensor, output_path: str) -> None:
+        """
+        Save the semantic ids in the format written by the inference pipeline through
+        LocalPickleWriter: the cluster ids with the deduplication column appended, of shape
+        (n_items, n_layers + 1), transposed.
+
+        Args:
+            cluster_ids: The cluster ids of shape (n_items, n_layers).
+            output_path: Path of the tensor to write, e.g. merged_predictions_tensor.pt.
+        """
+        # the ids keep the narrow dtype of cluster_ids, unless the deduplication column
+        # needs a wider one
+        semantic_ids = deduplicate_rows(cluster_ids, keep_dtype=True).transpose(-2, -1)
+        fs, _ = url_to_fs(output_path)
+        fs.makedirs(fs._parent(output_path), exist_ok=True)
+        with open_local_or_remote(output_path, "wb") as file:
+            torch.save(semantic_ids, file)
+        command_line_logger.info(
+            f"Saved semantic ids of shape {tuple(semantic_ids.shape)} to {output_path}"
+        )
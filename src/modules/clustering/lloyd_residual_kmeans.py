@@ -0,0 +1,238 @@
+import math
+import os
+import tempfile
+from typing import Any, Dict, Optional, Tuple
+
+import lightning
+import torch
+from torch import nn
+
+from src.modules.clustering.residual_quantization import ResidualQuantization
+from src.utils.pylogger import RankedLogger
+from src.utils.tensor_utils import gather_rows
+
+command_line_logger = RankedLogger(__name__, rank_zero_only=True)
+
+
+class LloydResidualKMeansTrainer:
+    def __init__(
+        self,
+        max_iterations: int = 100,
+        tolerance: float = 1e-4,
+        chunk_size: int = 65536,
+        device: Optional[str] = None,
+        scratch_dir: Optional[str] = None,
+        verbose: bool = True,
+    ):
+        """
+        Offline trainer of residual k-means with full-batch Lloyd iterations.
+
+        Instead of streaming mini-batches through Lightning, each layer of a
+        ResidualQuantization model is trained with exact Lloyd iterations over the whole
+        embedding matrix, which can be memory mapped. The points are assigned in chunks of
+        rows with the chunked nearest-centroid assignment of the distance function of the
+        layer, and the per-cluster counts and sums are accumulated over the chunks. The
+        layers are trained one at a time, on the residuals of the previous layers.
+
+        The residuals of all the points are kept on the host, in RAM or in a memory-mapped
+        scratch file, and only one chunk at a time is moved to the device, so the device
+        memory does not grow with the number of points.
+
+        Args:
+            max_iterations: Maximum number of Lloyd iterations per layer.
+            tolerance: A layer has converged when the relative decrease of its inertia,
+                the sum of the distances of the points to their centroids, is below it.
+            chunk_size: Number of rows of the embedding matrix processed at a time.
+            device: Device to run the assignments on. If None, the GPU is used if available.
+            scratch_dir: If given, the residuals are stored in a memory-mapped file in this
+                directory instead of RAM, for embedding matrices larger than the RAM.
+            verbose: Whether to log the inertia after each iteration.
+        """
+        self.max_iterations = max_iterations
+        self.tolerance = tolerance
+        self.chunk_size = chunk_size
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.device = torch.device(device)
+        self.scratch_dir = scratch_dir
+        self.verbose = verbose
+
+    def _allocate_residuals(self, shape: Tuple[int, int]) -> torch.Tensor:
+        """
+        Allocate the float32 host tensor holding the residuals of all the points.
+
+        Args:
+            shape: The shape (n_items, n_encoded_features) of the residuals.
+
+        Returns:
+            The uninitialized residuals, in RAM or memory mapped from a file in scratch_dir.
+        """
+        if self.scratch_dir is None:
+            return torch.empty(shape, dtype=torch.float32)
+        os.makedirs(self.scratch_dir, exist_ok=True)
+        file_descriptor, scratch_path = tempfile.mkstemp(
+            suffix=".bin", dir=self.scratch_dir
+        )
+        try:
+            os.ftruncate(file_descriptor, math.prod(shape) * 4)
+            residuals = torch.from_file(
+                scratch_path, shared=True, size=math.prod(shape), dtype=torch.float32
+            ).view(shape)
+        finally:
+            os.close(file_descriptor)
+            # the mapping stays valid after the file is removed
+            os.remove(scratch_path)
+        return residuals
+
+    def _iterate_chunks(self, n_samples: int):
+        """Yield the slices of rows of the chunks of n_samples points."""
+        for start_idx in range(0, n_samples, self.chunk_size):
+            yield slice(start_idx, min(start_idx + self.chunk_size, n_samples))
+
+    @torch.no_grad()
+    def _compute_inputs(
+        self, model: ResidualQuantization, embeddings: torch.Tensor
+    ) -> torch.Tensor:
+        """
+        Compute the inputs of the first quantization layer for all the rows of embeddings.
+
+        Args:
+            model: The residual quantization model.
+            embeddings: The embedding matrix of shape (n_items, n_features).
+
+        Returns:
+            The encoded embeddings of shape (n_items, n_encoded_features), on the host.
+        """
+        inputs = None
+        for rows in self._iterate_chunks(embeddings.shape[0]):
+            chunk = embeddings[rows].to(self.device, dtype=torch.float32)
+            chunk_inputs = model.encoder(model.normalization_layer(chunk))
+            if inputs is None:
+                inputs = self._allocate_residuals(
+                    (embeddings.shape[0], chunk_inputs.shape[1])
+                )
+            inputs[rows] = chunk_inputs.cpu()
+        return inputs
+
+    @torch.no_grad()
+    def _fit_layer(self, layer: nn.Module, residuals: torch.Tensor) -> torch.Tensor:
+        """
+        Train one quantization layer with Lloyd iterations.
+
+        Args:
+            layer: The quantization layer, e.g. MiniBatchKMeans.
+            residuals: The inputs of the layer of shape (n_items, n_features), on the host.
+
+        Returns:
+            The number of points in each cluster of shape (n_clusters,).
+        """
+        n_samples = residuals.shape[0]
+        if n_samples < layer.n_clusters:
+            raise ValueError(
+                f"Number of points {n_samples} is less than the number of clusters"
+                f" {layer.n_clusters}."
+            )
+        # The centroids are seeded as in the streaming training, on a sample of the points
+        buffer_size = min(max(layer.init_buffer_size, layer.n_clusters), n_samples)
+        buffer = gather_rows(residuals, torch.randperm(n_samples)[:buffer_size])
+        centroids = layer.initializer(buffer.to(self.device)).to(
+            self.device, torch.float32
+        )
+
+        previous_inertia = None
+        for iteration in range(self.max_iterations):
+            cluster_counts = torch.zeros(
+                layer.n_clusters, dtype=torch.long, device=self.device
+            )
+            cluster_sums = torch.zeros_like(centroids)
+            inertia = torch.zeros((), dtype=torch.float64, device=self.device)
+            for rows in self._iterate_chunks(n_samples):
+                chunk = residuals[rows].to(self.device)
+                assignments, min_distances = layer.distance_function.assign(
+                    chunk, centroids
+                )
+                cluster_counts += torch.bincount(assignments, minlength=layer.n_clusters)
+                cluster_sums.index_add_(0, assignments, chunk)
+                inertia += min_distances.sum(dtype=torch.float64)
+
+            # Empty clusters keep their centroid
+            mask = cluster_counts != 0
+            centroids[mask] = cluster_sums[mask] / cluster_counts[mask].unsqueeze(1)
+
+            inertia = inertia.item()
+            if self.verbose:
+                command_line_logger.info(
+                    f"Iteration {iteration}: inertia {inertia:.6f},"
+                    f" {int((~mask).sum())} empty clusters"
+                )
+            if (
+                previous_inertia is not None
+                and previous_inertia - inertia <= self.tolerance * previous_inertia
+            ):
+                break
+            previous_inertia = inertia
+
+        layer.centroids.data.copy_(centroids)
+        layer.is_initialized = True
+        return cluster_counts
+
+    @torch.no_grad()
+    def fit(
+        self, model: ResidualQuantization, embeddings: torch.Tensor
+    ) -> ResidualQuantization:
+        """
+        Train the quantization layers of the model one at a time.
+
+        Args:
+            model: The residual quantization model, as instantiated for training.
+            embeddings: The embedding matrix of shape (n_items, n_features), where row i
+                is the embedding of item i.
+
+        Returns:
+            The trained model.
+        """
+        model.to(self.device)
+        model.eval()
+        residuals = self._compute_inputs(model, embeddings)
+        for layer_idx, layer in enumerate(model.quantization_layer_list):
+            command_line_logger.info(
+                f"Training layer {layer_idx} of {model.n_layers} on"
+                f" {residuals.shape[0]} points"
+            )
+            if model.normalize_residuals:
+                for rows in self._iterate_chunks(residuals.shape[0]):
+                    residuals[rows] = nn.functional.normalize(residuals[rows], dim=-1)
+            cluster_counts = self._fit_layer(layer, residuals)
+            if hasattr(layer, "cluster_counts"):
+                # So that the mini-batch learning rates stay small if training continues
+                layer.cluster_counts = cluster_counts.to(layer.centroids.dtype)
+            if layer_idx < model.n_layers - 1:
+                for rows in self._iterate_chunks(residuals.shape[0]):
+                    chunk = residuals[rows].to(self.device)
+                    _, layer_embeddings = layer.predict_step(chunk)
+                    residuals[rows] = (chunk - layer_embeddings).cpu()
+        model.current_layer = model.n_layers - 1
+        return model
+
+    def save_checkpoint(self, model: ResidualQuantization, checkpoint_path: str) -> None:
+        """
+        Save the model in the format of the checkpoints saved by Lightning when training
+        ResidualQuantization, so that it can be used by the inference pipeline.
+
+        Args:
+            model: The trained residual quantization model.
+            checkpoint_path: Path of the checkpoint to write.
+        """
+        checkpoint: Dict[str, Any] = {
+            "epoch": 0,
+            "global_step": 0,
+            "pytorch-lightning_version": lightning.__version__,
+            "state_dict": {
+                key: value.cpu() for key, value in model.state_dict().items()
+            },
+            "hyper_parameters": dict(model.hparams),
+        }
+        model.on_save_checkpoint(checkpoint)
+        os.makedirs(os.path.dirname(checkpoint_path) or ".", exist_ok=True)
+        torch.save(checkpoint, checkpoint_path)
+        command_line_logger.info(f"Saved checkpoint to {checkpoint_path}")
@@ -249,6 +249,7 @@ class ResidualQuantization(LightningModule):
                 layer_ids, layer_embeddings, layer_loss = layer.model_step(
                     current_residuals
                 )
+                # layers updated manually return their loss detached, it is only logged
                 quantization_loss += layer_loss
             else:
                 layer_ids, layer_embeddings = layer.predict_step(current_residuals)
@@ -737,6 +738,31 @@ class ResidualQuantization(LightningModule):
         )
         return model_output
 
+    @torch.no_grad()
+    def predict_cluster_ids(self, embeddings: torch.Tensor) -> torch.Tensor:
+        """
+        Assign the cluster ids of each layer to a batch of input embeddings.
+
+        Unlike predict_step, this does not require a trainer or ItemData, so it can be
+        used to assign ids to a whole embedding matrix in bulk.
+
+        Args:
+            embeddings: The input embeddings. Shape (batch_size, input_dim)
+
+        Returns:
+            cluster_ids: The cluster ids assigned to the input embeddings.
+                    Shape (batch_size, n_layers)
+        """
+        current_residuals = self.encoder(self.normalization_layer(embeddings))
+        cluster_ids = []
+        for layer in self.quantization_layer_list:
+            if self.normalize_residuals:
+                current_residuals = nn.functional.normalize(current_residuals, dim=-1)
+            layer_ids, layer_embeddings = layer.predict_step(current_residuals)
+            cluster_ids.append(layer_ids)
+            current_residuals = current_residuals - layer_embeddings
+        return torch.stack(cluster_ids, dim=-1)
+
     def configure_optimizers(self) -> Dict[str, Any]:
         """
         Configure the optimizer and learning rate scheduler.
@@ -0,0 +1,50 @@
+from typing import Optional
+
+import hydra
+import lightning as L
+import rootutils
+from omegaconf import DictConfig
+
+rootutils.setup_root(__file__, indicator=".project-root", pythonpath=True)
+
+from src.utils import RankedLogger, extras
+from src.utils.custom_hydra_resolvers import *
+
+command_line_logger = RankedLogger(__name__, rank_zero_only=True)
+
+
+def train_lloyd(cfg: DictConfig) -> None:
+    """Trains a residual k-means model offline with full-batch Lloyd iterations over the
+    embedding matrix, and saves it as a checkpoint usable by the inference pipeline.
+
+    :param cfg: A DictConfig configuration composed by Hydra.
+    """
+    if cfg.get("seed"):
+        L.seed_everything(cfg.seed, workers=True)
+
+    command_line_logger.info(f"Instantiating model <{cfg.model._target_}>")
+    model = hydra.utils.instantiate(cfg.model)
+
+    command_line_logger.info(f"Loading embeddings <{cfg.embeddings._target_}>")
+    embeddings = hydra.utils.instantiate(cfg.embeddings)
+
+    command_line_logger.info(f"Instantiating trainer <{cfg.lloyd_trainer._target_}>")
+    lloyd_trainer = hydra.utils.instantiate(cfg.lloyd_trainer)
+
+    command_line_logger.info("Starting training!")
+    model = lloyd_trainer.fit(model, embeddings)
+    lloyd_trainer.save_checkpoint(model, cfg.checkpoint_path)
+
+
+@hydra.main(version_base="1.3", config_path="../configs", config_name="train.yaml")
+def main(cfg: DictConfig) -> Optional[float]:
+    """Main entry point for offline residual k-means training.
+
+    :param cfg: DictConfig configuration composed by Hydra.
+    """
+    extras(cfg)
+    train_lloyd(cfg)
+
+
+if __name__ == "__main__":
+    main()
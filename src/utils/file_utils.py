@@ -17,6 +17,21 @@ def get_file_size(file_path: str) -> int:
     return fs.size(file_path)
 
 
+@retry()
+def get_file_modified_time(file_path: str) -> str:
+    """The last modification time of a local or remote file, or an empty string if the
+    filesystem does not report it."""
+    fs, _ = url_to_fs(file_path)
+    try:
+        return str(fs.modified(file_path))
+    except NotImplementedError:
+        info = fs.info(file_path)
+        for key in ("mtime", "updated", "LastModified", "last_modified"):
+            if key in info:
+                return str(info[key])
+        return ""
+
+
 @retry()
 def copy_to_remote(local_path: str, remote_path: str, recursive: bool = True) -> None:
     try:
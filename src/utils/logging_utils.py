@@ -1,16 +1,20 @@
 import json
 import os
+import time
 from importlib.util import find_spec
-from typing import Any, Dict
+from typing import Any, Dict, Optional
 
 from dotenv import load_dotenv
+import torch
 from lightning import Callback, LightningDataModule, LightningModule, Trainer
+from lightning.pytorch.trainer.states import TrainerFn
 from lightning_utilities.core.rank_zero import rank_zero_only
 from omegaconf import DictConfig, OmegaConf
 
 from src.utils import pylogger
 
 log = pylogger.RankedLogger(__name__, rank_zero_only=True)
+all_ranks_log = pylogger.RankedLogger(__name__, rank_zero_only=False)
 
 # logging constants
 END_RUN = "end_run"
@@ -107,3 +111,145 @@ def log_hyperparameters(
     # send hparams to all loggers
     for logger in trainer.loggers:
         logger.log_hyperparams(hparams)
+
+
+class DataLoadingMonitor(Callback):
+    """Logs metrics of the training data path, to tell whether a slow run is caused by the data
+    loading or by the model, and warns when the GPU is starved by data loading.
+
+    Logged every log_every_n_steps steps, averaged since the previous log:
+    - data/wait_time_ms: time per step between the end of a step and the start of the next
+      one, i.e. getting the batch from the dataloader and moving it to the device.
+    - data/step_time_ms and data/wait_fraction (wait time / (wait time + step time)).
+    - data/worker_{i}/rows_per_sec and data/rows_per_sec: rows yielded by the dataloader workers.
+    - data/collate_time_ms: time per batch in the collate function.
+    - data/preprocessing/{function}_us: time per row in each preprocessing function.
+    - data/queue_depth: batches ready for the step, in the DevicePrefetchLoader queue, the
+      SharedPreprocessingLoader buffer or the queue of the dataloader workers.
+
+    The worker statistics come from UnboundedSequenceIterable.enable_metrics_tracking,
+    which SequenceDataModule enables for training when the training dataloader config sets
+    track_data_loading_metrics.
+
+    CUDA kernels run asynchronously, so on a GPU the device is synchronized at the start and
+    at the end of every step to attribute the time to the step or to the wait. This removes
+    the overlap of the next step's host work with the current step's kernels, so the monitor
+    should only be enabled to diagnose a run.
+
+    Parameters
+    ----------
+    log_every_n_steps: int
+        The number of training steps between logs.
+    starvation_threshold: float
+        A warning is logged when the wait fraction is above this threshold.
+    synchronize_cuda: bool
+        Whether to synchronize the device around the steps on a GPU. Without it, the step
+        time only covers launching the kernels, and the wait time includes their execution.
+    """
+
+    def __init__(
+        self,
+        log_every_n_steps: int = 100,
+        starvation_threshold: float = 0.2,
+        synchronize_cuda: bool = True,
+    ):
+        super().__init__()
+        self.log_every_n_steps = log_every_n_steps
+        self.starvation_threshold = starvation_threshold
+        self.synchronize_cuda = synchronize_cuda
+        self._last_batch_end_time: Optional[float] = None
+        self._batch_start_time: Optional[float] = None
+        self._reset_step_times()
+        self._last_stats: Optional[torch.Tensor] = None
+        self._last_log_time: Optional[float] = None
+
+    def _reset_step_times(self):
+        self._wait_time = 0.0
+        self._step_time = 0.0
+        self._num_steps = 0
+
+    def _synchronize(self, pl_module) -> None:
+        if self.synchronize_cuda and pl_module.device.type == "cuda":
+            torch.cuda.synchronize(pl_module.device)
+
+    def on_train_batch_start(self, trainer, pl_module, batch, batch_idx) -> None:
+        self._synchronize(pl_module)
+        self._batch_start_time = time.perf_counter()
+        if self._last_batch_end_time is not None:
+            self._wait_time += self._batch_start_time - self._last_batch_end_time
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx) -> None:
+        self._synchronize(pl_module)
+        batch_end_time = time.perf_counter()
+        self._step_time += batch_end_time - self._batch_start_time
+        self._num_steps += 1
+        self._last_batch_end_time = batch_end_time
+        if self._num_steps >= self.log_every_n_steps:
+            pl_module.log_dict(self._compute_metrics(trainer), on_step=True, on_epoch=False)
+            self._reset_step_times()
+
+    def on_validation_start(self, trainer, pl_module) -> None:
+        # the validation time is not waiting on training data
+        self._last_batch_end_time = None
+
+    def _compute_metrics(self, trainer) -> Dict[str, float]:
+        metrics = {
+            "data/wait_time_ms": 1000 * self._wait_time / self._num_steps,
+            "data/step_time_ms": 1000 * self._step_time / self._num_steps,
+            "data/wait_fraction": self._wait_time
+            / max(self._wait_time + self._step_time, 1e-9),
+        }
+        if metrics["data/wait_fraction"] > self.starvation_threshold:
+            all_ranks_log.warning(
+                f"The GPU is starved by data loading: {100 * metrics['data/wait_fraction']:.1f}% "
+                f"of the time is spent waiting for batches ({metrics['data/wait_time_ms']:.1f}ms per step)."
+            )
+
+        dataloaders = trainer.train_dataloader
+        if not isinstance(dataloaders, (list, tuple)):
+            dataloaders = [dataloaders]
+        for dataloader in dataloaders:
+            if hasattr(dataloader, "queue_depth"):
+                metrics["data/queue_depth"] = float(dataloader.queue_depth)
+
+        dataset = getattr(trainer.datamodule, "stage_to_dataset", {}).get(
+            TrainerFn.FITTING, None
+        )
+        if dataset is None or getattr(dataset, "data_loading_stats", None) is None:
+            return metrics
+        metrics.update(self._compute_worker_metrics(dataset))
+        return metrics
+
+    def _compute_worker_metrics(self, dataset) -> Dict[str, float]:
+        # the stats are cumulative, we log the difference since the last log
+        stats = dataset.data_loading_stats.clone()
+        log_time = time.time()
+        last_stats = (
+            self._last_stats if self._last_stats is not None else torch.zeros_like(stats)
+        )
+        elapsed_time = (
+            log_time - self._last_log_time if self._last_log_time is not None else None
+        )
+        self._last_stats, self._last_log_time = stats, log_time
+        delta = stats - last_stats
+
+        metrics = {}
+        num_rows = delta[:, 0].sum().item()
+        if elapsed_time is not None and elapsed_time > 0:
+            for worker_id, worker_num_rows in enumerate(delta[:, 0].tolist()):
+                metrics[f"data/worker_{worker_id}/rows_per_sec"] = (
+                    worker_num_rows / elapsed_time
+                )
+            metrics["data/rows_per_sec"] = num_rows / elapsed_time
+        num_collates = delta[:, 3].sum().item()
+        if num_collates > 0:
+            metrics["data/collate_time_ms"] = 1000 * delta[:, 2].sum().item() / num_collates
+        if num_rows > 0:
+            # the preprocessing times are the last columns
+            function_names = dataset.get_preprocessing_function_names()
+            for name, function_time in zip(
+                function_names,
+                delta[:, stats.size(1) - len(function_names) :].sum(0).tolist(),
+            ):
+                metrics[f"data/preprocessing/{name}_us"] = 1e6 * function_time / num_rows
+        return metrics
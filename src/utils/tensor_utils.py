@@ -1,8 +1,28 @@
-from typing import Optional, Tuple, Union
-
+import atexit
+import fcntl
+import glob
+import hashlib
+import json
+import math
+import os
+import tempfile
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
+import psutil
 import torch
 
-from src.utils.file_utils import open_local_or_remote
+from src.utils.file_utils import (
+    get_file_modified_time,
+    get_file_size,
+    open_local_or_remote,
+)
+from src.utils.pylogger import RankedLogger
+
+command_line_logger = RankedLogger(__name__)
+
+# the cached tensor files this process registered as a reader of, see _cache_tensor_file
+_cached_tensor_files_read = []
 
 
 def locations_to_index_tuple(locations: torch.Tensor, num_dims: int = 2) -> Tuple:
@@ -128,8 +148,8 @@ def deduplicate_rows_in_tensor(
     """
     Identifies and de-duplicate repeated rows in a PyTorch tensor.
     Rows that are not duplicated will have a new column with value 0,
-    while rows that are duplicated will have a new column indicating the number of duplicates from 1 to N-1
-    where N is the number of duplicates for that row.
+    while rows that are duplicated will have a new column indicating their rank, from 1 to N
+    in their original order, among the N duplicates of that row.
 
     Args:
         file_path: Optional; Path to a file containing the tensor data.
@@ -141,39 +161,58 @@ def deduplicate_rows_in_tensor(
     if not file_path.endswith(".pt"):
         return None
     data = torch.load(open_local_or_remote(file_path, mode="rb"))
+    result = deduplicate_rows(data)
+    if return_tensor:
+        return result
+    else:
+        # Save the result to a file
+        torch.save(result, file_path)
+        return None
+
+
+def deduplicate_rows(data: torch.Tensor, keep_dtype: bool = False) -> torch.Tensor:
+    """
+    Append a column to a 2D tensor that tells apart its repeated rows. Rows that are not
+    duplicated get 0, and the N rows that share the same values get 1 to N.
+
+    Args:
+        data: A 2D tensor.
+        keep_dtype: If True, the result keeps the dtype of data, unless the new column needs
+            a wider integer dtype, instead of being converted to long.
+    Returns:
+        The tensor with the new column, as a long tensor unless keep_dtype is True.
+    """
     assert len(data.size()) == 2, "Input data must be a 2D PyTorch tensor."
 
     # Use torch.unique to get unique rows and their inverse indices
-    unique_rows, inverse_indices, counts = torch.unique(
+    _, inverse_indices, counts = torch.unique(
         data, dim=0, return_inverse=True, return_counts=True
     )
 
-    output_indices = torch.zeros_like(inverse_indices)
-
-    # Find indices where counts > 1 (meaning duplicates exist)
-    duplicate_indices = torch.where(counts > 1)[0]
-
-    for i in range(len(duplicate_indices)):
-        # Calculate number of collisions
-        num_of_collisions = counts[duplicate_indices[i]]
-
-        # Gather the indices where the collisions occur
-        indices_to_change = torch.where(inverse_indices == duplicate_indices[i])[0]
-
-        # Create a range based on the number of collision, starting from 1
-        range_to_add = torch.arange(1, num_of_collisions + 1)
+    # A stable sort by group keeps the rows of each group in their original order, so
+    # the rank of a row within its group is its position minus the start of its group.
+    # This is O(N log N) instead of a scan of all rows per group of duplicates.
+    order = torch.argsort(inverse_indices, stable=True)
+    sorted_groups = inverse_indices[order]
+    group_starts = torch.cumsum(counts, dim=0) - counts
+    sorted_ranks = (
+        torch.arange(1, data.shape[0] + 1, device=data.device)
+        - group_starts[sorted_groups]
+    )
+    # Rows that are not duplicated get 0
+    sorted_ranks[counts[sorted_groups] == 1] = 0
 
-        # Scatter to those specific indices
-        output_indices = output_indices.scatter(0, indices_to_change, range_to_add)
+    output_indices = torch.empty_like(inverse_indices)
+    output_indices[order] = sorted_ranks
 
     # Concatenate the duplicate indicator column to the original data
-    result = torch.cat((data, output_indices.unsqueeze(1)), dim=1).long()
-    if return_tensor:
-        return result
-    else:
-        # Save the result to a file
-        torch.save(result, file_path)
-        return None
+    if not keep_dtype:
+        return torch.cat((data, output_indices.unsqueeze(1)), dim=1).long()
+    max_rank = int(sorted_ranks.max()) if sorted_ranks.numel() else 0
+    dtype = torch.promote_types(
+        data.dtype, get_smallest_integer_dtype(0, max_rank, min_dtype=torch.int8)
+    )
+    return torch.cat((data.to(dtype), output_indices.to(dtype).unsqueeze(1)), dim=1)
 
 
 def transpose_tensor_from_file(
@@ -205,3 +244,300 @@ def transpose_tensor_from_file(
         # Save the result to a file
         torch.save(result, file_path)
         return None
+
+
+def _load_tensor_file(file_path: str) -> torch.Tensor:
+    """Load a tensor saved with torch.save, or a numpy array saved with np.save (.npy)."""
+    with open_local_or_remote(file_path, mode="rb") as f:
+        if file_path.endswith(".npy"):
+            return torch.from_numpy(np.load(f))
+        return torch.load(f)
+
+
+def _is_process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # the process exists but belongs to another user
+        return True
+    return True
+
+
+def _get_live_reader_pids(cached_path: str) -> List[int]:
+    """Get the processes registered as readers of a cached tensor file that are still alive.
+    Must be called with the lock of the file held."""
+    try:
+        with open(f"{cached_path}.readers", "r") as f:
+            pids = [int(pid) for pid in f.read().split()]
+    except FileNotFoundError:
+        return []
+    # the processes that crashed or were killed did not unregister themselves
+    return [pid for pid in pids if _is_process_alive(pid)]
+
+
+def _set_reader_pids(cached_path: str, pids: List[int]) -> None:
+    readers_path = f"{cached_path}.readers"
+    with open(f"{readers_path}.tmp", "w") as f:
+        f.write(" ".join(str(pid) for pid in pids))
+    os.replace(f"{readers_path}.tmp", readers_path)
+
+
+def _unregister_cached_tensor_reader() -> None:
+    """Unregister this process from the readers of the cached tensor files it read, and remove
+    the files that no live process reads anymore. The processes that mapped them keep their
+    pages until they unmap them. The lock files are kept, as a process may be waiting on them."""
+    for cached_path in _cached_tensor_files_read:
+        with open(f"{cached_path}.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                pids = [
+                    pid for pid in _get_live_reader_pids(cached_path) if pid != os.getpid()
+                ]
+                if pids:
+                    _set_reader_pids(cached_path, pids)
+                    continue
+                for path in (
+                    f"{cached_path}.json",
+                    cached_path,
+                    f"{cached_path}.readers",
+                ):
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+    _cached_tensor_files_read.clear()
+
+
+def _cache_tensor_file(
+    file_path: str,
+    cache_dir: str,
+    dtype: Optional[torch.dtype] = None,
+    remove_on_exit: bool = True,
+    transpose: bool = False,
+    compact: bool = False,
+) -> Tuple[str, dict]:
+    """Write the tensor of file_path as a raw binary file under cache_dir once per host, and
+    return the path of the binary file with its metadata (shape and dtype).
+
+    If remove_on_exit is True, the process is registered as a reader of the file (in a
+    .readers file next to it, under the lock) before the file is mapped, and unregisters
+    itself when it exits. The last live reader removes the file, so a process attaching later
+    (e.g. a restarted dataloader worker) either finds the file complete or writes it again,
+    whichever process wrote it first and in whatever order the processes exit."""
+    path_key = hashlib.md5(
+        f"{file_path}:{dtype}:{transpose}:{compact}".encode()
+    ).hexdigest()[:16]
+    # the size and modification time of the source are part of the key, so a source file
+    # regenerated at the same path is loaded again
+    version_key = hashlib.md5(
+        f"{get_file_size(file_path)}:{get_file_modified_time(file_path)}".encode()
+    ).hexdigest()[:16]
+    cached_path = os.path.join(cache_dir, f"shared_tensor_{path_key}_{version_key}.bin")
+    metadata_path = f"{cached_path}.json"
+
+    # only the first process on the host loads the source file, the others wait for it
+    with open(f"{cached_path}.lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            if not os.path.exists(metadata_path):
+                # the copies of previous versions of the source are stale
+                for stale_path in glob.glob(
+                    os.path.join(cache_dir, f"shared_tensor_{path_key}_*.bin")
+                ):
+                    if stale_path != cached_path:
+                        for path in (
+                            f"{stale_path}.json",
+                            stale_path,
+                            f"{stale_path}.readers",
+                        ):
+                            if os.path.exists(path):
+                                os.remove(path)
+                data = _load_tensor_file(file_path)
+                if transpose:
+                    data = data.t()
+                data = data.contiguous()
+                if compact:
+                    data = compact_integer_tensor(data)
+                if dtype is not None:
+                    data = data.to(dtype)
+                data.view(torch.uint8).numpy().tofile(f"{cached_path}.tmp")
+                os.replace(f"{cached_path}.tmp", cached_path)
+                # the metadata file is written last and marks the cached file as complete
+                with open(f"{metadata_path}.tmp", "w") as f:
+                    json.dump(
+                        {
+                            "shape": list(data.shape),
+                            "dtype": str(data.dtype).replace("torch.", ""),
+                        },
+                        f,
+                    )
+                os.replace(f"{metadata_path}.tmp", metadata_path)
+            with open(metadata_path, "r") as f:
+                metadata = json.load(f)
+            if remove_on_exit:
+                pids = _get_live_reader_pids(cached_path)
+                if os.getpid() not in pids:
+                    _set_reader_pids(cached_path, pids + [os.getpid()])
+                if cached_path not in _cached_tensor_files_read:
+                    if not _cached_tensor_files_read:
+                        atexit.register(_unregister_cached_tensor_reader)
+                    _cached_tensor_files_read.append(cached_path)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+    return cached_path, metadata
+
+
+def _map_cached_tensor(
+    file_path: str, cached_path: str, metadata: dict, shared: bool
+) -> torch.Tensor:
+    dtype = getattr(torch, metadata["dtype"])
+    shape = metadata["shape"]
+    mapped_tensor = torch.from_file(
+        cached_path, shared=shared, size=math.prod(shape), dtype=dtype
+    ).view(shape)
+
+    tensor_size_mb = mapped_tensor.numel() * mapped_tensor.element_size() / 2**20
+    process_rss_mb = psutil.Process().memory_info().rss / 2**20
+    command_line_logger.info(
+        f"Attached {file_path} {tuple(shape)} {dtype} ({tensor_size_mb:.1f} MB) from "
+        f"{cached_path}. Process RSS: {process_rss_mb:.1f} MB."
+    )
+    return mapped_tensor
+
+
+def load_tensor_to_shared_memory(
+    file_path: str,
+    shared_memory_dir: str = "/dev/shm",
+    remove_on_exit: bool = True,
+    transpose: bool = False,
+    compact: bool = False,
+) -> torch.Tensor:
+    """
+    Loads a tensor saved with torch.save into a file under shared_memory_dir once per host,
+    and returns a tensor memory-mapped from that file. Every process that calls this with
+    the same file_path (DataLoader workers, DDP ranks, or several config nodes pointing to
+    the same file) attaches to the same physical pages instead of holding its own copy.
+
+    Args:
+        file_path: Local or remote path to the tensor saved with torch.save.
+        shared_memory_dir: Directory backing the shared tensors. /dev/shm is RAM backed.
+        remove_on_exit: Whether the shared file is removed once the last process reading it
+            exits, so that it does not hold RAM after the run. Processes loading it with
+            False are not counted as readers.
+        transpose: Whether to store the transpose of the 2-D tensor, contiguous, e.g. the
+            N x D semantic id map looked up by SemanticIDDatasetConfig.
+        compact: Whether to store the integer tensor in the smallest integer dtype that
+            holds its values and -1 (see compact_integer_tensor).
+    Returns:
+        The tensor, memory-mapped from the shared file. It should be treated as read-only.
+    """
+    cached_path, metadata = _cache_tensor_file(
+        file_path,
+        shared_memory_dir,
+        remove_on_exit=remove_on_exit,
+        transpose=transpose,
+        compact=compact,
+    )
+    return _map_cached_tensor(file_path, cached_path, metadata, shared=True)
+
+
+def load_tensor_memory_mapped(
+    file_path: str,
+    cache_dir: Optional[str] = None,
+    dtype: Optional[Union[str, torch.dtype]] = None,
+    remove_on_exit: bool = True,
+) -> torch.Tensor:
+    """
+    Loads a tensor saved with torch.save (or a .npy array) into a raw file on local disk once
+    per host, and returns a tensor memory-mapped from that file. Unlike
+    load_tensor_to_shared_memory, the table does not have to fit in RAM: rows are read from
+    disk when they are accessed and cached by the OS page cache, which is shared by all
+    processes. Use it for large tables such as item embedding matrices.
+
+    Args:
+        file_path: Local or remote path to the tensor.
+        cache_dir: Local directory of the raw file. Defaults to the temporary directory.
+        dtype: If given, the table is stored in this dtype (e.g. float16 halves the disk
+            reads of a float32 embedding table).
+        remove_on_exit: Whether the raw file is removed once the last process reading it
+            exits, so that copies of large tables do not accumulate in cache_dir. Every
+            process mapping the file registers as a reader before mapping it, so a process
+            opening it later (e.g. a respawned worker) never finds it half removed.
+    Returns:
+        The tensor, memory-mapped from the local file. Writes to it are not saved to the file.
+    """
+    if isinstance(dtype, str):
+        dtype = getattr(torch, dtype)
+    cached_path, metadata = _cache_tensor_file(
+        file_path,
+        cache_dir or tempfile.gettempdir(),
+        dtype=dtype,
+        remove_on_exit=remove_on_exit,
+    )
+    return _map_cached_tensor(file_path, cached_path, metadata, shared=False)
+
+
+def gather_rows(table: torch.Tensor, indices: torch.Tensor) -> torch.Tensor:
+    """
+    Gathers the rows of table at indices. The rows are read in sorted order, so a
+    memory-mapped table is read sequentially instead of randomly.
+
+    Args:
+        table: The [N, ...] table.
+        indices: The indices of the rows to gather, of any shape.
+    Returns:
+        The gathered rows, of shape indices.shape + table.shape[1:].
+    """
+    flat_indices = indices.reshape(-1)
+    if flat_indices.numel() <= 1:
+        return table[indices]
+    sorted_indices, order = torch.sort(flat_indices)
+    sorted_rows = table[sorted_indices]
+    rows = torch.empty_like(sorted_rows)
+    rows[order] = sorted_rows
+    return rows.view(*indices.shape, *table.shape[1:])
+
+
+def get_smallest_integer_dtype(
+    min_value: int, max_value: int, min_dtype: torch.dtype = torch.int16
+) -> torch.dtype:
+    """
+    Returns the smallest signed integer dtype, not smaller than min_dtype, that holds all the
+    values in [min_value, max_value].
+
+    Args:
+        min_value: The smallest value to represent.
+        max_value: The largest value to represent.
+        min_dtype: The smallest dtype to return.
+    Returns:
+        One of torch.int8, torch.int16, torch.int32 or torch.int64.
+    """
+    integer_dtypes = [torch.int8, torch.int16, torch.int32, torch.int64]
+    for dtype in integer_dtypes[integer_dtypes.index(min_dtype) :]:
+        dtype_info = torch.iinfo(dtype)
+        if dtype_info.min <= min_value and max_value <= dtype_info.max:
+            return dtype
+    return torch.int64
+
+
+def compact_integer_tensor(data: torch.Tensor, min_value: int = -1) -> torch.Tensor:
+    """
+    Converts an integer tensor to the smallest integer dtype (at least int16) that holds its
+    values and min_value.
+
+    Args:
+        data: The integer tensor.
+        min_value: A value that should stay representable, e.g. the -1 padding token.
+    Returns:
+        The tensor in the compact dtype. It is data itself if the dtype does not change.
+    """
+    if data.numel() == 0:
+        return data
+    dtype = get_smallest_integer_dtype(
+        min(int(data.min()), min_value), max(int(data.max()), min_value)
+    )
+    return data.to(dtype)
@@ -220,9 +220,14 @@ def lightning_precision_to_dtype(precision: str) -> torch.dtype:
             "Supported precision types are: '32', '32-true', '64', '16', '16-mixed', 'bf16', 'half'."
         )
 
-def load_tokenize(config: TokenizerConfig) -> Any:
-    """Load tokenizer and return a partial function for tokenization."""
+def get_prepared_tokenizer(config: TokenizerConfig) -> Any:
+    """Add the special tokens and the eos post-processor to the tokenizer of the config.
+    This is done once per config: the config records it, and the processes it is copied
+    to (e.g. dataloader workers) get the prepared tokenizer with it."""
     tokenizer = config.tokenizer
+    if config.is_tokenizer_prepared:
+        return tokenizer
+
     if hasattr(config, "special_tokens"):
         tokenizer.add_special_tokens(config.special_tokens)
     if config.postprocess_eos_token:
@@ -230,6 +235,13 @@ def load_tokenize(config: TokenizerConfig) -> Any:
             single="$A " + tokenizer.eos_token,
             special_tokens=[(tokenizer.eos_token, tokenizer.eos_token_id)],
         )
+    config.is_tokenizer_prepared = True
+    return tokenizer
+
+
+def load_tokenize(config: TokenizerConfig) -> Any:
+    """Load tokenizer and return a partial function for tokenization."""
+    tokenizer = get_prepared_tokenizer(config)
     tokenize = partial(
         tokenizer.encode_plus,
         max_length=config.max_length,
@@ -240,6 +252,22 @@ def load_tokenize(config: TokenizerConfig) -> Any:
     )
     return tokenize
 
+
+def load_batch_tokenize(config: TokenizerConfig) -> Any:
+    """Load tokenizer and return a partial function that tokenizes a list of texts in one call.
+    Fast tokenizers encode the whole list in parallel. With padding="longest", the texts are
+    only padded to the longest text of the list instead of max_length."""
+    tokenizer = get_prepared_tokenizer(config)
+    tokenize = partial(
+        tokenizer,
+        max_length=config.max_length,
+        padding=config.padding,
+        truncation=config.truncation,
+        add_special_tokens=config.add_special_tokens,
+        return_tensors="pt",
+    )
+    return tokenize
+
 def sample_gumbel(shape: Tuple, device: torch.device, eps=1e-20) -> torch.Tensor:
     """Sample from Gumbel(0, 1)"""
     U = torch.rand(shape, device=device)